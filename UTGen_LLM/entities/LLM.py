@@ -1,8 +1,18 @@
+import os
+import sys
+import time
 import pickle
 from abc import abstractmethod, ABC
 
+import openai
 from loguru import logger
-from openai import OpenAI
+
+# The HTTP clients, endpoint pool and backoff are shared with assert_mate: neither `utils` folder is a regular
+# package, so assert_mate's modules join this project's `utils` namespace.
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../assert_mate")))
+from utils.http_clients import configure_http_pool, get_openai_client
+from utils.endpoint_pool import load_endpoint_pool
+from utils.rate_limiter import backoff_delay, retry_after_seconds
 
 
 class LLM(ABC):
@@ -27,15 +37,54 @@ class DeepSeek(LLM):
             self.top_p = config["llm"]["top_p"]
             self.max_tokens = config["llm"]["max_tokens"]
             self.model = config["llm"]["model"]
-            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+            self.max_retries = config["llm"].get("max_retries", 6)
+            self.backoff_base = config["llm"].get("backoff_base", 1.0)
+            self.backoff_cap = config["llm"].get("backoff_cap", 60.0)
         except Exception:
             logger.error(
                 "Error loading configuration: llm.key or llm.api, please check the configuration file."
             )
             exit(-1)
+        configure_http_pool(config.get("http_pool", {}))
+        self.endpoints = load_endpoint_pool(config["llm"])
+
+    def _create(self, **kwargs):
+        """
+        Sends a chat completion to the least loaded healthy endpoint, failing over to the others on transient
+        errors. Once every endpoint has failed the request, it is retried after an exponential backoff (or the
+        server's `Retry-After`), at most `llm.max_retries` times.
+        """
+        attempt = 0
+        failed = []
+        while True:
+            endpoint = self.endpoints.acquire(exclude=failed)
+            # The model override of one endpoint must not carry over to the next.
+            request = {**kwargs, "model": endpoint.model} if endpoint.model else kwargs
+            try:
+                response = get_openai_client(endpoint.api_key, endpoint.base_url).chat.completions.create(**request)
+            except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) as e:
+                self.endpoints.release(endpoint, success=isinstance(e, openai.RateLimitError))
+                failed.append(endpoint)
+                if self.endpoints.has_alternative(endpoint, failed):
+                    logger.warning(f"Endpoint {endpoint.name} failed: {str(e)}, failing over.")
+                    continue
+                if attempt >= self.max_retries:
+                    logger.error(f"Request failed after {attempt + 1} attempts: {str(e)}")
+                    raise
+                retry_after = retry_after_seconds(e)
+                delay = retry_after if retry_after else backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+                logger.warning(f"{type(e).__name__} on attempt {attempt + 1}, retrying in {delay:.1f}s.")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except openai.APIError as e:
+                self.endpoints.release(endpoint, success=isinstance(e, openai.BadRequestError))
+                raise
+            self.endpoints.release(endpoint)
+            return response
 
     def get_response(self, messages):
-        response = self.client.chat.completions.create(
+        response = self._create(
             model=self.model,
             messages=messages,
             stream=False,
@@ -47,8 +96,7 @@ class DeepSeek(LLM):
 
     def get_response_with_prefix(self, messages, prefix="```java\nassertEquals("):
         new_message = pickle.loads(pickle.dumps(messages))
-        extend_client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-        response = extend_client.chat.completions.create(
+        response = self._create(
             model=self.model,
             messages=new_message,
             extra_body={"prefix": prefix},
@@ -1,9 +1,13 @@
+import re
 import sys
 
 sys.path.extend(['.', '..'])
 from agents.base.llm import *
 from agents.base.generator import Generator
 from utils.multi_processing_cache import MultiProcessingCache
+from utils.llm_metrics import call_tags
+from utils.message_history import MessageHistory
+from utils.prompt_layout import EQUALS_QUESTION, BOOLEAN_QUESTION, NULL_QUESTION, ANSWER_FORMAT, similar_example
 import time
 
 class RAGGenerator(Generator):
@@ -236,16 +240,15 @@ class RAGGenerator(Generator):
             exit(-1)
         judge_response = kwargs['judge_response']
         # First round: Understand the intention of the focal method
-        messages = self.history
-        messages.append({
-            'role': 'user',
-            'content': f"Now you are working with other colleagues to write proper assertion for the given method. Your codename is `NaiveGenerator`.\n"
-                       f"Now, you and others have different answers, and your superior have commented on your answers.\n"
-                       f"Please refine your previous answer according to his comment:\n\n{judge_response}\n\n"
-                       f"Please write your answer in a code block and do not provide any explanation."
-        })
-        response = self.model.get_response(messages=messages)
-        self._history = pickle.loads(pickle.dumps(messages))
+        messages = self.history.with_message(
+            role='user',
+            content=f"Now you are working with other colleagues to write proper assertion for the given method. Your codename is `NaiveGenerator`.\n"
+                    f"Now, you and others have different answers, and your superior have commented on your answers.\n"
+                    f"Please refine your previous answer according to his comment:\n\n{judge_response}\n\n"
+                    f"Please write your answer in a code block and do not provide any explanation."
+        )
+        response = self.model.get_response(messages=self._compact(messages))
+        self.update_history(messages)
         self._record_history('assistant', response)
         return response
 
@@ -285,19 +288,21 @@ class RAGGenerator(Generator):
         #                                    retrieved_test_case=retrieved_test_case,
         #                                    focal_method=focal_method,
         #                                    test_prefix=test_prefix)
-        messages = self._group_messages_v2_with_code_features(retrieved_focal_method=retrieved_focal_method,
-                                                              retrieved_test_case=retrieved_test_case,
-                                                              focal_method=focal_method,
-                                                              test_prefix=test_prefix,
-                                                              focal_class_fields=kwargs['focal_class_fields'],
-                                                              focal_class_methods=kwargs['focal_class_methods'],
-                                                              test_class_fields=kwargs['test_class_fields'],
-                                                              actual_value=kwargs['actual_value']
-                                                              )
+        if self.model.prefix_cache_layout:
+            messages = self._layout_messages(
+                similar_example(retrieved_focal_method, retrieved_test_case) + EQUALS_QUESTION + ANSWER_FORMAT, **kwargs)
+        else:
+            messages = self._group_messages_v2_with_code_features(retrieved_focal_method=retrieved_focal_method,
+                                                                  retrieved_test_case=retrieved_test_case,
+                                                                  focal_method=focal_method,
+                                                                  test_prefix=test_prefix,
+                                                                  **self._class_context(**kwargs),
+                                                                  actual_value=kwargs['actual_value']
+                                                                  )
         # response = self.model.get_response_with_prefix(
         #     messages, prefix=f'I think the answer should be:\n```java\nassertEquals(')
-        response = self.model.get_response(messages=messages)
-        self._history = pickle.loads(pickle.dumps(messages))
+        response = self._respond_with_assertion(messages)
+        self.update_history(messages)
         self._record_history('assistant', response)
         return response
 
@@ -332,14 +337,18 @@ class RAGGenerator(Generator):
             retrieved_focal_method = kwargs['retrieved_focal_method']
             retrieved_test_case = kwargs['retrieved_test_case']
 
-        messages = self._group_messages_v2_for_assertBool(retrieved_focal_method=retrieved_focal_method,
-                                                          retrieved_test_case=retrieved_test_case,
-                                                          focal_method=focal_method,
-                                                          test_prefix=test_prefix)
+        if self.model.prefix_cache_layout:
+            messages = self._layout_messages(
+                similar_example(retrieved_focal_method, retrieved_test_case) + BOOLEAN_QUESTION + ANSWER_FORMAT, **kwargs)
+        else:
+            messages = self._group_messages_v2_for_assertBool(retrieved_focal_method=retrieved_focal_method,
+                                                              retrieved_test_case=retrieved_test_case,
+                                                              focal_method=focal_method,
+                                                              test_prefix=test_prefix)
         # response = self.model.get_response_with_prefix(
         #     messages, prefix='I think the answer should be:\n```java\nassert')
-        response = self.model.get_response(messages=messages)
-        self._history = pickle.loads(pickle.dumps(messages))
+        response = self._respond_with_assertion(messages)
+        self.update_history(messages)
         self._record_history('assistant', response)
         return response
 
@@ -374,14 +383,18 @@ class RAGGenerator(Generator):
             retrieved_focal_method = kwargs['retrieved_focal_method']
             retrieved_test_case = kwargs['retrieved_test_case']
 
-        messages = self._group_messages_v2_for_assertNullValue(retrieved_focal_method=retrieved_focal_method,
-                                                               retrieved_test_case=retrieved_test_case,
-                                                               focal_method=focal_method,
-                                                               test_prefix=test_prefix)
+        if self.model.prefix_cache_layout:
+            messages = self._layout_messages(
+                similar_example(retrieved_focal_method, retrieved_test_case) + NULL_QUESTION + ANSWER_FORMAT, **kwargs)
+        else:
+            messages = self._group_messages_v2_for_assertNullValue(retrieved_focal_method=retrieved_focal_method,
+                                                                   retrieved_test_case=retrieved_test_case,
+                                                                   focal_method=focal_method,
+                                                                   test_prefix=test_prefix)
         # response = self.model.get_response_with_prefix(
         #     messages, prefix='I think the answer should be:\n```java\nassert')
-        response = self.model.get_response(messages=messages)
-        self._history = pickle.loads(pickle.dumps(messages))
+        response = self._respond_with_assertion(messages)
+        self.update_history(messages)
         self._record_history('assistant', response)
         return response
 
@@ -425,14 +438,12 @@ class RAGGenerator(Generator):
                                                               retrieved_test_case=retrieved_test_case,
                                                               focal_method=focal_method,
                                                               test_prefix=test_prefix,
-                                                              focal_class_fields=kwargs['focal_class_fields'],
-                                                              focal_class_methods=kwargs['focal_class_methods'],
-                                                              test_class_fields=kwargs['test_class_fields'],
+                                                              **self._class_context(**kwargs),
                                                               actual_value=kwargs['actual_value']
                                                               )
         responses, probs = self.model.get_multiple_responses_with_prefix(
             messages, prefix=f'I think the assertion should be:\n```java\nassertEquals(')
-        self._history = pickle.loads(pickle.dumps(messages))
+        self.update_history(messages)
         return responses, probs
 
     def generate_assertBoolean_multiple(self, **kwargs):
@@ -473,7 +484,7 @@ class RAGGenerator(Generator):
         responses, probs = self.model.get_multiple_responses_with_prefix(
             messages, prefix='I think the assertion should be:\n```java\nassert')
         # response = self.model.get_response(messages=messages)
-        self._history = pickle.loads(pickle.dumps(messages))
+        self.update_history(messages)
         # self._record_history('assistant', response)
         return responses, probs
 
@@ -514,7 +525,7 @@ class RAGGenerator(Generator):
                                                                test_prefix=test_prefix)
         responses, probs = self.model.get_multiple_responses_with_prefix(
             messages, prefix='I think the assertion should be:\n```java\nassert')
-        self._history = pickle.loads(pickle.dumps(messages))
+        self.update_history(messages)
         # self._record_history('assistant', response)
         return responses, probs
 
@@ -530,7 +541,7 @@ class BaselineRAGGenerator(Generator):
             "And you can refer to their opinions to revise yours or defend your own. "
             "Please remember there should and must be a more plausible answer in the responses.")
         super().__init__(model, debate_system_prompt)
-        self.understanding_history = []
+        self.understanding_history = MessageHistory()
         pass
 
     def construct_generation_messages(self, understanding, focal_method, test_prefix, retrieved_test_case):
@@ -578,7 +589,7 @@ class BaselineRAGGenerator(Generator):
         understanding = '\n'.join([chat['content'] for chat in dialog[2:] if chat['role'] == 'assistant'])
         history = self.construct_generation_messages(understanding, kwargs['focal_method'], kwargs['test_prefix'],
                                                      kwargs['retrieved_test_case'])
-        self.understanding_history = pickle.loads(pickle.dumps(dialog))
+        self.understanding_history = MessageHistory(dialog)
         start = time.time()
         response = self.model.get_response(history)
         end = time.time()
@@ -761,16 +772,15 @@ class NaiveGenerator(Generator):
             exit(-1)
         judge_response = kwargs['judge_response']
         # First round: Understand the intention of the focal method
-        messages = self.history
-        messages.append({
-            'role': 'user',
-            'content': f"Now you are working with other colleagues to write proper assertion for the given method. Your codename is `NaiveGenerator`.\n"
-                       f"Now, you and others have different answers, and your superior have commented on your answers.\n"
-                       f"Please refine your previous answer according to his comment:\n\n{judge_response}\n\n"
-                       f"Please write your answer in a code block and do not provide any explanation."
-        })
-        response = self.model.get_response(messages=messages)
-        self._history = pickle.loads(pickle.dumps(messages))
+        messages = self.history.with_message(
+            role='user',
+            content=f"Now you are working with other colleagues to write proper assertion for the given method. Your codename is `NaiveGenerator`.\n"
+                    f"Now, you and others have different answers, and your superior have commented on your answers.\n"
+                    f"Please refine your previous answer according to his comment:\n\n{judge_response}\n\n"
+                    f"Please write your answer in a code block and do not provide any explanation."
+        )
+        response = self.model.get_response(messages=self._compact(messages))
+        self.update_history(messages)
         self._record_history('assistant', response)
         return response
 
@@ -799,17 +809,22 @@ class NaiveGenerator(Generator):
             exit(-1)
         focal_method = kwargs['focal_method']
         test_prefix = kwargs['test_prefix']
-        focal_class_fields = kwargs['focal_class_fields']
-        focal_class_methods = kwargs['focal_class_methods']
-        test_class_fields = kwargs['test_class_fields']
+        context = self._class_context(**kwargs)
+        focal_class_fields = context['focal_class_fields']
+        focal_class_methods = context['focal_class_methods']
+        test_class_fields = context['test_class_fields']
         actual_value = kwargs['actual_value']
-        messages = self._group_messages_with_code_features(focal_method, test_prefix, focal_class_fields,
-                                                           focal_class_methods, test_class_fields,
-                                                           actual_value=kwargs['actual_value'])
+        if self.model.prefix_cache_layout:
+            messages = self._layout_messages(EQUALS_QUESTION + 'Please directly respond the code without any explanation.',
+                                              **kwargs)
+        else:
+            messages = self._group_messages_with_code_features(focal_method, test_prefix, focal_class_fields,
+                                                               focal_class_methods, test_class_fields,
+                                                               actual_value=kwargs['actual_value'])
         # response = self.model.get_response_with_prefix(
         #     messages, prefix=f'I think the answer should be:\n```java\nassertEquals(')
-        response = self.model.get_response(messages=messages)
-        self._history = pickle.loads(pickle.dumps(messages))
+        response = self._respond_with_assertion(messages)
+        self.update_history(messages)
         self._record_history('assistant', response)
         return response
 
@@ -829,13 +844,16 @@ class NaiveGenerator(Generator):
             expected_value_type = None
         # messages = self._group_messages_with_code_features(focal_method, test_prefix, kwargs['focal_class_fields'],
         #                                                    kwargs['focal_class_methods'], kwargs['test_class_fields'])
-        messages = self._group_messages_for_assertBoolean(
-            focal_method, test_prefix, expected_value_type)
+        if self.model.prefix_cache_layout:
+            messages = self._layout_messages(BOOLEAN_QUESTION + ANSWER_FORMAT, **kwargs)
+        else:
+            messages = self._group_messages_for_assertBoolean(
+                focal_method, test_prefix, expected_value_type)
 
         # response = self.model.get_response_with_prefix(
         #     messages, prefix='I think the answer should be:\n```java\nassert')
-        response = self.model.get_response(messages=messages)
-        self._history = pickle.loads(pickle.dumps(messages))
+        response = self._respond_with_assertion(messages)
+        self.update_history(messages)
         self._record_history('assistant', response)
         return response
 
@@ -852,13 +870,16 @@ class NaiveGenerator(Generator):
 
         # messages = self._group_messages_with_code_features(focal_method, test_prefix, kwargs['focal_class_fields'],
         #                                                    kwargs['focal_class_methods'], kwargs['test_class_fields'])
-        messages = self._group_messages_for_assertNullValues(
-            focal_method, test_prefix)
+        if self.model.prefix_cache_layout:
+            messages = self._layout_messages(NULL_QUESTION + ANSWER_FORMAT, **kwargs)
+        else:
+            messages = self._group_messages_for_assertNullValues(
+                focal_method, test_prefix)
 
         # response = self.model.get_response_with_prefix(
         #     messages, prefix='I think the answer should be:\n```java\nassert')
-        response = self.model.get_response(messages=messages)
-        self._history = pickle.loads(pickle.dumps(messages))
+        response = self._respond_with_assertion(messages)
+        self.update_history(messages)
         self._record_history('assistant', response)
         return response
 
@@ -872,9 +893,10 @@ class NaiveGenerator(Generator):
             exit(-1)
         focal_method = kwargs['focal_method']
         test_prefix = kwargs['test_prefix']
-        focal_class_fields = kwargs['focal_class_fields']
-        focal_class_methods = kwargs['focal_class_methods']
-        test_class_fields = kwargs['test_class_fields']
+        context = self._class_context(**kwargs)
+        focal_class_fields = context['focal_class_fields']
+        focal_class_methods = context['focal_class_methods']
+        test_class_fields = context['test_class_fields']
         actual_value = kwargs['actual_value']
         messages = self._group_messages_with_code_features(focal_method, test_prefix, focal_class_fields,
                                                            focal_class_methods, test_class_fields,
@@ -882,7 +904,7 @@ class NaiveGenerator(Generator):
         responses, probs = self.model.get_multiple_responses_with_prefix(
             messages, prefix=f'I think the assertion should be:\n```java\nassertEquals(')
         # response = self.model.get_response(messages=messages)
-        self._history = pickle.loads(pickle.dumps(messages))
+        self.update_history(messages)
         # self._record_history('assistant', response)
         return responses, probs
 
@@ -908,7 +930,7 @@ class NaiveGenerator(Generator):
         responses, probs = self.model.get_multiple_responses_with_prefix(
             messages, prefix='I think the assertion should be:\n```java\nassert')
         # response = self.model.get_response(messages=messages)
-        self._history = pickle.loads(pickle.dumps(messages))
+        self.update_history(messages)
         # self._record_history('assistant', response)
         return responses, probs
 
@@ -930,12 +952,16 @@ class NaiveGenerator(Generator):
 
         responses, probs = self.model.get_multiple_responses_with_prefix(
             messages, prefix='I think the assertion should be:\n```java\nassert')
-        self._history = pickle.loads(pickle.dumps(messages))
+        self.update_history(messages)
         return responses, probs
 
 
 class FourStepCoTGenerator(Generator):
-    def __init__(self, model):
+    # Section headers of the single-turn answer, one per round of the multi-round conversation.
+    single_turn_headers = ['### Step 1: Scenario', '### Step 2: Execution path', '### Step 3: Output',
+                           '### Step 4: Assertion']
+
+    def __init__(self, model, single_turn: bool = False):
         debate_system_prompt = (
             "You are an expert in software testing, with 10 years of experience. You are very good at writing test cases. "
             "Now you are user3 in a round table debate of three users. "
@@ -945,55 +971,201 @@ class FourStepCoTGenerator(Generator):
             "Please remember there should and must be a more plausible answer in the responses.")
         super().__init__(model, debate_system_prompt)
         self.system_prompt = "You are an expert in software testing, with 10 years of experience. You are very good at writing test cases. You must give short and concise answers."
+        # Ask all four rounds in one prompt instead of four sequential calls.
+        self.single_turn = single_turn
+        self.single_turn_exchange = MessageHistory()
+        # Class context of the current instance, for the prefix-cache layout.
+        self._class_features = {}
+
+    def _thought(self, step, messages, cot_cache: MultiProcessingCache | None) -> str:
+        # The first three rounds only depend on the conversation so far, so instances that send the same
+        # messages (in this run or an earlier one) share their answers through `cot_cache`.
+        messages = self._compact(messages)
+        with call_tags(step=step):
+            if cot_cache is None:
+                return self.model.get_response(messages=messages)
+            key = cot_cache.thought_key(getattr(self.model, 'model', None), step, messages)
+            thought = cot_cache.get_thought(key)
+            if thought is None:
+                thought = self.model.get_response(messages=messages)
+                if thought:
+                    cot_cache.put_thought(key, thought)
+            return thought
+
+    def _reason(self, focal_method_name, focal_method, test_prefix, cot_cache: MultiProcessingCache | None):
+        """
+        Runs the first three rounds, leaving their messages and answers in the history.
+        """
+        if self.single_turn:
+            self._single_turn(focal_method_name, focal_method, test_prefix, cot_cache=cot_cache)
+            return
+        first_round_response = self._thought('first_round', self.first_round_messages(
+            focal_method_name, focal_method, test_prefix), cot_cache)
+        self._record_history(role='assistant', content=first_round_response)
+        second_round_response = self._thought('second_round', self.second_round_messages(
+            focal_method_name, focal_method, test_prefix), cot_cache)
+        self._record_history(role='assistant', content=second_round_response)
+        third_round_response = self._thought('third_round', self.third_round_messages(
+            focal_method_name, focal_method, test_prefix), cot_cache)
+        self._record_history(role='assistant', content=third_round_response)
 
-    def first_round_messages(self, focal_method_name, focal_method, test_prefix):
-        messages = [{
+    def single_turn_messages(self, focal_method_name, focal_method, test_prefix, final_instruction=None):
+        """
+        One prompt with the instructions of the first three rounds and, if given, the final round, each under its
+        `single_turn_headers` entry so that the answer can be split back into rounds.
+        """
+        instructions = [self._round_instruction(step, focal_method_name, focal_method, test_prefix)
+                        for step in range(3)]
+        if final_instruction is not None:
+            instructions.append(final_instruction)
+        content = 'Please answer the following steps in order. Start the answer of every step with its header, ' \
+                  'exactly as given, on a line of its own.\n\n'
+        for header, instruction in zip(self.single_turn_headers, instructions):
+            content += f'{header}\n{instruction}\n\n'
+        if self.model.prefix_cache_layout:
+            return self._layout_messages(content, focal_method, test_prefix, **self._class_features)
+        return [{
             'role': 'system',
             'content': self.system_prompt
         }, {
             'role': 'user',
-            'content': f'I have a test case for a method named`{focal_method_name}`:\n```java\n{test_prefix}\n```\n'
-                       f'Please read the test case, and tell me what scenario does this test case cover.'
-            #    f'Please read the test case, and find out the input values in the test case for the `{focal_method_name}`.'
+            'content': content
         }]
+
+    @staticmethod
+    def split_single_turn_response(response: str, num_steps: int) -> list:
+        """
+        Splits a single-turn answer at its `Step N` headers. Steps the model skipped are returned as ''.
+        """
+        sections = [''] * num_steps
+        headers = [m for m in re.finditer(r'^[#*\s]*Step\s*(\d+)\b.*$', response, flags=re.MULTILINE)
+                   if 1 <= int(m.group(1)) <= num_steps]
+        for i, header in enumerate(headers):
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(response)
+            sections[int(header.group(1)) - 1] = response[header.end():end].strip()
+        return sections
+
+    def _single_turn(self, focal_method_name, focal_method, test_prefix, final_instruction=None,
+                     cot_cache: MultiProcessingCache | None = None):
+        """
+        Asks every round in one request and rebuilds the history of the first three rounds from the answer, as if
+        they had been asked one by one. Returns the final-round section if `final_instruction` is given.
+        """
+        messages = self.single_turn_messages(focal_method_name, focal_method, test_prefix, final_instruction)
+        if final_instruction is None:
+            response = self._thought('single_turn', messages, cot_cache)
+        else:
+            with call_tags(step='single_turn'):
+                response = self.model.get_response(messages=messages)
+        self.single_turn_exchange = MessageHistory(messages).with_message(role='assistant', content=response)
+        sections = self.split_single_turn_response(response, 3 if final_instruction is None else 4)
+        self.first_round_messages(focal_method_name, focal_method, test_prefix)
+        self._record_history(role='assistant', content=sections[0])
+        self.second_round_messages(focal_method_name, focal_method, test_prefix)
+        self._record_history(role='assistant', content=sections[1])
+        self.third_round_messages(focal_method_name, focal_method, test_prefix)
+        self._record_history(role='assistant', content=sections[2])
+        if final_instruction is None:
+            return None
+        # Without a recognizable final section the whole answer still carries the assertion.
+        return sections[3] or response
+
+    @staticmethod
+    def first_round_instruction(focal_method_name, test_prefix):
+        return f'I have a test case for a method named`{focal_method_name}`:\n```java\n{test_prefix}\n```\n' \
+               f'Please read the test case, and tell me what scenario does this test case cover.'
+        #    f'Please read the test case, and find out the input values in the test case for the `{focal_method_name}`.'
+
+    @staticmethod
+    def second_round_instruction(focal_method_name, focal_method):
+        return f'Here is the code of `{focal_method_name}` method:\n```java\n{focal_method}\n```\n' \
+               f'Please read the code, and analyze the execution path of the `{focal_method_name}` method when given the input values.'
+
+    @staticmethod
+    def third_round_instruction(focal_method_name):
+        return f'According to your analysis, what is the output of the `{focal_method_name}` method under the given inputs?'
+
+    @staticmethod
+    def final_round_instruction(test_prefix):
+        instruction = f'Based on your analysis, please accomplish the given test case by filling proper value in the `<expected_value>` part:\n```java\n{test_prefix}\n```\n'
+        instruction += "\nPlease write down the completed assertion and provide a short explaination. You should keep your answer within 200 words. "
+        return instruction
+
+    @staticmethod
+    def final_round_instruction_for_assertBoolean(test_prefix):
+        instruction = f'Based on your analysis, please accomplish the given test case by writing an assertion statement in the `<AssertionPlaceHolder>` line:\n```java\n{test_prefix}\n```\n'
+        instruction += f"Please read my code and write an assertion statement in the `<AssertionPlaceHolder>` line." + \
+                       "Note that you **MUST** use either `assertTrue()` or `assertFalse()` method to verify the result." + \
+                       "Please write down the assertion and provide a short explaination. You should keep your answer within 200 words."
+        return instruction
+
+    @staticmethod
+    def final_round_instruction_assertNullValues(test_prefix):
+        instruction = f'Based on your analysis, please accomplish the given test case by writing an assertion statement in the `<AssertionPlaceHolder>` line:\n```java\n{test_prefix}\n```\n'
+        instruction += "Note that you **MUST** use either `assertNull()` or `assertNotNull()` method to verify the result." + \
+                       "Please write down the assertion and provide a short explanation. You should keep your answer within 200 words."
+        return instruction
+
+    def _round_instruction(self, step, focal_method_name, focal_method, test_prefix):
+        # With the prefix-cache layout, the test case and the focal method are already in the first message.
+        if step == 0:
+            if self.model.prefix_cache_layout:
+                return 'Please read the test case, and tell me what scenario does this test case cover.'
+            return self.first_round_instruction(focal_method_name, test_prefix)
+        if step == 1:
+            if self.model.prefix_cache_layout:
+                return f'Please read the code of the `{focal_method_name}` method, and analyze its execution path when given the input values.'
+            return self.second_round_instruction(focal_method_name, focal_method)
+        return self.third_round_instruction(focal_method_name)
+
+    def _final_instruction(self, assertion_kind, test_prefix):
+        """
+        The final-round instruction for `assertion_kind` ('equals', 'boolean' or 'null').
+        """
+        if self.model.prefix_cache_layout:
+            question = {'equals': EQUALS_QUESTION, 'boolean': BOOLEAN_QUESTION, 'null': NULL_QUESTION}[assertion_kind]
+            return 'Based on your analysis, p' + question[1:] + ANSWER_FORMAT
+        return {'equals': self.final_round_instruction,
+                'boolean': self.final_round_instruction_for_assertBoolean,
+                'null': self.final_round_instruction_assertNullValues}[assertion_kind](test_prefix)
+
+    def first_round_messages(self, focal_method_name, focal_method, test_prefix):
+        instruction = self._round_instruction(0, focal_method_name, focal_method, test_prefix)
+        if self.model.prefix_cache_layout:
+            messages = self._layout_messages(instruction, focal_method, test_prefix, **self._class_features)
+        else:
+            messages = [{
+                'role': 'system',
+                'content': self.system_prompt
+            }, {
+                'role': 'user',
+                'content': instruction
+            }]
         self.update_history(messages)
         return messages
 
     def second_round_messages(self, focal_method_name, focal_method, test_prefix):
-        new_messages = pickle.loads(pickle.dumps(self._history))
-        new_messages.append({
-            'role': 'user',
-            'content': f'Here is the code of `{focal_method_name}` method:\n```java\n{focal_method}\n```\n'
-                       f'Please read the code, and analyze the execution path of the `{focal_method_name}` method when given the input values.'
-        })
+        new_messages = self._history.with_message(
+            role='user', content=self._round_instruction(1, focal_method_name, focal_method, test_prefix))
         self.update_history(new_messages)
         return new_messages
 
     def third_round_messages(self, focal_method_name, focal_method, test_prefix):
-        new_messages = pickle.loads(pickle.dumps(self._history))
-        new_messages.append({
-            'role': 'user',
-            'content': f'According to your analysis, what is the output of the `{focal_method_name}` method under the given inputs?'
-        })
+        new_messages = self._history.with_message(
+            role='user', content=self._round_instruction(2, focal_method_name, focal_method, test_prefix))
         self.update_history(new_messages)
         return new_messages
 
     def final_round_messages(self, focal_method_name, focal_method, test_prefix, expected_value_type: str | None,
                              actual_value: str):
-        new_messages = pickle.loads(pickle.dumps(self._history))
-        instruction = f'Based on your analysis, please accomplish the given test case by filling proper value in the `<expected_value>` part:\n```java\n{test_prefix}\n```\n'
-        instruction += "\nPlease write down the completed assertion and provide a short explaination. You should keep your answer within 200 words. "
-        new_messages.append({
-            'role': 'user',
-            'content': instruction
-        })
+        instruction = self._final_instruction('equals', test_prefix)
+        new_messages = self._history.with_message(role='user', content=instruction)
         self.update_history(new_messages)
         return new_messages
 
     def final_round_messages_with_code_features(self, focal_method_name, focal_method, test_prefix,
                                                 expected_value_type: str | None, focal_class_fields,
                                                 focal_class_methods, test_class_fields):
-        new_messages = pickle.loads(pickle.dumps(self._history))
         instruction = f'Based on the outputs, please accomplish the given test case by filling proper value in the `<expected_value>` part:\n```java\n{test_prefix}\n```\n'
         if len(focal_class_fields) != 0 or len(focal_class_methods) != 0:
             instruction += 'The method is declared in a class with the following fields and methods:\n```java\n'
@@ -1020,37 +1192,21 @@ class FourStepCoTGenerator(Generator):
             else:
                 instruction += f"Here are some possible values of according to the type of the expected value: `{self.type_to_predefined_candidates(expected_value_type)}`."
         instruction += "\nPlease write down the completed assertion and provide a short explaination. You should keep your answer within 200 words. "
-        new_messages.append({
-            'role': 'user',
-            'content': instruction
-        })
+        new_messages = self._history.with_message(role='user', content=instruction)
         self.update_history(new_messages)
         return new_messages
 
     def final_round_messages_for_assertBoolean(self, focal_method_name, focal_method, test_prefix,
                                                expected_value_type: str | None):
-        new_messages = pickle.loads(pickle.dumps(self._history))
-        instruction = f'Based on your analysis, please accomplish the given test case by writing an assertion statement in the `<AssertionPlaceHolder>` line:\n```java\n{test_prefix}\n```\n'
-        instruction += f"Please read my code and write an assertion statement in the `<AssertionPlaceHolder>` line." + \
-                       "Note that you **MUST** use either `assertTrue()` or `assertFalse()` method to verify the result." + \
-                       "Please write down the assertion and provide a short explaination. You should keep your answer within 200 words."
-        new_messages.append({
-            'role': 'user',
-            'content': instruction
-        })
+        instruction = self._final_instruction('boolean', test_prefix)
+        new_messages = self._history.with_message(role='user', content=instruction)
         self.update_history(new_messages)
         return new_messages
 
     def final_round_messages_assertNullValues(self, focal_method_name, focal_method, test_prefix,
                                               expected_value_type: str | None):
-        new_messages = pickle.loads(pickle.dumps(self._history))
-        instruction = f'Based on your analysis, please accomplish the given test case by writing an assertion statement in the `<AssertionPlaceHolder>` line:\n```java\n{test_prefix}\n```\n'
-        instruction += "Note that you **MUST** use either `assertNull()` or `assertNotNull()` method to verify the result." + \
-                       "Please write down the assertion and provide a short explanation. You should keep your answer within 200 words."
-        new_messages.append({
-            'role': 'user',
-            'content': instruction
-        })
+        instruction = self._final_instruction('null', test_prefix)
+        new_messages = self._history.with_message(role='user', content=instruction)
         self.update_history(new_messages)
         return new_messages
 
@@ -1069,24 +1225,24 @@ class FourStepCoTGenerator(Generator):
         test_prefix = kwargs['test_prefix']
         actual_value = kwargs['actual_value']
         expected_value_type = kwargs['expected_value_type'] if 'expected_value_type' in kwargs else None
-        first_round_response = self.model.get_response(
-            messages=self.first_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=first_round_response)
-        second_round_response = self.model.get_response(
-            messages=self.second_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=second_round_response)
-        third_round_response = self.model.get_response(
-            messages=self.third_round_messages(
-                focal_method_name, focal_method, test_prefix)
-        )
-        self._record_history(role='assistant', content=third_round_response)
+        self._class_features = {key: kwargs.get(key) for key in
+                                ['focal_class_fields', 'focal_class_methods', 'test_class_fields']}
+        if self.single_turn:
+            final_round_response = self._single_turn(focal_method_name, focal_method, test_prefix,
+                                                     self._final_instruction('equals', test_prefix))
+            self.final_round_messages(focal_method_name, focal_method, test_prefix, expected_value_type,
+                                      actual_value=kwargs['actual_value'])
+            self._record_history(role='assistant', content=final_round_response)
+            return final_round_response
+        self._reason(focal_method_name, focal_method, test_prefix, kwargs.get('cot_cache', None))
         # final_round_response = self.model.get_response_with_prefix(
         #     messages=self.final_round_messages(
         #         focal_method_name, focal_method, test_prefix, expected_value_type, actual_value=kwargs['actual_value']),
         #     prefix=f'I think the answer should be:\n```java\nassertEquals('
         # )
-        final_round_response = self.model.get_response(messages=self.final_round_messages(
-            focal_method_name, focal_method, test_prefix, expected_value_type, actual_value=kwargs['actual_value']))
+        with call_tags(step='final_round'):
+            final_round_response = self.model.get_response(messages=self._compact(self.final_round_messages(
+                focal_method_name, focal_method, test_prefix, expected_value_type, actual_value=kwargs['actual_value'])))
 
         self._record_history(role='assistant', content=final_round_response)
         return final_round_response
@@ -1102,25 +1258,24 @@ class FourStepCoTGenerator(Generator):
         focal_method = kwargs['focal_method']
         test_prefix = kwargs['test_prefix']
         expected_value_type = kwargs['expected_value_type'] if 'expected_value_type' in kwargs else None
-        first_round_response = self.model.get_response(
-            messages=self.first_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=first_round_response)
-        second_round_response = self.model.get_response(
-            messages=self.second_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=second_round_response)
-        third_round_response = self.model.get_response(
-            messages=self.third_round_messages(
-                focal_method_name, focal_method, test_prefix)
-        )
-        self._record_history(role='assistant', content=third_round_response)
+        self._class_features = {key: kwargs.get(key) for key in
+                                ['focal_class_fields', 'focal_class_methods', 'test_class_fields']}
+        if self.single_turn:
+            final_round_response = self._single_turn(focal_method_name, focal_method, test_prefix,
+                                                     self._final_instruction('boolean', test_prefix))
+            self.final_round_messages_for_assertBoolean(focal_method_name, focal_method, test_prefix, expected_value_type)
+            self._record_history(role='assistant', content=final_round_response)
+            return final_round_response
+        self._reason(focal_method_name, focal_method, test_prefix, kwargs.get('cot_cache', None))
         # final_round_response = self.model.get_response_with_prefix(
         #     messages=self.final_round_messages_for_assertBoolean(
         #         focal_method_name, focal_method, test_prefix, expected_value_type),
         #     prefix='I think the answer should be:\n```java\nassert'
         # )
-        final_round_response = self.model.get_response(
-            messages=self.final_round_messages_for_assertBoolean(focal_method_name, focal_method, test_prefix,
-                                                                 expected_value_type))
+        with call_tags(step='final_round'):
+            final_round_response = self.model.get_response(
+                messages=self._compact(self.final_round_messages_for_assertBoolean(
+                    focal_method_name, focal_method, test_prefix, expected_value_type)))
         self._record_history(role='assistant', content=final_round_response)
         return final_round_response
 
@@ -1135,25 +1290,24 @@ class FourStepCoTGenerator(Generator):
         focal_method = kwargs['focal_method']
         test_prefix = kwargs['test_prefix']
         expected_value_type = kwargs['expected_value_type'] if 'expected_value_type' in kwargs else None
-        first_round_response = self.model.get_response(
-            messages=self.first_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=first_round_response)
-        second_round_response = self.model.get_response(
-            messages=self.second_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=second_round_response)
-        third_round_response = self.model.get_response(
-            messages=self.third_round_messages(
-                focal_method_name, focal_method, test_prefix)
-        )
-        self._record_history(role='assistant', content=third_round_response)
+        self._class_features = {key: kwargs.get(key) for key in
+                                ['focal_class_fields', 'focal_class_methods', 'test_class_fields']}
+        if self.single_turn:
+            final_round_response = self._single_turn(focal_method_name, focal_method, test_prefix,
+                                                     self._final_instruction('null', test_prefix))
+            self.final_round_messages_assertNullValues(focal_method_name, focal_method, test_prefix, expected_value_type)
+            self._record_history(role='assistant', content=final_round_response)
+            return final_round_response
+        self._reason(focal_method_name, focal_method, test_prefix, kwargs.get('cot_cache', None))
         # final_round_response = self.model.get_response_with_prefix(
         #     messages=self.final_round_messages_assertNullValues(focal_method_name, focal_method, test_prefix,
         #                                                         expected_value_type),
         #     prefix='I think the answer should be:\n```java\nassert'
         # )
-        final_round_response = self.model.get_response(
-            messages=self.final_round_messages_assertNullValues(focal_method_name, focal_method, test_prefix,
-                                                                expected_value_type))
+        with call_tags(step='final_round'):
+            final_round_response = self.model.get_response(
+                messages=self._compact(self.final_round_messages_assertNullValues(
+                    focal_method_name, focal_method, test_prefix, expected_value_type)))
         self._record_history(role='assistant', content=final_round_response)
         return final_round_response
 
@@ -1169,22 +1323,15 @@ class FourStepCoTGenerator(Generator):
         test_prefix = kwargs['test_prefix']
         actual_value = kwargs['actual_value']
         expected_value_type = kwargs['expected_value_type'] if 'expected_value_type' in kwargs else None
-        first_round_response = self.model.get_response(
-            messages=self.first_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=first_round_response)
-        second_round_response = self.model.get_response(
-            messages=self.second_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=second_round_response)
-        third_round_response = self.model.get_response(
-            messages=self.third_round_messages(
-                focal_method_name, focal_method, test_prefix)
-        )
-        self._record_history(role='assistant', content=third_round_response)
-        responses, probs = self.model.get_multiple_responses_with_prefix(
-            messages=self.final_round_messages(
-                focal_method_name, focal_method, test_prefix, expected_value_type, actual_value=kwargs['actual_value']),
-            prefix=f'I think the assertion should be:\n```java\nassertEquals('
-        )
+        self._class_features = {key: kwargs.get(key) for key in
+                                ['focal_class_fields', 'focal_class_methods', 'test_class_fields']}
+        self._reason(focal_method_name, focal_method, test_prefix, kwargs.get('cot_cache', None))
+        with call_tags(step='final_round'):
+            responses, probs = self.model.get_multiple_responses_with_prefix(
+                messages=self._compact(self.final_round_messages(
+                    focal_method_name, focal_method, test_prefix, expected_value_type, actual_value=kwargs['actual_value'])),
+                prefix=f'I think the assertion should be:\n```java\nassertEquals('
+            )
         return responses, probs
 
     def generate_assertBoolean_multiple(self, **kwargs):
@@ -1198,22 +1345,15 @@ class FourStepCoTGenerator(Generator):
         focal_method = kwargs['focal_method']
         test_prefix = kwargs['test_prefix']
         expected_value_type = kwargs['expected_value_type'] if 'expected_value_type' in kwargs else None
-        first_round_response = self.model.get_response(
-            messages=self.first_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=first_round_response)
-        second_round_response = self.model.get_response(
-            messages=self.second_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=second_round_response)
-        third_round_response = self.model.get_response(
-            messages=self.third_round_messages(
-                focal_method_name, focal_method, test_prefix)
-        )
-        self._record_history(role='assistant', content=third_round_response)
-        responses, probs = self.model.get_multiple_responses_with_prefix(
-            messages=self.final_round_messages_for_assertBoolean(
-                focal_method_name, focal_method, test_prefix, expected_value_type),
-            prefix='I think the assertion should be:\n```java\nassert'
-        )
+        self._class_features = {key: kwargs.get(key) for key in
+                                ['focal_class_fields', 'focal_class_methods', 'test_class_fields']}
+        self._reason(focal_method_name, focal_method, test_prefix, kwargs.get('cot_cache', None))
+        with call_tags(step='final_round'):
+            responses, probs = self.model.get_multiple_responses_with_prefix(
+                messages=self._compact(self.final_round_messages_for_assertBoolean(
+                    focal_method_name, focal_method, test_prefix, expected_value_type)),
+                prefix='I think the assertion should be:\n```java\nassert'
+            )
         return responses, probs
 
     def generate_assertNullValue_multiple(self, **kwargs):
@@ -1227,21 +1367,14 @@ class FourStepCoTGenerator(Generator):
         focal_method = kwargs['focal_method']
         test_prefix = kwargs['test_prefix']
         expected_value_type = kwargs['expected_value_type'] if 'expected_value_type' in kwargs else None
-        first_round_response = self.model.get_response(
-            messages=self.first_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=first_round_response)
-        second_round_response = self.model.get_response(
-            messages=self.second_round_messages(focal_method_name, focal_method, test_prefix))
-        self._record_history(role='assistant', content=second_round_response)
-        third_round_response = self.model.get_response(
-            messages=self.third_round_messages(
-                focal_method_name, focal_method, test_prefix)
-        )
-        self._record_history(role='assistant', content=third_round_response)
-        responses, probs = self.model.get_multiple_responses_with_prefix(
-            messages=self.final_round_messages_assertNullValues(focal_method_name, focal_method, test_prefix,
-                                                                expected_value_type),
-            prefix='I think the assertion should be:\n```java\nassert'
-        )
+        self._class_features = {key: kwargs.get(key) for key in
+                                ['focal_class_fields', 'focal_class_methods', 'test_class_fields']}
+        self._reason(focal_method_name, focal_method, test_prefix, kwargs.get('cot_cache', None))
+        with call_tags(step='final_round'):
+            responses, probs = self.model.get_multiple_responses_with_prefix(
+                messages=self._compact(self.final_round_messages_assertNullValues(
+                    focal_method_name, focal_method, test_prefix, expected_value_type)),
+                prefix='I think the assertion should be:\n```java\nassert'
+            )
         return responses, probs
 
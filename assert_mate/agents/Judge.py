@@ -1,4 +1,5 @@
 import os.path
+import re
 import sys
 
 sys.path.extend(['.', '..'])
@@ -6,6 +7,18 @@ import yaml
 
 from agents.base.llm import LLM
 from dotmap import DotMap
+from loguru import logger
+from utils.agreement import extract_assertion
+from utils.tokens import estimate_tokens
+from utils.prompt_layout import SYSTEM_PROMPT, layout_messages
+from utils.llm_metrics import call_tags
+
+VERDICT_PATTERN = re.compile(r'<verdict>\s*\**\s*(YES|NO)\b', re.IGNORECASE)
+COMMENTS_PATTERN = re.compile(r'<comments>(.*?)(?:</comments>|<assertion>|$)', re.DOTALL | re.IGNORECASE)
+ASSERTION_PATTERN = re.compile(r'<assertion>(.*?)(?:</assertion>|$)', re.DOTALL | re.IGNORECASE)
+VERDICT_QUESTION = 'Please read the codes and the responses, and determine whether they have the same answer regarding the what to fill in the `<expected_value>` part in the assertion. If their answer were different, please answer **NO**. Otherwise, please answer **YES**.'
+FINAL_VERDICT_QUESTION = 'Please read the codes and their responses, and determine what to fill in the `<expected_value>` part in the assertion statement. Please directly response the **assertion statement** wrapped in code block without explanation.'
+CASE_PATTERN = re.compile(r'<case\s+id="?([^">\s]+)"?\s*>(.*?)(?=</case>|<case\s+id=|$)', re.DOTALL | re.IGNORECASE)
 
 
 class Judge():
@@ -26,7 +39,7 @@ class Judge():
         instruction += f'Here are their responses:\n'
         for member, response in responses.items():
             instruction += f'Team Member {member}: {response}\n'
-        instruction += 'Please read the codes and the responses, and determine whether they have the same answer regarding the what to fill in the `<expected_value>` part in the assertion. If their answer were different, please answer **NO**. Otherwise, please answer **YES**.'
+        instruction += VERDICT_QUESTION
         return instruction
 
     def _interpretation_instruction(self,processed_assertion:str) -> str:
@@ -35,6 +48,48 @@ class Judge():
                        f'- If your previous answer is **YES**, then fill in the `<expected_value>` part of `{processed_assertion}`. Please just return the complete **assertion statement**.\n')
         return instruction
 
+    def _layout_messages(self, focal_method: str, test_prefix: str, responses: dict, question: str) -> list:
+        # Prefix-cache layout: the Judge shares the system prompt and the instance context with the agents, and
+        # its role, the responses and the question come last.
+        content = f'You are the leader of the team. There are {len(responses)} teammates in your team, and here are their responses:\n'
+        for member, response in responses.items():
+            content += f'Team Member {member}: {response}\n'
+        return layout_messages(content + question, focal_method, test_prefix)
+
+    @staticmethod
+    def _structured_format(processed_assertion: str) -> str:
+        return ('\nAnswer in exactly the following format:\n'
+                '<verdict>YES or NO</verdict>\n'
+                '<comments>If NO, your comment regarding their answers according to your understanding. Please do not repeat their answers. If YES, leave it empty.</comments>\n'
+                f'<assertion>If YES, the complete **assertion statement** `{processed_assertion}` with the `<expected_value>` part filled in, wrapped in a code block. If NO, leave it empty.</assertion>')
+
+    def _structured_verdict_instruction(self, focal_method: str, test_prefix: str, responses: dict,
+                                        processed_assertion: str) -> str:
+        return self._verdict_instruction(focal_method, test_prefix, responses) + \
+            self._structured_format(processed_assertion)
+
+    def _case_description(self, case: dict) -> str:
+        description = f'<case id="{case["id"]}">\n'
+        description += f'The method under test is:\n```java\n{case["focal_method"]}\n```\n'
+        description += f'The test case with the `<expected_value>` part to fill:\n```java\n{case["test_prefix"]}\n```\n'
+        description += f'The assertion to complete is `{case["processed_assertion"]}`. Here are their responses:\n'
+        for member, response in case['responses'].items():
+            description += f'Team Member {member}: {response}\n'
+        return description + '</case>\n'
+
+    def _batched_verdict_instruction(self, cases: list) -> str:
+        instruction = (f'Your teammates are writing expected values in assertions for {len(cases)} test cases. '
+                       'For each case below, read the codes and the responses, and determine whether they have the same answer regarding what to fill in the `<expected_value>` part in the assertion.\n\n')
+        for case in cases:
+            instruction += self._case_description(case) + '\n'
+        instruction += ('Answer every case, in the given order, in exactly the following format:\n'
+                        '<case id="the case id">\n'
+                        '<verdict>YES or NO</verdict>\n'
+                        '<comments>If NO, your comment regarding their answers according to your understanding. Please do not repeat their answers. If YES, leave it empty.</comments>\n'
+                        '<assertion>If YES, the complete **assertion statement** of the case with the `<expected_value>` part filled in, wrapped in a code block. If NO, leave it empty.</assertion>\n'
+                        '</case>')
+        return instruction
+
     def _final_verdict_instruction(self, focal_method, test_prefix, responses: dict) -> str:
         instruction = f'There are {len(responses)} teammates in your team, and they are writing expected values in assertions.'
         instruction += f'The method they are going to test is:\n```java\n{focal_method}\n```\n'
@@ -42,10 +97,12 @@ class Judge():
         instruction += f'Here are their responses:\n'
         for member, response in responses.items():
             instruction += f'Team Member {member}: {response}\n'
-        instruction += 'Please read the codes and their responses, and determine what to fill in the `<expected_value>` part in the assertion statement. Please directly response the **assertion statement** wrapped in code block without explanation.'
+        instruction += FINAL_VERDICT_QUESTION
         return instruction
 
     def _group_final_verdict_messages(self, focal_method: str, test_prefix: str, responses: dict) -> list:
+        if self.model.prefix_cache_layout:
+            return self._layout_messages(focal_method, test_prefix, responses, FINAL_VERDICT_QUESTION)
         instruction = self._final_verdict_instruction(focal_method, test_prefix, responses)
         messages = []
         messages.append({
@@ -59,6 +116,8 @@ class Judge():
         return messages
 
     def _group_verdict_messages(self, focal_method: str, test_prefix: str, responses: dict) -> list:
+        if self.model.prefix_cache_layout:
+            return self._layout_messages(focal_method, test_prefix, responses, VERDICT_QUESTION)
         instruction = self._verdict_instruction(focal_method, test_prefix, responses)
         messages = []
         messages.append({
@@ -86,6 +145,134 @@ class Judge():
         })
         return messages
 
+    def _group_structured_verdict_messages(self, focal_method: str, test_prefix: str, responses: dict,
+                                           processed_assertion: str) -> list:
+        if self.model.prefix_cache_layout:
+            return self._layout_messages(focal_method, test_prefix, responses,
+                                         VERDICT_QUESTION + self._structured_format(processed_assertion))
+        return [{
+            'role': 'system',
+            'content': self.system_prompt
+        }, {
+            'role': 'user',
+            'content': self._structured_verdict_instruction(focal_method, test_prefix, responses, processed_assertion)
+        }]
+
+    @staticmethod
+    def parse_structured_verdict(response: str) -> dict | None:
+        """
+        Reads the verdict, comments and assertion of a structured answer. Tolerates missing closing tags and a bare
+        **YES**/**NO**; returns None if no verdict can be found at all.
+        """
+        match = VERDICT_PATTERN.search(response)
+        if match is None:
+            bare = re.findall(r'\*\*(YES|NO)\*\*', response)
+            if len(set(bare)) != 1:
+                return None
+            verdict = bare[0]
+        else:
+            verdict = match.group(1).upper()
+        comments = COMMENTS_PATTERN.search(response)
+        assertion = ASSERTION_PATTERN.search(response)
+        assertion_text = assertion.group(1).strip() if assertion is not None else ''
+        if '```' not in assertion_text:
+            # A bare statement is wrapped so that `extract_assertion_from_response` can read it.
+            assertion_text = f'```java\n{assertion_text}\n```' if assertion_text else ''
+        if verdict == 'YES' and extract_assertion(assertion_text) == '':
+            # Without tags, the first code block of the whole answer carries the assertion.
+            assertion_text = response if extract_assertion(response) != '' else assertion_text
+        return {
+            'verdict': f'**{verdict}**',
+            'comments': comments.group(1).strip() if comments is not None else '',
+            'assertion': assertion_text,
+        }
+
+    def structured_decision(self, focal_method, test_prefix, responses, processed_assertion) -> dict:
+        """
+        Verdict, comments and completed assertion in one call. Falls back to `make_decision` and
+        `explain_decision` if the answer has no readable verdict.
+        """
+        messages = self._group_structured_verdict_messages(focal_method, test_prefix, responses, processed_assertion)
+        self._history = messages
+        response = self.model.get_response(messages=messages)
+        decision = self.parse_structured_verdict(response)
+        if decision is not None:
+            decision['raw'] = response
+            return decision
+        logger.warning('Structured Judge verdict could not be parsed, asking in two steps instead.')
+        verdict = self.make_decision(focal_method, test_prefix, responses)
+        explain = self.explain_decision(focal_method, test_prefix, responses, verdict, processed_assertion)
+        return {
+            'verdict': verdict,
+            'comments': explain if '**YES**' not in verdict else '',
+            'assertion': explain if '**YES**' in verdict else '',
+            'raw': response,
+        }
+
+    def _group_batched_verdict_messages(self, cases: list) -> list:
+        return [{
+            'role': 'system',
+            'content': SYSTEM_PROMPT if self.model.prefix_cache_layout else self.system_prompt
+        }, {
+            'role': 'user',
+            'content': self._batched_verdict_instruction(cases)
+        }]
+
+    def pack_cases(self, cases: list, token_budget: int, max_batch_size: int, output_tokens_per_case: int) -> list:
+        """
+        Greedily packs cases into batches whose estimated prompt plus answer tokens stay within `token_budget`.
+        A case larger than the budget gets a batch of its own.
+        """
+        overhead = estimate_tokens(self.system_prompt) + estimate_tokens(self._batched_verdict_instruction([]))
+        batches, batch, used = [], [], overhead
+        for case in cases:
+            cost = estimate_tokens(self._case_description(case)) + output_tokens_per_case
+            if len(batch) != 0 and (used + cost > token_budget or len(batch) >= max_batch_size):
+                batches.append(batch)
+                batch, used = [], overhead
+            batch.append(case)
+            used += cost
+        if len(batch) != 0:
+            batches.append(batch)
+        return batches
+
+    def _batched_decision(self, cases: list) -> dict:
+        if len(cases) == 1:
+            case = cases[0]
+            with call_tags(instance_id=case['id']):
+                return {case['id']: self.structured_decision(case['focal_method'], case['test_prefix'],
+                                                             case['responses'], case['processed_assertion'])}
+        # The metrics (and the budget's cost per instance) spread the call over its cases.
+        with call_tags(cases=len(cases)):
+            response = self.model.get_response(messages=self._group_batched_verdict_messages(cases))
+        decisions = {}
+        for case_id, body in CASE_PATTERN.findall(response):
+            decision = self.parse_structured_verdict(body)
+            if decision is not None:
+                decision['raw'] = body.strip()
+                decisions[case_id] = decision
+        missing = [case for case in cases if str(case['id']) not in decisions]
+        decisions = {case['id']: decisions[str(case['id'])] for case in cases if str(case['id']) in decisions}
+        if len(missing) != 0:
+            # Cases the answer skipped or garbled are asked again in two halves, down to single cases.
+            logger.warning(f'Batched Judge verdict missed {len(missing)} of {len(cases)} cases, retrying them.')
+            half = (len(missing) + 1) // 2
+            for part in [missing[:half], missing[half:]]:
+                if len(part) != 0:
+                    decisions.update(self._batched_decision(part))
+        return decisions
+
+    def batched_decisions(self, cases: list, token_budget: int = 12000, max_batch_size: int = 8,
+                          output_tokens_per_case: int = 200) -> dict:
+        """
+        Structured verdicts (see `structured_decision`) for many cases, several per request. Every case is a dict
+        with `id`, `focal_method`, `test_prefix`, `processed_assertion` and `responses`. Returns decisions by id.
+        """
+        decisions = {}
+        for batch in self.pack_cases(cases, token_budget, max_batch_size, output_tokens_per_case):
+            decisions.update(self._batched_decision(batch))
+        return decisions
+
     def make_decision(self, focal_method, test_prefix, responses):
         messages = self._group_verdict_messages(focal_method, test_prefix, responses)
         response = self.model.get_response(messages=messages)
@@ -1,12 +1,17 @@
-import pickle
+import asyncio
+import functools
+import contextvars
 from abc import ABC, abstractmethod
 
 from loguru import logger
 
+from utils.message_history import MessageHistory
+from utils.prompt_layout import layout_messages
+
 
 class Generator(ABC):
     def __init__(self, model, debate_sys_prompt):
-        self._history = []
+        self._history = MessageHistory()
         self.model = model
         self.character_to_id = {
             'CoTGenerator': 1,
@@ -25,16 +30,50 @@ class Generator(ABC):
             'boolean': 'true, false'
         }
         self.debate_system_prompt = debate_sys_prompt
+        self.response_truncated = False
 
     def _record_history(self, role, content):
-        self._history.append({'role': role, 'content': content})
+        self._history = self._history.with_message(role=role, content=content)
+
+    def _respond_with_assertion(self, messages) -> str:
+        # Single-answer prompts only need the first code block, so stream and stop once it is complete.
+        if self.model.stream_early_stop:
+            response, self.response_truncated = self.model.get_response_stream(messages=messages)
+        else:
+            response, self.response_truncated = self.model.get_response(messages=messages), False
+        return response
+
+    def _class_context(self, focal_method, test_prefix, focal_class_fields=None, focal_class_methods=None,
+                       test_class_fields=None, **kwargs) -> dict:
+        """
+        The class fields and methods of the generator arguments, cut to this agent's token budget if the model has
+        a context builder (see `utils.context_builder`).
+        """
+        context = {'focal_class_fields': focal_class_fields or [], 'focal_class_methods': focal_class_methods or [],
+                   'test_class_fields': test_class_fields or []}
+        if self.model.context_builder is None:
+            return context
+        return self.model.context_builder.fit(self.__class__.__name__, focal_method, test_prefix, **context)
+
+    def _layout_messages(self, question, focal_method, test_prefix, **kwargs) -> list:
+        # Takes the generator arguments as they are, so that every agent of an instance sends the same class context.
+        return layout_messages(question, focal_method, test_prefix,
+                               **self._class_context(focal_method, test_prefix, **kwargs))
+
+    def _compact(self, messages):
+        # Long conversations are compacted only in the request (see `utils.history_compaction`); the history
+        # keeps every turn as it was.
+        if self.model.history_compactor is None:
+            return messages
+        return self.model.history_compactor.compact(messages)
 
     @property
     def history(self):
         return self._history
 
     def update_history(self, history):
-        self._history = pickle.loads(pickle.dumps(history))
+        # Histories are immutable, so the caller's messages are shared rather than copied.
+        self._history = MessageHistory(history)
 
     @abstractmethod
     def generate_assertEquals(self, **kwargs):
@@ -48,8 +87,26 @@ class Generator(ABC):
     def generate_assertNullValue(self, **kwargs):
         pass
 
+    async def _run_in_executor(self, generate_fn, **kwargs):
+        # Blocking generator code runs in the model's worker pool (if it has one), so that an `AsyncDeepSeek`
+        # keeps all network I/O on its own event loop while callers simply await the generator.
+        # `run_in_executor` does not carry context variables over, so the caller's metrics tags are copied along.
+        loop = asyncio.get_running_loop()
+        executor = getattr(self.model, 'executor', None)
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(executor, functools.partial(context.run, generate_fn, **kwargs))
+
+    async def agenerate_assertEquals(self, **kwargs):
+        return await self._run_in_executor(self.generate_assertEquals, **kwargs)
+
+    async def agenerate_assertBoolean(self, **kwargs):
+        return await self._run_in_executor(self.generate_assertBoolean, **kwargs)
+
+    async def agenerate_assertNullValue(self, **kwargs):
+        return await self._run_in_executor(self.generate_assertNullValue, **kwargs)
+
     def clear_history(self):
-        self._history.clear()
+        self._history = MessageHistory()
 
     @abstractmethod
     def refine(self, **kwagrs):
@@ -82,22 +139,18 @@ class Generator(ABC):
             refine_instruction += f"Here are some local variables defined in the test case, you may need them:\n```java\n{var_hints}\n```\n"
             refine_instruction += 'Please write down your refined answer.'
 
-        messages.append({
-            'role': 'user',
-            'content': refine_instruction
-        })
-        response = self.model.get_response_with_prefix(messages=messages, prefix='```java\nassertEquals(')
-        self._history = pickle.loads(pickle.dumps(messages))
+        messages = messages.with_message(role='user', content=refine_instruction)
+        response = self.model.get_response_with_prefix(messages=self._compact(messages), prefix='```java\nassertEquals(')
+        self._history = messages
         self._record_history('assistant', response)
         return response
 
     def clarify_answer(self) -> str:
-        new_messages = self.history + [{
-            'role': 'user',
-            'content': 'OK, I understand your thoughts, now I need a short answer of what does the assertion finally look like. Please write down your answer.'
-        }]
-        self._history = pickle.loads(pickle.dumps(new_messages))
-        return self.model.get_response_with_prefix(new_messages)
+        new_messages = self.history.with_message(
+            role='user',
+            content='OK, I understand your thoughts, now I need a short answer of what does the assertion finally look like. Please write down your answer.')
+        self._history = new_messages
+        return self.model.get_response_with_prefix(self._compact(new_messages))
 
     def type_to_predefined_candidates(self, expected_value_type):
         return self._candidate_dict.get(expected_value_type, None)
@@ -143,8 +196,8 @@ class Generator(ABC):
             focal_method=focal_method, test_prefix=test_prefix,
             statements=statements)
         response = self.model.get_response_with_prefix(
-            messages=messages,
+            messages=self._compact(messages),
             prefix=prefix)
-        self._history = messages
+        self.update_history(messages)
         self._record_history(role='assistant', content=response)
         return response
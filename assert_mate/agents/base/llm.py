@@ -1,16 +1,94 @@
 import sys
+import os
+import time
+import asyncio
+import threading
+import functools
 import openai
 import numpy as np
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 from abc import abstractmethod, ABC
 import requests
-import pickle
 sys.path.extend(['.', '..'])
 
-from utils.postprocessing import extract_assertion_from_response
+from utils.postprocessing import extract_assertion_from_response, first_code_block_end
+from utils.llm_cache import LLMCacheMiss, load_llm_cache
+from utils.http_clients import configure_http_pool, get_openai_client
+from utils.rate_limiter import load_rate_limiter, backoff_delay, retry_after_seconds
+from utils.tokens import estimate_messages_tokens, estimate_tokens
+from utils.hedging import load_hedging_policy
+from utils.endpoint_pool import load_endpoint_pool
+from utils.confidence import score_logprobs, score_choices
+from utils.adaptive_sampling import load_adaptive_sampler
+from utils.context_builder import load_context_builder
+from utils.history_compaction import load_history_compactor
+from utils.budget import load_budget_scheduler
+from utils.llm_metrics import load_metrics_recorder, track_call, note_usage, note_retry, note_first_token, \
+    active_call, current_tags
+
+code_base = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+
 
 class LLM(ABC):
+    _cache = None
+    metrics = None
+    stream_early_stop = False
+    prefix_cache_layout = False
+    context_builder = None
+    history_compactor = None
+    budget = None
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def attach_cache(self, cache):
+        self._cache = cache
+
+    def _cache_request(self, kind, messages, prefix=None, n=1, **extra) -> dict:
+        request = dict(kind=kind, model=getattr(self, 'model', None), messages=messages, prefix=prefix,
+                       temperature=getattr(self, 'temperature', None), stop=getattr(self, 'eos', None), n=n)
+        request.update(extra)
+        return request
+
+    def _lookup(self, request: dict):
+        key = self._cache.make_key(**request)
+        found, value = self._cache.get(key)
+        if not found and self._cache.read_only:
+            raise LLMCacheMiss(f'No cached response for request {key} in read-only mode.')
+        return key, found, value
+
+    def _cached(self, request: dict, compute, *args):
+        with track_call(self.metrics, request['kind'], request['model']) as call:
+            if self._cache is None:
+                return compute(*args)
+            key, found, value = self._lookup(request)
+            if found:
+                call['cache_hit'] = True
+                return tuple(value) if isinstance(value, list) else value
+            value = compute(*args)
+            self._store(key, value)
+            return value
+
+    async def _acached(self, request: dict, compute, *args):
+        with track_call(self.metrics, request['kind'], request['model']) as call:
+            if self._cache is None:
+                return await compute(*args)
+            key, found, value = self._lookup(request)
+            if found:
+                call['cache_hit'] = True
+                return tuple(value) if isinstance(value, list) else value
+            value = await compute(*args)
+            self._store(key, value)
+            return value
+
+    def _store(self, key, value):
+        # Failed requests come back as '' or ([], []) and must not be replayed.
+        if (isinstance(value, tuple) and len(value[0]) == 0) or not value:
+            return
+        self._cache.put(key, value)
+
     @abstractmethod
     def get_response(self, messages) -> str:
         pass
@@ -27,30 +105,191 @@ class LLM(ABC):
     def get_multiple_responses_with_prefix(self, messages, prefix):
         pass
 
+    def get_response_stream(self, messages, early_stop=True):
+        """
+        Returns `(response, truncated)`. Backends without streaming return the full response.
+        """
+        return self.get_response(messages), False
+
 
 class DeepSeek(LLM):
+    # Transient failures worth retrying; APITimeoutError is a subclass of APIConnectionError.
+    retryable_errors = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+    # Failures caused by the request itself, retrying them would fail the same way.
+    request_errors = (openai.BadRequestError, openai.UnprocessableEntityError)
+
     def __init__(self, config):
         super().__init__()
         try:
             self.api_key = config.deepseek.key
             self.base_url = config.deepseek.api
-            openai.api_key = config.deepseek.key
-            openai.base_url = config.deepseek.api
             self.temperature = config.deepseek.temperature
             self.top_p = config.deepseek.top_p
             self.max_tokens = config.deepseek.max_tokens
             self.model = config.deepseek.model
-            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
             self.eos = config.deepseek.eos
             self.assistant_response_header = config.deepseek.response_header
         except Exception:
             logger.error(
                 "Error loading configuration: llm.key or llm.api, please check the configuration file.")
             exit(-1)
+        self.max_retries = config.deepseek.get('max_retries', 6)
+        self.backoff_base = config.deepseek.get('backoff_base', 1.0)
+        self.backoff_cap = config.deepseek.get('backoff_cap', 60.0)
+        self.expected_completion_tokens = config.deepseek.get('expected_completion_tokens', 512)
+        self.stream_early_stop = config.deepseek.get('stream_early_stop', False)
+        self.prefix_cache_layout = config.deepseek.get('prefix_cache_layout', False)
+        configure_http_pool(config.get('http_pool', {}))
+        self.attach_cache(load_llm_cache(code_base, config))
+        self.rate_limiter = load_rate_limiter(code_base, config)
+        self.metrics = load_metrics_recorder(code_base, config)
+        self.budget = load_budget_scheduler(config, self.metrics)
+        self.hedging = load_hedging_policy(config)
+        self.endpoints = load_endpoint_pool(config.deepseek)
+        self.sampler = load_adaptive_sampler(config.deepseek)
+        self.context_builder = load_context_builder(config)
+        self.history_compactor = load_history_compactor(config)
+
+    @property
+    def client(self):
+        return get_openai_client(self.api_key, self.base_url)
+
+    def _create(self, endpoint, api):
+        if api == 'fim':
+            return get_openai_client(endpoint.api_key, endpoint.base_url + '/beta').completions.create
+        client = get_openai_client(endpoint.api_key, endpoint.base_url)
+        return client.chat.completions.create if api == 'chat' else client.completions.create
+
+    @staticmethod
+    def _endpoint_kwargs(endpoint, kwargs) -> dict:
+        if endpoint.model:
+            return {**kwargs, 'model': endpoint.model}
+        return kwargs
 
     def get_response(self, messages):
+        return self._cached(self._cache_request('chat', messages, max_tokens=self.max_tokens),
+                            self._get_response, messages)
+
+    def get_response_stream(self, messages, early_stop=True):
+        """
+        Streams the completion and, with `early_stop`, cancels it as soon as the first code block is closed or
+        starts with a complete assertion statement. Returns `(response, truncated)`.
+        """
+        return self._cached(self._cache_request('stream', messages, max_tokens=self.max_tokens, early_stop=early_stop),
+                            self._get_response_stream, messages, early_stop)
+
+    def get_response_with_prefix(self, messages, prefix='```java\nassertEquals('):
+        return self._cached(self._cache_request('prefix', messages, prefix=prefix, max_tokens=4096),
+                            self._get_response_with_prefix, messages, prefix)
+
+    def fim_response(self, prompt, suffix, max_tokens=4096):
+        return self._cached(self._cache_request('fim', prompt, prefix=suffix, max_tokens=max_tokens),
+                            self._fim_response, prompt, suffix, max_tokens)
+
+    def _allow_more_samples(self) -> bool:
+        # Samples beyond the first batch are optional; they are charged to the round of the calling agent.
+        if self.budget is None:
+            return True
+        tags = current_tags()
+        return self.budget.allow([(tags.get('agent'), tags.get('round'))])
+
+    def get_multiple_responses_with_prefix(self, messages, prefix='```java\nassertEquals(', best_of=10):
+        """
+        Samples `best_of` responses with their confidences. With adaptive sampling, samples are drawn in batches
+        until the answers agree, so fewer than `best_of` may come back.
+        """
+        if self.sampler is not None:
+            return self.sampler.sample(functools.partial(self._sample_batch, messages, prefix), best_of,
+                                       allow_more=self._allow_more_samples)
+        return self._cached(
+            self._cache_request('multiple', messages, prefix=prefix, n=best_of, temperature=1.0, max_tokens=1024),
+            self._get_multiple_responses_with_prefix, messages, prefix, best_of)
+
+    def _sample_batch(self, messages, prefix, n, batch):
+        # Batches are cached one by one, so a replayed run stops at the same batch.
+        return self._cached(
+            self._cache_request('multiple', messages, prefix=prefix, n=n, temperature=1.0, max_tokens=1024,
+                                batch=batch),
+            self._get_multiple_responses_with_prefix, messages, prefix, n)
+
+    def _reserved_tokens(self, messages):
+        return estimate_messages_tokens(messages) + self.expected_completion_tokens
+
+    def _retry_delay(self, error, attempt) -> float:
+        retry_after = retry_after_seconds(error)
+        if attempt >= self.max_retries:
+            logger.error(f'Request failed after {attempt + 1} attempts: {str(error)}')
+            raise error
+        delay = retry_after if retry_after else backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+        note_retry()
+        logger.warning(f'{type(error).__name__} on attempt {attempt + 1}, retrying in {delay:.1f}s.')
+        return delay
+
+    def _lease_outcome(self, reserved_tokens, error=None, response=None) -> dict:
+        """
+        The arguments of `rate_limiter.release` for a lease whose request failed with a retryable `error`, or
+        brought `response`.
+        """
+        if error is not None:
+            return dict(success=False, rate_limited=isinstance(error, openai.RateLimitError),
+                        retry_after=retry_after_seconds(error), reserved_tokens=reserved_tokens, used_tokens=0)
+        usage = getattr(response, 'usage', None)
+        note_usage(usage)
+        return dict(success=True, reserved_tokens=reserved_tokens, used_tokens=usage.total_tokens if usage else None)
+
+    def _failover(self, endpoint, failed, error) -> bool:
+        """
+        Records a transient failure of `endpoint` and tells whether another endpoint can take the retry at once.
+        Once every healthy endpoint has failed the request, the retry waits for the backoff (or `Retry-After`).
+        """
+        # A 429 means the endpoint is busy, not broken; the rate limiter slows down for it.
+        self.endpoints.release(endpoint, success=isinstance(error, openai.RateLimitError))
+        failed.append(endpoint)
+        return self.endpoints.has_alternative(endpoint, failed)
+
+    def _request(self, api, reserved_tokens, **kwargs):
+        """
+        Sends one `api` ('chat', 'completions' or 'fim') request through the shared rate limiter and the endpoint
+        pool, retrying transient failures on another endpoint, or on the same one after an exponential backoff
+        (or the server's `Retry-After`). Raises the last error once `max_retries` is exhausted.
+
+        Synchronous requests are not hedged, a blocking call cannot cancel its losing copy (see `AsyncDeepSeek`).
+        """
+        return self._request_with_retries(api, reserved_tokens, **kwargs)
+
+    def _request_with_retries(self, api, reserved_tokens, **kwargs):
+        attempt = 0
+        failed = []
+        while True:
+            lease = self.rate_limiter.acquire(reserved_tokens) if self.rate_limiter else None
+            endpoint = self.endpoints.acquire(exclude=failed)
+            try:
+                response = self._create(endpoint, api)(**self._endpoint_kwargs(endpoint, kwargs))
+            except self.retryable_errors as e:
+                switch = self._failover(endpoint, failed, e)
+                if lease is not None:
+                    self.rate_limiter.release(lease, **self._lease_outcome(reserved_tokens, error=e))
+                delay = self._retry_delay(e, attempt)
+                if not switch:
+                    time.sleep(delay)
+                attempt += 1
+                continue
+            except openai.APIError as e:
+                self.endpoints.release(endpoint, success=isinstance(e, self.request_errors))
+                if lease is not None:
+                    self.rate_limiter.release(lease, success=False, reserved_tokens=reserved_tokens, used_tokens=0)
+                raise
+            self.endpoints.release(endpoint)
+            outcome = self._lease_outcome(reserved_tokens, response=response)
+            if lease is not None:
+                self.rate_limiter.release(lease, **outcome)
+            return response
+
+    def _get_response(self, messages):
         try:
-            response = self.client.chat.completions.create(
+            response = self._request(
+                'chat',
+                self._reserved_tokens(messages),
                 model=self.model,
                 messages=messages,
                 # stream=False,
@@ -59,38 +298,83 @@ class DeepSeek(LLM):
                 max_tokens=self.max_tokens,
                 stop=self.eos
             )
-        except openai.APIError as apierror:
-            try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    # stream=False,
-                    temperature=self.temperature,
-                    # top_p=self.top_p,
-                    max_tokens=self.max_tokens,
-                    stop=self.eos
-                )
-            except openai.APIError:
-                return ''
+        except self.request_errors as e:
+            logger.error(f'Http request failed, Error: {str(e)}')
+            return ''
         return response.choices[0].message.content
 
-    def get_response_with_prefix(self, messages, prefix='```java\nassertEquals('):
-        new_message = pickle.loads(pickle.dumps(messages))
+    @staticmethod
+    def _consume_delta(chunks, chunk, early_stop) -> bool:
+        # With `include_usage` the usage arrives in a final chunk without choices.
+        note_usage(getattr(chunk, 'usage', None))
+        if len(chunk.choices) == 0 or not chunk.choices[0].delta.content:
+            return False
+        delta = chunk.choices[0].delta.content
+        note_first_token()
+        chunks.append(delta)
+        # Only a fence or a semicolon can complete the first code block.
+        return early_stop and ('`' in delta or ';' in delta) and first_code_block_end(''.join(chunks)) != -1
+
+    @staticmethod
+    def _finish_stream(messages, chunks, truncated):
+        text = ''.join(chunks)
+        call = active_call()
+        if call is not None and call['completion_tokens'] == 0:
+            # A stream cancelled early never receives its usage chunk.
+            call['prompt_tokens'] = estimate_messages_tokens(messages)
+            call['completion_tokens'] = estimate_tokens(text)
+            call['usage_estimated'] = True
+        if truncated:
+            text = text[:first_code_block_end(text)]
+            if not text.endswith('```'):
+                text += '\n```'
+        return text, truncated
+
+    def _get_response_stream(self, messages, early_stop):
+        try:
+            stream = self._request(
+                'chat',
+                self._reserved_tokens(messages),
+                model=self.model,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                stop=self.eos,
+                stream=True,
+                stream_options={'include_usage': True}
+            )
+        except self.request_errors as e:
+            logger.error(f'Http request failed, Error: {str(e)}')
+            return '', False
+        chunks = []
+        truncated = False
+        try:
+            for chunk in stream:
+                if self._consume_delta(chunks, chunk, early_stop):
+                    truncated = True
+                    break
+        finally:
+            # Closing the response cancels the generation on the server side.
+            stream.close()
+        return self._finish_stream(messages, chunks, truncated)
+
+    def _get_response_with_prefix(self, messages, prefix):
         # fim_url = self.base_url + '/beta'
         fim_url = self.base_url
         # extend_client = OpenAI(api_key=self.api_key, base_url=fim_url)
+        # Rendering the template only reads the messages, so they are not copied.
         prompt = self.tokenizer.apply_chat_template(
-            new_message, tokenize=False)
+            list(messages), tokenize=False)
         prompt += self.assistant_response_header + prefix
-        completion = openai.completions.create(
+        completion = self._request(
+            'completions', self._reserved_tokens(prompt),
             model=self.model, prompt=prompt, max_tokens=4096, stop=self.eos)
         return prefix + completion.choices[0].text
         # return self.get_response_with_confidence(messages, prefix)
 
-    def fim_response(self, prompt, suffix, max_tokens=4096):
-        fim_url = self.base_url + '/beta'
-        fim_client = OpenAI(api_key=self.api_key, base_url=fim_url)
-        response = fim_client.completions.create(
+    def _fim_response(self, prompt, suffix, max_tokens):
+        response = self._request(
+            'fim', self._reserved_tokens(prompt + suffix),
             model="deepseek-chat",
             prompt=prompt,
             suffix=suffix,
@@ -98,14 +382,14 @@ class DeepSeek(LLM):
         )
         return response.choices[0].text
 
-    def get_multiple_responses_with_prefix(self, messages, prefix='```java\nassertEquals(', best_of=10):
+    def _get_multiple_responses_with_prefix(self, messages, prefix, best_of):
         try:
-            new_message = pickle.loads(pickle.dumps(messages))
             fim_url = self.base_url
             prompt = self.tokenizer.apply_chat_template(
-                new_message, tokenize=False)
+                list(messages), tokenize=False)
             prompt += self.assistant_response_header + prefix
-            completion = openai.completions.create(
+            completion = self._request(
+                'completions', self._reserved_tokens(prompt) * best_of,
                 model=self.model, prompt=prompt, max_tokens=1024,
                 temperature=1.0,
                 stop=self.eos,
@@ -113,8 +397,7 @@ class DeepSeek(LLM):
                 n=best_of,
             )
             choices = [completion.choices[i].text for i in range(best_of)]
-            probs = [self.analyze_prob(
-                choice.logprobs.tokens, choice.logprobs.token_logprobs) for choice in completion.choices]
+            probs = score_choices(completion.choices)['confidence'].tolist()
             responses = [prefix + choice for choice in choices]
             return responses, probs
         except openai.BadRequestError as e:
@@ -122,13 +405,232 @@ class DeepSeek(LLM):
             return [],[]
 
     def analyze_prob(self, tokens, token_logprobs):
-        probs = []
-        for token, prob in zip(tokens, token_logprobs):
-            if token == '```':
-                break
-            probs.append(prob)
-            pass
-        final_prob = np.average(np.asarray(probs))
-        final_prob = np.round(np.exp(final_prob)*100, 2)
-        return final_prob
+        return score_logprobs([tokens], [token_logprobs])['confidence'][0]
+
+
+
+class AsyncDeepSeek(DeepSeek):
+    """
+    DeepSeek client built on `AsyncOpenAI`.
+
+    All requests run on one background event loop per process, and at most `deepseek.max_in_flight` requests
+    are open at the same time. Coroutines (`aget_*`) can be awaited from any event loop, and the synchronous
+    `LLM` methods block the calling thread only, so generators driven from many threads share the same loop.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.max_in_flight = config.deepseek.get('max_in_flight', 32)
+        self._loop = None
+        self._loop_pid = None
+        self._loop_lock = threading.Lock()
+        self._loop_thread = None
+        self._semaphore = None
+        self._executor = None
+
+    def _ensure_loop(self):
+        # Event loops, threads and HTTP connections do not survive fork, so each worker process starts its own.
+        with self._loop_lock:
+            if self._loop_pid == os.getpid():
+                return self._loop
+            self._loop = asyncio.new_event_loop()
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+            self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+            self._loop_thread.start()
+            self._loop_pid = os.getpid()
+            return self._loop
+
+    @property
+    def executor(self):
+        self._ensure_loop()
+        return self._executor
+
+    async def _guarded(self, coro_fn, *args, **kwargs):
+        async with self._semaphore:
+            return await coro_fn(*args, **kwargs)
+
+    async def _submit(self, coro_fn, *args, **kwargs):
+        loop = self._ensure_loop()
+        if asyncio.get_running_loop() is loop:
+            return await self._guarded(coro_fn, *args, **kwargs)
+        future = asyncio.run_coroutine_threadsafe(self._guarded(coro_fn, *args, **kwargs), loop)
+        return await asyncio.wrap_future(future)
+
+    def _run(self, coro_fn, *args, **kwargs):
+        loop = self._ensure_loop()
+        if threading.current_thread() is self._loop_thread:
+            raise RuntimeError('Synchronous LLM calls cannot be made from the client event loop, await them instead.')
+        future = asyncio.run_coroutine_threadsafe(self._guarded(coro_fn, *args, **kwargs), loop)
+        return future.result()
+
+    def _create(self, endpoint, api):
+        base_url = endpoint.base_url + '/beta' if api == 'fim' else endpoint.base_url
+        client = get_openai_client(endpoint.api_key, base_url, async_client=True, loop=self._loop)
+        return client.chat.completions.create if api == 'chat' else client.completions.create
+
+    async def _arequest(self, api, reserved_tokens, **kwargs):
+        if self.hedging is None or kwargs.get('stream', False):
+            return await self._arequest_with_retries(api, reserved_tokens, **kwargs)
+        return await self.hedging.arun(
+            functools.partial(self._arequest_with_retries, api, reserved_tokens, **kwargs))
+
+    async def _arequest_with_retries(self, api, reserved_tokens, **kwargs):
+        attempt = 0
+        failed = []
+        while True:
+            lease = await self.rate_limiter.aacquire(reserved_tokens) if self.rate_limiter else None
+            endpoint = await self.endpoints.aacquire(exclude=failed)
+            try:
+                response = await self._create(endpoint, api)(**self._endpoint_kwargs(endpoint, kwargs))
+            except self.retryable_errors as e:
+                switch = self._failover(endpoint, failed, e)
+                if lease is not None:
+                    await self.rate_limiter.arelease(lease, **self._lease_outcome(reserved_tokens, error=e))
+                delay = self._retry_delay(e, attempt)
+                if not switch:
+                    await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except (openai.APIError, asyncio.CancelledError) as e:
+                # A hedged request that lost the race is cancelled and must give its slot back.
+                self.endpoints.release(endpoint, success=not isinstance(e, openai.APIError) or
+                                       isinstance(e, self.request_errors))
+                if lease is not None:
+                    await self.rate_limiter.arelease(lease, success=False, reserved_tokens=reserved_tokens,
+                                                     used_tokens=0)
+                raise
+            self.endpoints.release(endpoint)
+            outcome = self._lease_outcome(reserved_tokens, response=response)
+            if lease is not None:
+                await self.rate_limiter.arelease(lease, **outcome)
+            return response
+
+    async def _chat(self, messages):
+        try:
+            response = await self._arequest(
+                'chat',
+                self._reserved_tokens(messages),
+                model=self.model,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                stop=self.eos
+            )
+        except self.request_errors as e:
+            logger.error(f'Http request failed, Error: {str(e)}')
+            return ''
+        return response.choices[0].message.content
+
+    async def _chat_stream(self, messages, early_stop):
+        try:
+            stream = await self._arequest(
+                'chat',
+                self._reserved_tokens(messages),
+                model=self.model,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                stop=self.eos,
+                stream=True,
+                stream_options={'include_usage': True}
+            )
+        except self.request_errors as e:
+            logger.error(f'Http request failed, Error: {str(e)}')
+            return '', False
+        chunks = []
+        truncated = False
+        try:
+            async for chunk in stream:
+                if self._consume_delta(chunks, chunk, early_stop):
+                    truncated = True
+                    break
+        finally:
+            await stream.close()
+        return self._finish_stream(messages, chunks, truncated)
+
+    async def _completion_with_prefix(self, messages, prefix):
+        prompt = self.tokenizer.apply_chat_template(
+            messages, tokenize=False)
+        prompt += self.assistant_response_header + prefix
+        completion = await self._arequest(
+            'completions', self._reserved_tokens(prompt),
+            model=self.model, prompt=prompt, max_tokens=4096, stop=self.eos)
+        return prefix + completion.choices[0].text
+
+    async def _fim(self, prompt, suffix, max_tokens):
+        response = await self._arequest(
+            'fim', self._reserved_tokens(prompt + suffix),
+            model="deepseek-chat",
+            prompt=prompt,
+            suffix=suffix,
+            max_tokens=max_tokens
+        )
+        return response.choices[0].text
+
+    async def _multiple_with_prefix(self, messages, prefix, best_of):
+        try:
+            prompt = self.tokenizer.apply_chat_template(
+                messages, tokenize=False)
+            prompt += self.assistant_response_header + prefix
+            completion = await self._arequest(
+                'completions', self._reserved_tokens(prompt) * best_of,
+                model=self.model, prompt=prompt, max_tokens=1024,
+                temperature=1.0,
+                stop=self.eos,
+                logprobs=1,
+                n=best_of,
+            )
+            choices = [completion.choices[i].text for i in range(best_of)]
+            probs = score_choices(completion.choices)['confidence'].tolist()
+            responses = [prefix + choice for choice in choices]
+            return responses, probs
+        except openai.BadRequestError as e:
+            logger.error(f'Http request failed, Error: {str(e)}')
+            return [], []
+
+    async def aget_response(self, messages) -> str:
+        return await self._acached(self._cache_request('chat', messages, max_tokens=self.max_tokens),
+                                   self._submit, self._chat, messages)
+
+    async def aget_response_stream(self, messages, early_stop=True):
+        return await self._acached(
+            self._cache_request('stream', messages, max_tokens=self.max_tokens, early_stop=early_stop),
+            self._submit, self._chat_stream, messages, early_stop)
+
+    async def aget_response_with_prefix(self, messages, prefix='```java\nassertEquals(') -> str:
+        return await self._acached(self._cache_request('prefix', messages, prefix=prefix, max_tokens=4096),
+                                   self._submit, self._completion_with_prefix, messages, prefix)
+
+    async def afim_response(self, prompt, suffix, max_tokens=4096) -> str:
+        return await self._acached(self._cache_request('fim', prompt, prefix=suffix, max_tokens=max_tokens),
+                                   self._submit, self._fim, prompt, suffix, max_tokens)
+
+    async def aget_multiple_responses_with_prefix(self, messages, prefix='```java\nassertEquals(', best_of=10):
+        if self.sampler is not None:
+            return await self.sampler.asample(functools.partial(self._asample_batch, messages, prefix), best_of,
+                                              allow_more=self._allow_more_samples)
+        return await self._acached(
+            self._cache_request('multiple', messages, prefix=prefix, n=best_of, temperature=1.0, max_tokens=1024),
+            self._submit, self._multiple_with_prefix, messages, prefix, best_of)
+
+    async def _asample_batch(self, messages, prefix, n, batch):
+        return await self._acached(
+            self._cache_request('multiple', messages, prefix=prefix, n=n, temperature=1.0, max_tokens=1024,
+                                batch=batch),
+            self._submit, self._multiple_with_prefix, messages, prefix, n)
+
+    def _get_response(self, messages):
+        return self._run(self._chat, messages)
+
+    def _get_response_stream(self, messages, early_stop):
+        return self._run(self._chat_stream, messages, early_stop)
+
+    def _get_response_with_prefix(self, messages, prefix):
+        return self._run(self._completion_with_prefix, messages, prefix)
+
+    def _fim_response(self, prompt, suffix, max_tokens):
+        return self._run(self._fim, prompt, suffix, max_tokens)
 
+    def _get_multiple_responses_with_prefix(self, messages, prefix, best_of):
+        return self._run(self._multiple_with_prefix, messages, prefix, best_of)
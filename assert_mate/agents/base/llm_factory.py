@@ -0,0 +1,18 @@
+import sys
+
+sys.path.extend(['.', '..'])
+from dotmap import DotMap
+from agents.base.llm import LLM, DeepSeek, AsyncDeepSeek
+from agents.base.replay_llm import ReplayLLM
+
+
+def llm_factory(config: DotMap) -> LLM:
+    backend = config.llm.get('backend', 'deepseek').lower()
+    if backend == 'deepseek':
+        return DeepSeek(config)
+    if backend == 'async_deepseek':
+        return AsyncDeepSeek(config)
+    if backend == 'replay':
+        return ReplayLLM(config)
+    else:
+        raise ValueError(f'Unknown LLM backend: {backend}')
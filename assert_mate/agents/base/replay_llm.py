@@ -0,0 +1,146 @@
+import sys
+import os
+import glob
+import json
+import math
+import time
+import random
+import hashlib
+import threading
+
+from loguru import logger
+
+sys.path.extend(['.', '..'])
+from agents.base.llm import LLM, code_base
+from utils.llm_metrics import load_metrics_recorder, track_call
+from utils.hedging import load_hedging_policy
+from utils.tokens import estimate_messages_tokens, estimate_tokens
+
+
+class ReplayMiss(KeyError):
+    pass
+
+
+class ReplayLLM(LLM):
+    """
+    Offline LLM backend that answers from the `history` fields of recorded result files.
+
+    Every assistant turn of a recorded history is indexed by the hash of the messages before it, so replaying
+    the same prompts reproduces the recorded answers without network access. A synthetic latency is slept before
+    each answer to make throughput measurements realistic.
+    """
+
+    def __init__(self, config):
+        super().__init__()
+        replay_config = config.get('replay', {})
+        self.model = 'replay'
+        self.on_miss = replay_config.get('on_miss', 'error')
+        self.latency = replay_config.get('latency', {})
+        self._rng = random.Random(replay_config.get('seed', 666))
+        self._lock = threading.Lock()
+        self._responses = {}
+        self.hits = 0
+        self.misses = 0
+        patterns = replay_config.get('files', ['results/no_judge-*-results.jsonl'])
+        for pattern in patterns:
+            if not os.path.isabs(pattern):
+                pattern = os.path.join(code_base, pattern)
+            for result_file in sorted(glob.glob(pattern)):
+                self._index(result_file)
+        logger.info(f'Replay backend indexed {len(self._responses)} recorded responses.')
+        self.metrics = load_metrics_recorder(code_base, config)
+        self.hedging = load_hedging_policy(config)
+
+    @staticmethod
+    def prompt_key(messages) -> str:
+        normalized = [{'role': m['role'], 'content': m['content']} for m in messages]
+        serialized = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def _index(self, result_file):
+        with open(result_file, 'r', encoding='utf-8') as reader:
+            for line in reader:
+                line = line.strip()
+                if line == '':
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f'Skipping malformed line in {result_file}.')
+                    continue
+                history = record.get('history', [])
+                if not isinstance(history, list):
+                    continue
+                for idx, message in enumerate(history):
+                    if idx != 0 and message.get('role') == 'assistant':
+                        self._responses.setdefault(self.prompt_key(history[:idx]), message.get('content', ''))
+
+    def _sample_latency(self) -> float:
+        distribution = self.latency.get('distribution', 'none')
+        with self._lock:
+            if distribution == 'constant':
+                return self.latency.get('mean', 1.0)
+            if distribution == 'uniform':
+                return self._rng.uniform(self.latency.get('low', 0.5), self.latency.get('high', 2.0))
+            if distribution == 'normal':
+                return max(0.0, self._rng.gauss(self.latency.get('mean', 1.0), self.latency.get('std', 0.2)))
+            if distribution == 'lognormal':
+                # Parameterized by the median latency and the sigma of log-latency, which gives a long right tail.
+                return self._rng.lognormvariate(math.log(self.latency.get('median', 1.0)),
+                                                self.latency.get('sigma', 0.5))
+        return 0.0
+
+    def _simulate_latency(self):
+        delay = self._sample_latency()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _replay(self, messages, kind='chat') -> str:
+        with track_call(self.metrics, kind, self.model) as call:
+            # Every hedged copy draws its own latency, which lets hedging policies be tuned offline.
+            if self.hedging is None:
+                self._simulate_latency()
+            else:
+                time.sleep(self.hedging.simulate(self._sample_latency))
+            key = self.prompt_key(messages)
+            with self._lock:
+                response = self._responses.get(key)
+                if response is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            if response is None:
+                if self.on_miss == 'error':
+                    raise ReplayMiss(f'No recorded response for prompt {key}.')
+                return ''
+            # Recorded histories carry no usage, so replayed calls report estimated token counts.
+            call['prompt_tokens'] = estimate_messages_tokens(messages)
+            call['completion_tokens'] = estimate_tokens(response)
+            call['usage_estimated'] = True
+            return response
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0
+        }
+
+    def get_response(self, messages) -> str:
+        return self._replay(messages)
+
+    def get_response_with_prefix(self, messages, prefix='```java\nassertEquals(') -> str:
+        response = self._replay(messages, 'prefix')
+        if response == '' or response.startswith(prefix):
+            return response
+        return prefix + response
+
+    def fim_response(self, prompt, suffix, max_tokens=4096) -> str:
+        return self._replay([{'role': 'user', 'content': prompt + suffix}], 'fim')
+
+    def get_multiple_responses_with_prefix(self, messages, prefix='```java\nassertEquals(', best_of=10):
+        response = self.get_response_with_prefix(messages, prefix)
+        if response == '':
+            return [], []
+        return [response], [100.0]
@@ -0,0 +1,99 @@
+import sys
+
+sys.path.extend(['.', '..'])
+import os
+import time
+import json
+import random
+import yaml
+from dotmap import DotMap
+from tqdm import tqdm
+from loguru import logger
+
+from agents.Generator_Impls import FourStepCoTGenerator
+from agents.base.llm_factory import llm_factory
+from utils.llm_metrics import call_tags, assertion_type_tag, format_summary
+from utils.agreement import extract_assertion
+from data.base.dataset_factory import dataset_factory
+
+random.seed(888)
+
+code_base = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+with open(os.path.join(code_base, 'config/basic_config.yaml'), 'r') as reader:
+    config = DotMap(yaml.load(reader, Loader=yaml.FullLoader))
+# The comparison is read from the per-call records, so metrics are always on.
+config.metrics.enabled = True
+model = llm_factory(config)
+
+# Instances per mode; with `llm.backend: replay` the single-turn prompts must have been recorded by an earlier run.
+num_instances = 50
+modes = ['multi_round', 'single_turn']
+
+
+def run_mode(mode, dual_groups, output_base) -> dict:
+    """
+    Runs FourStepCoTGenerator in one mode over all instances and writes its records. Returns the final
+    assertion of every instance and the wall time.
+    """
+    generator = FourStepCoTGenerator(model, single_turn=mode == 'single_turn')
+    assertions = {}
+    start = time.perf_counter()
+    with open(os.path.join(output_base, f'fast_cot-{mode}-results.jsonl'), 'w', encoding='utf-8') as writer:
+        for _, target_group in tqdm(dual_groups, desc=f'FourStepCoT ({mode})'):
+            instance, expected_value, _, _ = target_group
+            generate_kwargs = dict(
+                focal_method_name=instance.focal_method_name,
+                focal_method=instance.focal_method,
+                test_prefix=instance.test_prefix,
+                expected_value_type='boolean' if expected_value in ['assertTrue', 'assertFalse'] else None,
+                actual_value=instance.actual_value
+            )
+            with call_tags(agent='FourStepCoTGenerator', round=mode, instance_id=instance.id,
+                           assertion_type=assertion_type_tag(expected_value)):
+                if expected_value in ['assertTrue', 'assertFalse']:
+                    response = generator.generate_assertBoolean(**generate_kwargs)
+                elif expected_value in ['assertNull', 'assertNotNull']:
+                    response = generator.generate_assertNullValue(**generate_kwargs)
+                else:
+                    response = generator.generate_assertEquals(**generate_kwargs)
+            assertions[instance.id] = extract_assertion(response)
+            # `history` holds the messages actually sent, so that the replay backend can index either mode.
+            writer.write(json.dumps({
+                'id': instance.id,
+                'mode': mode,
+                'expected_value': expected_value,
+                'assertion': assertions[instance.id],
+                'history': generator.single_turn_exchange if generator.single_turn else generator.history,
+                'rounds': generator.history
+            }, ensure_ascii=False) + '\n')
+    return {'assertions': assertions, 'wall_time': time.perf_counter() - start}
+
+
+if __name__ == '__main__':
+    dataset = 'defects4j'
+
+    ds = dataset_factory(config, dataset)
+    data = ds.load_retrieval_data(top_k=1)
+    random.shuffle(data)
+    data = data[:num_instances]
+
+    output_base = os.path.join(code_base, 'results/benchmarks')
+    if not os.path.exists(output_base):
+        os.makedirs(output_base)
+
+    results = {mode: run_mode(mode, data, output_base) for mode in modes}
+
+    rows = {row['round']: row for row in model.metrics.summary(keys=['round'])}
+    logger.info(f'FourStepCoT modes over {len(data)} instances:\n{format_summary(list(rows.values()))}')
+    for mode in modes:
+        row = rows.get(mode, {})
+        logger.info(f'{mode}: wall time {results[mode]["wall_time"]:.1f}s, {row.get("calls", 0)} calls, '
+                    f'{row.get("prompt_tokens", 0)} prompt tokens, {row.get("completion_tokens", 0)} completion '
+                    f'tokens, {row.get("cost", 0.0)} USD')
+    multi_round, single_turn = results['multi_round']['assertions'], results['single_turn']['assertions']
+    # Answers without an assertion are extracted as '' and never count as agreeing.
+    agreed = sum(1 for instance_id in multi_round
+                 if multi_round[instance_id] != '' and multi_round[instance_id] == single_turn.get(instance_id))
+    missing = {mode: sum(1 for assertion in results[mode]['assertions'].values() if assertion == '') for mode in modes}
+    logger.info(f'Final assertions agree on {agreed}/{len(multi_round)} instances, answers without an assertion: '
+                f'{missing}.')
@@ -9,7 +9,7 @@ import time
 from tqdm import tqdm
 from loguru import logger
 from agents.Generator_Impls import BaselineRAGGenerator
-from agents.base.llm import DeepSeek
+from agents.base.llm_factory import llm_factory
 import yaml
 import pickle
 
@@ -18,7 +18,7 @@ random.seed(888)
 code_base = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
 with open(os.path.join(code_base, 'config/basic_config.yaml'), 'r') as reader:
     config = DotMap(yaml.load(reader, Loader=yaml.FullLoader))
-model = DeepSeek(config)
+model = llm_factory(config)
 
 # if debugging mode.
 debug = True
@@ -114,8 +114,7 @@ def first_round_speak_up(dual_groups, members, cache, output_base, pid) -> dict:
             record_instance['response'] = response
             writer.write(json.dumps(record_instance,
                                     ensure_ascii=False) + '\n')
-            responses[member_id][instance.id] = pickle.loads(
-                pickle.dumps(member.history))
+            responses[member_id][instance.id] = member.history
         writer.close()
     return responses
 
@@ -10,16 +10,22 @@ from dotmap import DotMap
 from tqdm import tqdm
 
 from agents.Generator_Impls import NaiveGenerator, RAGGenerator, FourStepCoTGenerator
-from agents.base.llm import DeepSeek
+from agents.base.llm_factory import llm_factory
+from utils.llm_metrics import call_tags, assertion_type_tag
 from utils.postprocessing import extract_assertion_from_response
 from utils.file import load_jsonl_file_as_dict
+from utils.agreement import load_settled_instances
 
 random.seed(888)
 
 code_base = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
 with open(os.path.join(code_base, 'config/basic_config.yaml'), 'r') as reader:
     config = DotMap(yaml.load(reader, Loader=yaml.FullLoader))
-model = DeepSeek(config)
+model = llm_factory(config)
+# Debating is optional: with a budget, instances it cannot pay for keep their first-round answers.
+budget = model.budget
+# The speaker each member is in the debate statements and histories built below.
+DEBATE_USERS = {'RAGGenerator': 'user1', 'NaiveGenerator': 'user2', 'FourStepCoTGenerator': 'user3'}
 
 # if debugging mode.
 debug = False
@@ -106,12 +112,18 @@ def discussion(data, pid, output_base):
         # CoTGenerator(model),
         RAGGenerator(model),
         # AutoCoTGenerator(model),
-        FourStepCoTGenerator(model)
+        FourStepCoTGenerator(model, single_turn=config.get('four_step_cot', {}).get('single_turn', False))
     ]
 
     if debug:
         data = data[:10]
 
+    member_ids = [member.__class__.__name__ for member in members]
+    skipped = set()
+    if budget is not None:
+        skipped = {instance[0] for instance in data
+                   if not budget.allow([(member_id, 'debate') for member_id in member_ids])}
+
     record = {}
     for member in members:
         member_id = member.__class__.__name__
@@ -121,18 +133,31 @@ def discussion(data, pid, output_base):
             record[member_id] = {}
         for instance in tqdm(data, desc=f'{member_id} is debating'):
             id, focal_method, test_prefix, expected_value, statements, history = instance
+            if id in skipped:
+                writer.write(json.dumps({
+                    'id': id,
+                    'focal_method': focal_method,
+                    'test_prefix': test_prefix,
+                    'expected_value': expected_value,
+                    'debated_answer': None,
+                    'history': history[DEBATE_USERS[member_id]],
+                    'decided_by': 'budget',
+                }, ensure_ascii=False) + '\n')
+                continue
             prefix = None
             if expected_value in ['assertTrue','assertFalse','assertNull','assertNotNull']:
                 prefix = 'I think the answer should be:\n```java\nassert'
             else:
                 prefix = 'I think the answer should be:\n```java\nassertEquals('
-            refined_answer = member.debate(
-                focal_method=focal_method,
-                test_prefix=test_prefix,
-                statements=statements,
-                history=history,
-                prefix=prefix
-            )
+            with call_tags(agent=member_id, round='debate', instance_id=id,
+                           assertion_type=assertion_type_tag(expected_value)):
+                refined_answer = member.debate(
+                    focal_method=focal_method,
+                    test_prefix=test_prefix,
+                    statements=statements,
+                    history=history,
+                    prefix=prefix
+                )
             writer.write(json.dumps({
                 'id': id,
                 'focal_method': focal_method,
@@ -143,6 +168,8 @@ def discussion(data, pid, output_base):
             }, ensure_ascii=False) + '\n')
             member.clear_history()
         writer.close()
+    if budget is not None:
+        budget.settle()
 
 
 def record_results(num_process: int):
@@ -185,12 +212,14 @@ if __name__ == '__main__':
     b = load_jsonl_file_as_dict(os.path.join(output_base, 'no_judge-first_round_speak_up-RAGGenerator-results.jsonl'))
     c = load_jsonl_file_as_dict(
         os.path.join(output_base, 'no_judge-first_round_speak_up-FourStepCoTGenerator-results.jsonl'))
-    assert len(a) == len(b) == len(c)
-    all_ids = list(a.keys())
+    # Instances the cascade settled skip the debate; they count as agreed.
+    settled = load_settled_instances(os.path.join(output_base, 'no_judge-results.jsonl'))
+    all_ids = [id for id in dict.fromkeys([*a, *b, *c]) if id not in settled]
+    assert all(id in a and id in b and id in c for id in all_ids)
     accuracy_results, _ =summary_results(all_ids, {'naive': a, 'rag': b, 'fscot': c})
 
     data = []
-    agreed = 0
+    agreed = len(settled)
     for id, record in accuracy_results.items():
         if len(record['members_corrected']) == 3:
             agreed +=1
@@ -234,4 +263,7 @@ if __name__ == '__main__':
         for job in jobs:
             job.join()
         record_results(num_process)
+
+    if model.metrics is not None:
+        model.metrics.log_run_summary()
     pass
@@ -2,7 +2,7 @@ import sys
 
 sys.path.extend(['.', '..'])
 import os
-import yaml, multiprocessing, pickle
+import yaml, multiprocessing
 from dotmap import DotMap
 import json
 import random
@@ -11,7 +11,7 @@ from loguru import logger
 from collections import Counter
 
 from agents.Generator_Impls import NaiveGenerator, AutoCoTGenerator, CoTGenerator, RAGGenerator, FourStepCoTGenerator
-from agents.base.llm import DeepSeek
+from agents.base.llm_factory import llm_factory
 from utils.multi_processing_cache import load_cache, dump_cache
 from utils.java_parsers import parse_variables
 from data.base.dataset_factory import dataset_factory
@@ -21,7 +21,7 @@ random.seed(888)
 code_base = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
 with open(os.path.join(code_base, 'config/basic_config.yaml'), 'r') as reader:
     config = DotMap(yaml.load(reader, Loader=yaml.FullLoader))
-model = DeepSeek(config)
+model = llm_factory(config)
 
 # if debugging mode.
 debug = True
@@ -63,7 +63,7 @@ def discussion(dual_groups, cache, pid, output_base):
             for member in members:
                 member_id = member.__class__.__name__
                 response = response_histories[member_id][instance.id][-1].get('content', '').strip()
-                responses_for_record[member_id] = pickle.loads(pickle.dumps(response_histories[member_id][instance.id]))
+                responses_for_record[member_id] = response_histories[member_id][instance.id]
                 response_set.add(response)
                 current_round_responses[instance.id][member_id] = response
 
@@ -71,12 +71,12 @@ def discussion(dual_groups, cache, pid, output_base):
             if len(response_set) == 1:
                 # 如果一致，那么记录这个一致的结果
                 final_results[instance.id] = {
-                    'focal_method': pickle.loads(pickle.dumps(instance.focal_method)),
-                    'test_case': pickle.loads(pickle.dumps(instance.test_case)),
-                    'expected_value': pickle.loads(pickle.dumps(expected_value)),
-                    'processed_assertion': pickle.loads(pickle.dumps(processed_assertion)),
+                    'focal_method': instance.focal_method,
+                    'test_case': instance.test_case,
+                    'expected_value': expected_value,
+                    'processed_assertion': processed_assertion,
                     'response': response_set.pop(),
-                    'complete_responses': pickle.loads(pickle.dumps(responses_for_record)),
+                    'complete_responses': responses_for_record,
                 }
                 response_set.clear()
                 pass
@@ -88,8 +88,8 @@ def discussion(dual_groups, cache, pid, output_base):
             logger.info(f'{len(dual_groups_to_refine)} need to be refined. {maximum_retries} rounds remains.')
             refined_responses = refine(dual_groups_to_refine, members, response_histories, current_round_responses,
                                        output_base, pid)
-            response_histories = pickle.loads(pickle.dumps(refined_responses))
-            last_round_groups_to_refine = pickle.loads(pickle.dumps(dual_groups_to_refine))
+            response_histories = refined_responses
+            last_round_groups_to_refine = list(dual_groups_to_refine)
             dual_groups_to_refine.clear()
             continue
         else:
@@ -106,17 +106,17 @@ def discussion(dual_groups, cache, pid, output_base):
             for member in members:
                 member_id = member.__class__.__name__
                 response = refined_responses[member_id][instance.id][-1].get('content', '').strip()
-                responses_for_record[member_id] = pickle.loads(pickle.dumps(refined_responses[member_id][instance.id]))
+                responses_for_record[member_id] = refined_responses[member_id][instance.id]
                 voting[response] += 1
 
             final_answer = voting.most_common(1)[0][0]
             final_results[instance.id] = {
-                'focal_method': pickle.loads(pickle.dumps(instance.focal_method)),
-                'test_case': pickle.loads(pickle.dumps(instance.test_case)),
-                'expected_value': pickle.loads(pickle.dumps(expected_value)),
-                'processed_assertion': pickle.loads(pickle.dumps(processed_assertion)),
-                'response': pickle.loads(pickle.dumps(final_answer)),
-                'complete_responses': pickle.loads(pickle.dumps(responses_for_record)),
+                'focal_method': instance.focal_method,
+                'test_case': instance.test_case,
+                'expected_value': expected_value,
+                'processed_assertion': processed_assertion,
+                'response': final_answer,
+                'complete_responses': responses_for_record,
             }
     with open(os.path.join(code_base, f'results/debug_no_judge-{pid}-results.jsonl'), 'w', encoding='utf-8') as writer:
         for instance_id, record in final_results.items():
@@ -190,12 +190,13 @@ def first_round_speak_up(dual_groups, members, cache, output_base, pid) -> dict:
                 )
                 record_instance['history'] = member.history
                 writer.write(json.dumps(record_instance, ensure_ascii=False) + '\n')
-                responses[member_id][instance.id] = pickle.loads(pickle.dumps(member.history))
+                responses[member_id][instance.id] = member.history
             writer.close()
         return responses
     except:
         # In case there are unexpected errors, we need to dump the cache.
         dump_cache(code_base, dict(cache.cot_thoughts))
+        cache.log_stats()
 
 
 def refine(dual_groups, members, member_history, last_responses, output_base, pid) -> dict:
@@ -227,7 +228,7 @@ def refine(dual_groups, members, member_history, last_responses, output_base, pi
             record_instance['history'] = member.history
             record_instance['expected_value'] = expected_value
             writer.write(json.dumps(record_instance, ensure_ascii=False) + '\n')
-            responses[member_id][instance.id] = pickle.loads(pickle.dumps(member.history))
+            responses[member_id][instance.id] = member.history
         writer.close()
     return responses
 
@@ -273,6 +274,7 @@ if __name__ == '__main__':
     if debug:
         discussion(data, cache, 0, output_base)
         dump_cache(code_base, dict(cache.cot_thoughts))
+        cache.log_stats()
         # record_results(1)
 
     pass
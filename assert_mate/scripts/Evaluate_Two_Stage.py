@@ -6,6 +6,7 @@ from agents.Generator_Impls import *
 from loguru import logger
 from utils.file import load_jsonl_file
 from utils.postprocessing import extract_assertion_from_response
+from utils.agreement import load_settled_instances
 
 
 def load_jsonl_file_as_dict(file_path) -> dict:
@@ -71,15 +72,33 @@ if __name__ == '__main__':
 
     # autocot_results = load_jsonl_file(
     #     os.path.join(output_base,'no_judge-first_round_speak_up-AutoCoTGenerator-results.jsonl'))
-    assert len(naive_results) == len(rag_results) == len(fscot_results)  # == len(autocot_results)
-    total = len(naive_results)
-    for i in range(len(naive_results)):
-        assert naive_results[i]['id'] == rag_results[i]['id'] == fscot_results[i]['id']
-        naive_result = naive_results[i]
-        rag_result = rag_results[i]
-        fscot_result = fscot_results[i]
+    # The members the cascade skipped have no record of the instances it settled; those take the agreed assertion.
+    settled = load_settled_instances(os.path.join(output_base, 'no_judge-results.jsonl'))
+    results_by_member = {
+        'Naive': {r['id']: r for r in naive_results},
+        'RAG': {r['id']: r for r in rag_results},
+        'FSCoT': {r['id']: r for r in fscot_results},
+    }
+    all_ids = list(dict.fromkeys(r['id'] for r in naive_results + rag_results + fscot_results))
+    total = len(all_ids)
+    for id in all_ids:
+        if id in settled:
+            records = {m: results[id] for m, results in results_by_member.items() if id in results}
+            expected_value = next(iter(records.values()))['expected_value']
+            if expected_value in settled[id]['assertion']:
+                final_correct += 1
+                at_least_one_correct.add(id)
+                for m, record in records.items():
+                    if expected_value in extract_assertion_from_response(record['history'][-1]['content']):
+                        correct_by_member[m].add(id)
+            else:
+                unanimous_but_wrong.add(id)
+            continue
+        assert all(id in results for results in results_by_member.values())
+        naive_result = results_by_member['Naive'][id]
+        rag_result = results_by_member['RAG'][id]
+        fscot_result = results_by_member['FSCoT'][id]
         # autocot_result = autocot_results[i]
-        assert naive_result['id'] == rag_result['id'] == fscot_result['id']
         res_set = set()
         naive_response = extract_assertion_from_response(naive_result['history'][-1]['content'])
         rag_response = extract_assertion_from_response(rag_result['history'][-1]['content'])
@@ -28,14 +28,14 @@ def summary_results(ids, response_dict):
                 "members_corrected": [],
                 'type':''
             }
-        # specify output instances for each strategy
-        naive_result = naive_results[id]
-        rag_result = rag_results[id]
-        fscot_result = fscot_results[id]
+        # specify output instances for each strategy; the members the cascade skipped have no record.
+        member_results = [(m, results[id]) for m, results in
+                          zip(['Naive', 'RAG', 'FSCoT'], [naive_results, rag_results, fscot_results]) if id in results]
 
         # make sure all the instances are in the same page.
-        assert naive_result['expected_value'] == rag_result['expected_value'] == fscot_result['expected_value']
-        expected_value = naive_result['expected_value']
+        assert len({result['expected_value'] for _, result in member_results}) == 1
+        expected_value = member_results[0][1]['expected_value']
+        accuracy_results[id]['members'] = len(member_results)
 
         if expected_value in ['assertTrue', 'assertFalse']:
             accuracy_results[id]['type']= 'assertBoolean'
@@ -45,13 +45,9 @@ def summary_results(ids, response_dict):
             accuracy_results[id]['type']= 'assertEquals'
 
 
-        # extract assertions
-        naive_response = extract_assertion_from_response(naive_result['history'][-1]['content'])
-        rag_response = extract_assertion_from_response(rag_result['history'][-1]['content'])
-        fscot_response = extract_assertion_from_response(fscot_result['history'][-1]['content'])
-
         # check if the expected value is in the response
-        for m, response in zip(['Naive', 'RAG', 'FSCoT'], [naive_response, rag_response, fscot_response]):
+        for m, result in member_results:
+            response = extract_assertion_from_response(result['history'][-1]['content'])
             if m not in correct_by_member.keys():
                 correct_by_member[m] = {'all': set(),
                                     'assertEquals': set(),
@@ -98,11 +94,8 @@ if __name__ == '__main__':
     c = load_jsonl_file_as_dict(
         os.path.join(output_base, 'no_judge-first_round_speak_up-FourStepCoTGenerator-results.jsonl'))
 
-    # Make sure the number of instances are the same.
-    assert len(a) == len(b) == len(c)
-
-    # Collect all instance ids.
-    all_instance_ids = list(a.keys())
+    # Collect all instance ids; with the cascade, members it skipped lack the instances it settled.
+    all_instance_ids = list(dict.fromkeys([*a, *b, *c]))
     accuracy_results, correct_by_member = summary_results(all_instance_ids, {'naive': a, 'rag': b, 'fscot': c})
 
     # Debate part.
@@ -125,7 +118,8 @@ if __name__ == '__main__':
 
     # Summary
     total = len(all_instance_ids)
-    all_corrected = sum([1 for id in all_instance_ids if len(accuracy_results[id]['members_corrected']) == 3])
+    all_corrected = sum([1 for id in all_instance_ids
+                         if len(accuracy_results[id]['members_corrected']) == accuracy_results[id]['members']])
     all_assertEquals = sum([1 for id in accuracy_results.keys() if accuracy_results[id]['type'] == 'assertEquals'])
     all_assertBoolean = sum([1 for id in accuracy_results.keys() if accuracy_results[id]['type'] == 'assertBoolean'])
     all_assertNullValues = sum([1 for id in accuracy_results.keys() if accuracy_results[id]['type'] == 'assertNullValues'])
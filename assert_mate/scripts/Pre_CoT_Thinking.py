@@ -10,14 +10,14 @@ import random, json
 
 import data.methods2test as m2t
 from agents.Generator_Impls import CoTGenerator
-from agents.base.llm import DeepSeek
+from agents.base.llm_factory import llm_factory
 
 random.seed(666)
 
 code_base = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
 with open(os.path.join(code_base, 'config/basic_config.yaml'), 'r') as reader:
     config = DotMap(yaml.load(reader, Loader=yaml.FullLoader))
-model = DeepSeek(config)
+model = llm_factory(config)
 
 
 def discussion(dual_groups, pid, output_base):
@@ -2,7 +2,7 @@ import sys
 
 sys.path.extend(['.', '..'])
 import os
-import yaml, multiprocessing, pickle
+import yaml, multiprocessing
 from dotmap import DotMap
 import json
 import random
@@ -11,7 +11,10 @@ from loguru import logger
 
 from agents.Generator_Impls import NaiveGenerator, AutoCoTGenerator
 from agents.Judge import Judge
-from agents.base.llm import DeepSeek
+from agents.base.llm_factory import llm_factory
+from utils.llm_metrics import call_tags
+from utils.agreement import load_consensus_cascade, load_agreement_engine
+from utils.voting import load_weighted_voter
 from utils.multi_processing_cache import load_cache, dump_cache
 from data.base.dataset_factory import dataset_factory
 
@@ -20,7 +23,14 @@ random.seed(666)
 code_base = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
 with open(os.path.join(code_base, 'config/basic_config.yaml'), 'r') as reader:
     config = DotMap(yaml.load(reader, Loader=yaml.FullLoader))
-model = DeepSeek(config)
+model = llm_factory(config)
+cascade = load_consensus_cascade(config)
+agreement = load_agreement_engine(config)
+# With a budget, the first round runs for every instance and the Judge and refine rounds only while it lasts.
+budget = model.budget
+voter = load_weighted_voter(config)
+# two_step: a verdict call and an explanation call; structured: both in one call; batched: several instances per call.
+judge_mode = config.get('judge', {}).get('mode', 'two_step')
 
 # if debugging mode.
 debug = True
@@ -36,26 +46,40 @@ def discussion(dual_groups, cache, pid, output_base):
     # TODO: Remove this when running large-scale evaluation.
     dual_groups = dual_groups[:10]
 
-    generator_responses = first_round_speak_up(
+    if budget is not None:
+        budget.reserve([(member.__class__.__name__, 'first_round_speak_up') for member in members], len(dual_groups))
+    generator_responses, settled = first_round_speak_up(
         dual_groups=dual_groups,
         members=members,
         cache=cache,
         output_base=output_base,
-        pid=pid)
+        pid=pid,
+        cascade=cascade)
+    if budget is not None:
+        budget.settle()
 
-    judge_responses = judge_consistency(dual_groups, judge, generator_responses, output_base, pid)
+    judge_responses = judge_consistency(dual_groups, judge, generator_responses, output_base, pid, settled)
+    if budget is not None:
+        budget.settle()
 
     assert len(dual_groups) == len(judge_responses)
 
     generator_responses_refine = {}
     dual_groups_refine = []
     judge_responses_refine = {}
+    voted = []
+    refine_rounds = [(member.__class__.__name__, 'second_round_refine') for member in members] + \
+        [('Judge', 'judge_final_decision')]
     for dual_group in dual_groups:
         _, target_group = dual_group
         instance, _, _, _ = target_group
         verdict = judge_responses[instance.id][0]
         if '**YES**' in verdict:
             continue
+        elif budget is not None and not budget.allow(refine_rounds):
+            voted.append((dual_group, voter.vote_answers({
+                member: history[instance.id][-1].get('content')
+                for member, history in generator_responses.items() if instance.id in history})))
         else:
             dual_groups_refine.append(dual_group)
             judge_responses_refine[instance.id] = judge_responses[instance.id]
@@ -68,15 +92,27 @@ def discussion(dual_groups, cache, pid, output_base):
         logger.info(f'{len(dual_groups_refine)} need to be refined.')
         refined_responses = second_round_refine(dual_groups_refine, judge_responses_refine, members,
                                                 generator_responses_refine, output_base, pid)
-        judge_final_decision(dual_groups_refine, judge, refined_responses, pid, output_base)
+    else:
+        refined_responses = {}
+    if len(dual_groups_refine) != 0 or len(voted) != 0:
+        judge_final_decision(dual_groups_refine, judge, refined_responses, pid, output_base, voted)
+    if budget is not None:
+        budget.settle()
     pass
 
 
-def first_round_speak_up(dual_groups, members, cache, output_base, pid) -> dict:
+def first_round_speak_up(dual_groups, members, cache, output_base, pid, cascade=None) -> tuple:
+    """
+    Returns the member histories and the instances settled by the `cascade`, which later members skip.
+    """
     member_id = ''
     try:
         responses = {}
-        for member in members:
+        settled = {}
+        members_by_id = {member.__class__.__name__: member for member in members}
+        stages = cascade.plan(list(members_by_id)) if cascade is not None else [list(members_by_id)]
+        stage_ends = {stage[-1]: stage_idx for stage_idx, stage in enumerate(stages)}
+        for member in [members_by_id[member_id] for stage in stages for member_id in stage]:
             member_id = member.__class__.__name__
             responses[member_id] = {}
             writer = open(
@@ -88,6 +124,8 @@ def first_round_speak_up(dual_groups, members, cache, output_base, pid) -> dict:
                     'member': member_id
                 }
                 instance, expected_value, raw_assertion, processed_assertion = target_group
+                if instance.id in settled:
+                    continue
                 focal_method = instance.focal_method.body
                 test_case = instance.test_case.body
                 test_prefix = test_case.replace(raw_assertion, processed_assertion, 1)
@@ -118,53 +156,127 @@ def first_round_speak_up(dual_groups, members, cache, output_base, pid) -> dict:
                                        'public' in m.full_signature]
                 test_class_fields = [f.original_string for f in instance.test_class.fields]
 
-                response = member.generate_assertEquals(
-                    focal_method_name=instance.focal_method.identifier,
-                    focal_method=focal_method,
-                    focal_class_fields=focal_class_fields,
-                    focal_class_methods=focal_class_methods,
-                    test_class_fields=test_class_fields,
-                    # test_class_methods = test_class_methods,
-                    test_prefix=test_prefix,
-                    retrieved_focal_method=retrieved_focal_method,
-                    retrieved_test_prefix=retrieved_test_prefix,
-                    retrieved_ground_truth=retrieved_expected_value,
-                    cot_cache=cache
-                )
+                with call_tags(agent=member_id, round='first_round_speak_up', instance_id=instance.id,
+                               assertion_type='assertEquals'):
+                    response = member.generate_assertEquals(
+                        focal_method_name=instance.focal_method.identifier,
+                        focal_method=focal_method,
+                        focal_class_fields=focal_class_fields,
+                        focal_class_methods=focal_class_methods,
+                        test_class_fields=test_class_fields,
+                        # test_class_methods = test_class_methods,
+                        test_prefix=test_prefix,
+                        retrieved_focal_method=retrieved_focal_method,
+                        retrieved_test_prefix=retrieved_test_prefix,
+                        retrieved_ground_truth=retrieved_expected_value,
+                        cot_cache=cache
+                    )
                 record_instance['history'] = member.history
                 writer.write(json.dumps(record_instance, ensure_ascii=False) + '\n')
                 responses[member_id][instance.id] = member.history
             writer.close()
-        return responses
+            if cascade is not None and member_id in stage_ends:
+                cascade.settle_stage([(target_group[0].id, target_group[1]) for _, target_group in dual_groups],
+                                     responses, settled, stages, stage_ends[member_id])
+        if cascade is not None:
+            for _, target_group in dual_groups:
+                if target_group[0].id not in settled:
+                    cascade.observe(None)
+        return responses, settled
     except:
         # In case there are unexpected errors, we need to dump the cache.
         dump_cache(code_base, dict(cache.cot_thoughts))
+        cache.log_stats()
+
+
+def _judged_verdict(decision: dict, local_verdict):
+    verdict = '**NO**' if local_verdict == 'NO' else decision['verdict']
+    if '**YES**' in verdict:
+        return verdict, decision['assertion']
+    return verdict, decision['comments'] or decision['raw']
 
 
-def judge_consistency(dual_groups, judge: Judge, responses: dict, output_base, pid) -> dict:
+def judge_consistency(dual_groups, judge: Judge, responses: dict, output_base, pid, settled=None) -> dict:
     judge_result = {}
-    writer = open(os.path.join(output_base, f'first_round_judge-{pid}-results.jsonl'), 'w', encoding='utf-8')
-    for retrieved_group, target_group in tqdm(dual_groups, desc='First round judging'):
+    cases = []
+    judge_rounds = [('Judge', 'judge_consistency')]
+    if judge_mode == 'two_step':
+        judge_rounds.append(('Judge', 'judge_explain'))
+    for retrieved_group, target_group in dual_groups:
         instance, expected_value, raw_assertion, processed_assertion = target_group
-        focal_method = instance.focal_method.body
         test_case = instance.test_case.body
-        test_prefix = test_case.replace(raw_assertion, processed_assertion, 1)
-        final_responses = {}
-        for member, history in responses.items():
-            final_responses[member] = history[instance.id][-1].get('content')
-        verdict = judge.make_decision(focal_method, test_prefix, final_responses)
-        explain = judge.explain_decision(focal_method, test_prefix, final_responses, verdict, processed_assertion)
-        judge_result[instance.id] = [verdict, explain]
-        record_instance = {
+        case = {
             'id': instance.id,
-            'focal_method': focal_method,
+            'focal_method': instance.focal_method.body,
             'test_case': test_case,
-            'test_prefix': test_prefix,
+            'test_prefix': test_case.replace(raw_assertion, processed_assertion, 1),
             'expected_value': expected_value,
+            'processed_assertion': processed_assertion,
+            'responses': {member: history[instance.id][-1].get('content')
+                          for member, history in responses.items() if instance.id in history},
+        }
+        # Agreement is settled locally where possible; the Judge only sees the ambiguous cases. Local verdicts
+        # read like the Judge's, and a local YES comes with the agreed assertion as its explanation.
+        if settled and instance.id in settled:
+            case.update(decided_by='cascade', local_verdict='YES', agreed=settled[instance.id]['assertion'])
+        elif agreement is not None:
+            local_verdict, agreed = agreement.decide(case['responses'])
+            case.update(decided_by='agreement' if local_verdict is not None else 'judge', local_verdict=local_verdict,
+                        agreed=agreed)
+        else:
+            case.update(decided_by='judge', local_verdict=None, agreed=None)
+        # Out of budget, the weighted vote over the answers stands in for the Judge.
+        if case['local_verdict'] != 'YES' and budget is not None and not budget.allow(judge_rounds):
+            case.update(decided_by='budget', local_verdict='YES',
+                        agreed=voter.vote_answers(case['responses']))
+        cases.append(case)
+
+    batched = {}
+    if judge_mode == 'batched':
+        batch_config = config.get('judge', {})
+        with call_tags(agent='Judge', round='judge_consistency'):
+            batched = judge.batched_decisions([case for case in cases if case['local_verdict'] != 'YES'],
+                                              token_budget=batch_config.get('batch_token_budget', 12000),
+                                              max_batch_size=batch_config.get('max_batch_size', 8))
+
+    writer = open(os.path.join(output_base, f'first_round_judge-{pid}-results.jsonl'), 'w', encoding='utf-8')
+    for case in tqdm(cases, desc='First round judging'):
+        instance_id = case['id']
+        focal_method, test_prefix, final_responses = case['focal_method'], case['test_prefix'], case['responses']
+        local_verdict = case['local_verdict']
+        if local_verdict == 'YES':
+            verdict, explain = '**YES**', f'```java\n{case["agreed"]}\n```'
+        elif judge_mode == 'batched':
+            verdict, explain = _judged_verdict(batched[instance_id], local_verdict)
+        elif judge_mode == 'structured':
+            with call_tags(agent='Judge', round='judge_consistency', instance_id=instance_id):
+                decision = judge.structured_decision(focal_method, test_prefix, final_responses,
+                                                     case['processed_assertion'])
+            verdict, explain = _judged_verdict(decision, local_verdict)
+        else:
+            if local_verdict == 'NO':
+                verdict = '**NO**'
+            else:
+                with call_tags(agent='Judge', round='judge_consistency', instance_id=instance_id):
+                    verdict = judge.make_decision(focal_method, test_prefix, final_responses)
+            # The members still need the Judge's comments to refine their answers.
+            with call_tags(agent='Judge', round='judge_explain', instance_id=instance_id):
+                explain = judge.explain_decision(focal_method, test_prefix, final_responses, verdict,
+                                                 case['processed_assertion'])
+        judge_result[instance_id] = [verdict, explain]
+        record_instance = {
+            'id': instance_id,
+            'focal_method': focal_method,
+            'test_case': case['test_case'],
+            'test_prefix': test_prefix,
+            'expected_value': case['expected_value'],
             'first_round_speak_ups': final_responses,
             'first_round_verdict': verdict,
             'verdict_explain': explain,
+            'decided_by': case['decided_by'],
         }
+        if case['decided_by'] == 'cascade':
+            record_instance['cascade'] = settled[instance_id]
         writer.write(json.dumps(record_instance, ensure_ascii=False) + '\n')
     writer.close()
     return judge_result
@@ -189,18 +301,22 @@ def second_round_refine(dual_groups, judge_responses, members, member_previous_r
             record_instance['id'] = instance.id
             member.clear_history()
             member.update_history(history[instance.id])
-            member.refine(
-                judge_response=judge_response
-            )
+            with call_tags(agent=member_id, round='second_round_refine', instance_id=instance.id):
+                member.refine(
+                    judge_response=judge_response
+                )
             record_instance['history'] = member.history
             record_instance['expected_value'] = expected_value
             writer.write(json.dumps(record_instance, ensure_ascii=False) + '\n')
-            responses[member_id][instance.id] = pickle.loads(pickle.dumps(member.history))
+            responses[member_id][instance.id] = member.history
         writer.close()
     return responses
 
 
-def judge_final_decision(dual_groups, judge, refined_responses: dict, pid, output_base) -> dict:
+def judge_final_decision(dual_groups, judge, refined_responses: dict, pid, output_base, voted=()) -> dict:
+    """
+    `voted` holds the instances the budget left without a refine round, with the assertion voted for them.
+    """
     judge_result = {}
     writer = open(os.path.join(output_base, f'final_judge-{pid}-results.jsonl'), 'w', encoding='utf-8')
     error_writer = open(os.path.join(output_base, f'error-{pid}.jsonl'), 'w', encoding='utf-8')
@@ -213,7 +329,8 @@ def judge_final_decision(dual_groups, judge, refined_responses: dict, pid, outpu
         for member, history in refined_responses.items():
             final_responses[member] = history[instance.id][-1].get('content')
         try:
-            verdict = judge.final_decision(focal_method, test_prefix, final_responses)
+            with call_tags(agent='Judge', round='judge_final_decision', instance_id=instance.id):
+                verdict = judge.final_decision(focal_method, test_prefix, final_responses)
             judge_result[instance.id] = verdict
             record_instance = {
                 'id': instance.id,
@@ -235,6 +352,20 @@ def judge_final_decision(dual_groups, judge, refined_responses: dict, pid, outpu
             )
         finally:
             continue
+    for (retrieved_group, target_group), assertion in voted:
+        instance, expected_value, raw_assertion, processed_assertion = target_group
+        test_case = instance.test_case.body
+        verdict = f'```java\n{assertion}\n```'
+        judge_result[instance.id] = verdict
+        writer.write(json.dumps({
+            'id': instance.id,
+            'focal_method': instance.focal_method.body,
+            'test_case': test_case,
+            'test_prefix': test_case.replace(raw_assertion, processed_assertion, 1),
+            'expected_value': expected_value,
+            'final_verdict': verdict,
+            'decided_by': 'budget'
+        }, ensure_ascii=False) + '\n')
 
     writer.close()
     error_writer.close()
@@ -341,6 +472,7 @@ if __name__ == '__main__':
     if debug:
         discussion(chunks[4], cache, 0, output_base)
         dump_cache(code_base, dict(cache.cot_thoughts))
+        cache.log_stats()
         record_results(1)
         pass
     else:
@@ -353,6 +485,9 @@ if __name__ == '__main__':
         for job in jobs:
             job.join()
         dump_cache(code_base, dict(cache.cot_thoughts))
+        cache.log_stats()
         record_results(num_process)
 
+    if model.metrics is not None:
+        model.metrics.log_run_summary()
     pass
@@ -1,13 +1,15 @@
 import sys
 
 sys.path.extend(['.', '..'])
-import pickle
 import multiprocessing
 import yaml
 from data.base.dataset_factory import dataset_factory
 from utils.java_parsers import parse_variables
 from utils.multi_processing_cache import load_cache, dump_cache
-from agents.base.llm import DeepSeek
+from agents.base.llm_factory import llm_factory
+from utils.llm_metrics import call_tags, assertion_type_tag
+from utils.agreement import load_consensus_cascade
+from utils.voting import load_weighted_voter
 from agents.Generator_Impls import NaiveGenerator, RAGGenerator, FourStepCoTGenerator
 from collections import Counter
 from loguru import logger
@@ -24,7 +26,11 @@ random.seed(888)
 code_base = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
 with open(os.path.join(code_base, 'config/basic_config.yaml'), 'r') as reader:
     config = DotMap(yaml.load(reader, Loader=yaml.FullLoader))
-model = DeepSeek(config)
+model = llm_factory(config)
+cascade = load_consensus_cascade(config)
+# With a budget, the first round runs for every instance and the refine rounds only while it lasts.
+budget = model.budget
+voter = load_weighted_voter(config)
 
 # if debugging mode.
 debug = False
@@ -33,28 +39,54 @@ debug = False
 def discussion(dual_groups, cache, pid, output_base):
     global debug
     members = [
-        NaiveGenerator(DeepSeek(config)),
+        NaiveGenerator(llm_factory(config)),
         # CoTGenerator(model),
-        RAGGenerator(DeepSeek(config)),
+        RAGGenerator(llm_factory(config)),
         # AutoCoTGenerator(model),
-        FourStepCoTGenerator(DeepSeek(config))
+        FourStepCoTGenerator(llm_factory(config),
+                             single_turn=config.get('four_step_cot', {}).get('single_turn', False))
     ]
 
     # TODO: Remove this when running large-scale evaluation.
     dual_groups = dual_groups[:10]
 
     final_results = {}
-    first_round_responses = first_round_speak_up(
+    if budget is not None:
+        budget.reserve([(member.__class__.__name__, 'first_round_speak_up') for member in members], len(dual_groups))
+    first_round_responses, settled = first_round_speak_up(
         dual_groups=dual_groups,
         members=members,
         cache=cache,
         output_base=output_base,
-        pid=pid)
+        pid=pid,
+        cascade=cascade)
+    if budget is not None:
+        budget.settle()
+
+    # Instances the cascade settled skip the refine rounds; their answer is the agreed one.
+    for dual_group in dual_groups:
+        _, target_group = dual_group
+        instance, expected_value, _, processed_assertion = target_group
+        if instance.id not in settled:
+            continue
+        responses_for_record = {member_id: histories[instance.id]
+                                for member_id, histories in first_round_responses.items()
+                                if instance.id in histories}
+        final_results[instance.id] = {
+            'focal_method': instance.focal_method,
+            'test_case': instance.test_case,
+            'expected_value': expected_value,
+            'processed_assertion': processed_assertion,
+            'response': next(iter(responses_for_record.values()))[-1].get('content', '').strip(),
+            'complete_responses': responses_for_record,
+            'cascade': settled[instance.id],
+        }
 
     refined_responses = None
     response_histories = first_round_responses
     maximum_retries = 0
-    last_round_groups_to_refine = dual_groups
+    last_round_groups_to_refine = [dual_group for dual_group in dual_groups
+                                   if dual_group[1][0].id not in settled]
 
     while maximum_retries > 0:
         # 判断是否达到了一致, 达到一致为止，或者达到最大迭代次数为止。
@@ -73,8 +105,7 @@ def discussion(dual_groups, cache, pid, output_base):
                 member_id = member.__class__.__name__
                 response = response_histories[member_id][instance.id][-1].get(
                     'content', '').strip()
-                responses_for_record[member_id] = pickle.loads(
-                    pickle.dumps(response_histories[member_id][instance.id]))
+                responses_for_record[member_id] = response_histories[member_id][instance.id]
                 response_set.add(response)
                 current_round_responses[instance.id][member_id] = response
 
@@ -82,15 +113,29 @@ def discussion(dual_groups, cache, pid, output_base):
             if len(response_set) == 1:
                 # 如果一致，那么记录这个一致的结果
                 final_results[instance.id] = {
-                    'focal_method': pickle.loads(pickle.dumps(instance.focal_method)),
-                    'test_case': pickle.loads(pickle.dumps(instance.test_case)),
-                    'expected_value': pickle.loads(pickle.dumps(expected_value)),
-                    'processed_assertion': pickle.loads(pickle.dumps(processed_assertion)),
+                    'focal_method': instance.focal_method,
+                    'test_case': instance.test_case,
+                    'expected_value': expected_value,
+                    'processed_assertion': processed_assertion,
                     'response': response_set.pop(),
-                    'complete_responses': pickle.loads(pickle.dumps(responses_for_record)),
+                    'complete_responses': responses_for_record,
                 }
                 response_set.clear()
                 pass
+            elif budget is not None and not budget.allow(
+                    [(member.__class__.__name__, 'refine') for member in members]):
+                # Out of budget, the weighted vote over the answers of the last round decides, as in
+                # RoundTableDiscussion.
+                assertion = voter.vote_answers(current_round_responses[instance.id])
+                final_results[instance.id] = {
+                    'focal_method': instance.focal_method,
+                    'test_case': instance.test_case,
+                    'expected_value': expected_value,
+                    'processed_assertion': processed_assertion,
+                    'response': f'```java\n{assertion}\n```',
+                    'complete_responses': responses_for_record,
+                    'decided_by': 'budget',
+                }
             else:
                 # 如果不一致，那么记录这个不一致的case，后续进行refine。
                 dual_groups_to_refine.append(dual_group)
@@ -100,9 +145,10 @@ def discussion(dual_groups, cache, pid, output_base):
                 f'{len(dual_groups_to_refine)} need to be refined. {maximum_retries} rounds remains.')
             refined_responses = refine(dual_groups_to_refine, members, response_histories, current_round_responses,
                                        output_base, pid)
-            response_histories = pickle.loads(pickle.dumps(refined_responses))
-            last_round_groups_to_refine = pickle.loads(
-                pickle.dumps(dual_groups_to_refine))
+            if budget is not None:
+                budget.settle()
+            response_histories = refined_responses
+            last_round_groups_to_refine = list(dual_groups_to_refine)
             dual_groups_to_refine.clear()
             continue
         else:
@@ -120,18 +166,17 @@ def discussion(dual_groups, cache, pid, output_base):
                 member_id = member.__class__.__name__
                 response = refined_responses[member_id][instance.id][-1].get(
                     'content', '').strip()
-                responses_for_record[member_id] = pickle.loads(
-                    pickle.dumps(refined_responses[member_id][instance.id]))
+                responses_for_record[member_id] = refined_responses[member_id][instance.id]
                 voting[response] += 1
 
             final_answer = voting.most_common(1)[0][0]
             final_results[instance.id] = {
-                'focal_method': pickle.loads(pickle.dumps(instance.focal_method)),
-                'test_case': pickle.loads(pickle.dumps(instance.test_case)),
-                'expected_value': pickle.loads(pickle.dumps(expected_value)),
-                'processed_assertion': pickle.loads(pickle.dumps(processed_assertion)),
-                'response': pickle.loads(pickle.dumps(final_answer)),
-                'complete_responses': pickle.loads(pickle.dumps(responses_for_record)),
+                'focal_method': instance.focal_method,
+                'test_case': instance.test_case,
+                'expected_value': expected_value,
+                'processed_assertion': processed_assertion,
+                'response': final_answer,
+                'complete_responses': responses_for_record,
             }
 
     with open(os.path.join(code_base, f'results/no_judge-{pid}-results.jsonl'), 'w', encoding='utf-8') as writer:
@@ -141,11 +186,21 @@ def discussion(dual_groups, cache, pid, output_base):
     pass
 
 
-def first_round_speak_up(dual_groups, members, cache, output_base, pid) -> dict:
+def first_round_speak_up(dual_groups, members, cache, output_base, pid, cascade=None) -> tuple:
+    """
+    Runs every member on every instance, member by member. With a `cascade`, members run in its stage order and an
+    instance whose answers agree after a stage is not given to the later members.
+
+    Returns the member histories and the settled instances (id to agreed assertion, stage and skipped members).
+    """
     # try:
     logger.info(f'PID {pid} has {len(dual_groups)} instance to process.')
     responses = {}
-    for member in members:
+    settled = {}
+    members_by_id = {member.__class__.__name__: member for member in members}
+    stages = cascade.plan(list(members_by_id)) if cascade is not None else [list(members_by_id)]
+    stage_ends = {stage[-1]: stage_idx for stage_idx, stage in enumerate(stages)}
+    for member in [members_by_id[member_id] for stage in stages for member_id in stage]:
         member_id = member.__class__.__name__
         responses[member_id] = {}
         writer = open(
@@ -158,6 +213,8 @@ def first_round_speak_up(dual_groups, members, cache, output_base, pid) -> dict:
                 'member': member_id
             }
             instance, expected_value, raw_assertion, processed_assertion = target_group
+            if instance.id in settled:
+                continue
             focal_method = instance.focal_method
             test_case = instance.test_case
             test_prefix = instance.test_prefix
@@ -194,62 +251,70 @@ def first_round_speak_up(dual_groups, members, cache, output_base, pid) -> dict:
             focal_class_methods = [m for m in instance.focal_class_methods if
                                     'public' in m]
             test_class_fields = [f for f in instance.test_class_fields]
-            if expected_value in ['assertTrue','assertFalse']:
-                response = member.generate_assertBoolean(
-                    focal_method_name=instance.focal_method_name,
-                    focal_method=focal_method,
-                    focal_class_fields=focal_class_fields,
-                    focal_class_methods=focal_class_methods,
-                    test_class_fields=test_class_fields,
-                    test_prefix=test_prefix,
-                    retrieved_test_case=retrieved_test_case,
-                    retrieved_focal_method=retrieved_focal_method,
-                    cot_cache=cache,
-                    expected_value_type=expected_value_type,
-                    actual_value=instance.actual_value,
-                    prefix=False
-                )
-            elif expected_value in ['assertNull', 'assertNotNull']:
-                response = member.generate_assertNullValue(
-                    focal_method_name=instance.focal_method_name,
-                    focal_method=focal_method,
-                    focal_class_fields=focal_class_fields,
-                    focal_class_methods=focal_class_methods,
-                    test_class_fields=test_class_fields,
-                    test_prefix=test_prefix,
-                    retrieved_test_case=retrieved_test_case,
-                    retrieved_focal_method=retrieved_focal_method,
-                    cot_cache=cache,
-                    expected_value_type=expected_value_type,
-                    actual_value = instance.actual_value,
-                    prefix=False
-                )
-            else:
-                response = member.generate_assertEquals(
-                    focal_method_name=instance.focal_method_name,
-                    focal_method=focal_method,
-                    focal_class_fields=focal_class_fields,
-                    focal_class_methods=focal_class_methods,
-                    test_class_fields=test_class_fields,
-                    # test_class_methods = test_class_methods,
-                    test_prefix=test_prefix,
-                    retrieved_test_case=retrieved_test_case,
-                    retrieved_focal_method=retrieved_focal_method,
-                    # retrieved_test_prefix=retrieved_test_prefix,
-                    # retrieved_ground_truth=retrieved_expected_value,
-                    cot_cache=cache,
-                    expected_value_type=expected_value_type,
-                    actual_value=instance.actual_value,
-                    prefix=False
-                )
+            with call_tags(agent=member_id, round='first_round_speak_up', instance_id=instance.id,
+                           assertion_type=assertion_type_tag(expected_value)):
+                if expected_value in ['assertTrue','assertFalse']:
+                    response = member.generate_assertBoolean(
+                        focal_method_name=instance.focal_method_name,
+                        focal_method=focal_method,
+                        focal_class_fields=focal_class_fields,
+                        focal_class_methods=focal_class_methods,
+                        test_class_fields=test_class_fields,
+                        test_prefix=test_prefix,
+                        retrieved_test_case=retrieved_test_case,
+                        retrieved_focal_method=retrieved_focal_method,
+                        cot_cache=cache,
+                        expected_value_type=expected_value_type,
+                        actual_value=instance.actual_value,
+                        prefix=False
+                    )
+                elif expected_value in ['assertNull', 'assertNotNull']:
+                    response = member.generate_assertNullValue(
+                        focal_method_name=instance.focal_method_name,
+                        focal_method=focal_method,
+                        focal_class_fields=focal_class_fields,
+                        focal_class_methods=focal_class_methods,
+                        test_class_fields=test_class_fields,
+                        test_prefix=test_prefix,
+                        retrieved_test_case=retrieved_test_case,
+                        retrieved_focal_method=retrieved_focal_method,
+                        cot_cache=cache,
+                        expected_value_type=expected_value_type,
+                        actual_value = instance.actual_value,
+                        prefix=False
+                    )
+                else:
+                    response = member.generate_assertEquals(
+                        focal_method_name=instance.focal_method_name,
+                        focal_method=focal_method,
+                        focal_class_fields=focal_class_fields,
+                        focal_class_methods=focal_class_methods,
+                        test_class_fields=test_class_fields,
+                        # test_class_methods = test_class_methods,
+                        test_prefix=test_prefix,
+                        retrieved_test_case=retrieved_test_case,
+                        retrieved_focal_method=retrieved_focal_method,
+                        # retrieved_test_prefix=retrieved_test_prefix,
+                        # retrieved_ground_truth=retrieved_expected_value,
+                        cot_cache=cache,
+                        expected_value_type=expected_value_type,
+                        actual_value=instance.actual_value,
+                        prefix=False
+                    )
             record_instance['history'] = member.history
 
             writer.write(json.dumps(record_instance,
                             ensure_ascii=False) + '\n')
-            responses[member_id][instance.id] = pickle.loads(
-                pickle.dumps(member.history))
+            responses[member_id][instance.id] = member.history
         writer.close()
-    return responses
+        if cascade is not None and member_id in stage_ends:
+            cascade.settle_stage([(target_group[0].id, target_group[1]) for _, target_group in dual_groups],
+                                 responses, settled, stages, stage_ends[member_id])
+    if cascade is not None:
+        for _, target_group in dual_groups:
+            if target_group[0].id not in settled:
+                cascade.observe(None)
+    return responses, settled
     # except:
     #     # In case there are unexpected errors, we need to dump the cache.
     #     dump_cache(code_base, dict(cache.cot_thoughts))
@@ -277,17 +342,18 @@ def refine(dual_groups, members, member_history, last_responses, output_base, pi
             local_variables = parse_variables(instance.test_case)
             member.clear_history()
             member.update_history(history[instance.id])
-            member.refine_no_judge(
-                prev_responses=prev_responses,
-                test_case_local_variables=local_variables,
+            with call_tags(agent=member_id, round='refine', instance_id=instance.id,
+                           assertion_type=assertion_type_tag(expected_value)):
+                member.refine_no_judge(
+                    prev_responses=prev_responses,
+                    test_case_local_variables=local_variables,
 
-            )
+                )
             record_instance['history'] = member.history
             record_instance['expected_value'] = expected_value
             writer.write(json.dumps(record_instance,
                          ensure_ascii=False) + '\n')
-            responses[member_id][instance.id] = pickle.loads(
-                pickle.dumps(member.history))
+            responses[member_id][instance.id] = member.history
         writer.close()
     return responses
 
@@ -409,6 +475,7 @@ if __name__ == '__main__':
     if debug:
         discussion(chunks[4], cache, 0, output_base)
         dump_cache(code_base, dict(cache.cot_thoughts))
+        cache.log_stats()
         record_results(1)
         pass
     else:
@@ -422,6 +489,9 @@ if __name__ == '__main__':
         for job in jobs:
             job.join()
         dump_cache(code_base, dict(cache.cot_thoughts))
+        cache.log_stats()
         record_results(num_process)
 
+    if model.metrics is not None:
+        model.metrics.log_run_summary()
     pass
@@ -0,0 +1,44 @@
+import sys
+
+sys.path.extend(['.', '..'])
+import os
+import json
+import yaml
+from dotmap import DotMap
+from loguru import logger
+
+from utils.voting import load_candidates, load_weighted_voter, voting_accuracy
+
+code_base = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+with open(os.path.join(code_base, 'config/basic_config.yaml'), 'r') as reader:
+    config = DotMap(yaml.load(reader, Loader=yaml.FullLoader))
+voter = load_weighted_voter(config)
+
+
+def write_results(instances: dict, results: dict, output_file: str):
+    with open(output_file, 'w', encoding='utf-8') as writer:
+        for instance_id, result in results.items():
+            writer.write(json.dumps({
+                'id': instance_id,
+                'expected_value': instances[instance_id]['expected_value'],
+                'assertion': result['assertion'],
+                'score': result['score'],
+                'share': result['share'],
+                'agents': result['agents'],
+                'candidates': instances[instance_id]['candidates'],
+            }, ensure_ascii=False) + '\n')
+
+
+if __name__ == '__main__':
+    # Votes over the first-round answers instead of running the Debate/Judge rounds.
+    output_base = os.path.join(code_base, 'results/discussions/r1_distill_wo_prefill')
+    inputs = [os.path.join(output_base, name) for name in
+              config.get('voting', {}).get('inputs', ['first_round_speak_up-results.jsonl'])]
+
+    instances = load_candidates(inputs)
+    if len(instances) == 0:
+        logger.error(f'No candidates found in {inputs}.')
+        exit(-1)
+    results = voter.vote(instances)
+    write_results(instances, results, os.path.join(output_base, 'voting-results.jsonl'))
+    logger.info(f'Voting over {len(inputs)} result files: {voting_accuracy(instances, results)}')
@@ -9,20 +9,24 @@ from tqdm import tqdm
 from loguru import logger
 from collections import Counter
 from agents.Generator_Impls import NaiveGenerator, RAGGenerator, FourStepCoTGenerator
-from agents.base.llm import DeepSeek
+from agents.base.llm_factory import llm_factory
+from utils.llm_metrics import call_tags, assertion_type_tag
+from utils.agreement import load_consensus_cascade
 from utils.multi_processing_cache import load_cache, dump_cache
 from utils.java_parsers import parse_variables
 from data.base.dataset_factory import dataset_factory
 import yaml
 import multiprocessing
-import pickle
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 random.seed(888)
 
 code_base = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
 with open(os.path.join(code_base, 'config/basic_config.yaml'), 'r') as reader:
     config = DotMap(yaml.load(reader, Loader=yaml.FullLoader))
-model = DeepSeek(config)
+model = llm_factory(config)
+cascade = load_consensus_cascade(config)
 
 # if debugging mode.
 debug = True
@@ -30,134 +34,183 @@ debug = True
 
 def discussion(dual_groups, cache, pid, output_base):
     global debug
-    members = [
-        NaiveGenerator(model),
-        RAGGenerator(model),
-        FourStepCoTGenerator(model)
+    member_types = [
+        NaiveGenerator,
+        RAGGenerator,
+        FourStepCoTGenerator
     ]
 
     if debug:
         dual_groups = dual_groups[:10]
     first_round_speak_up(
         dual_groups=dual_groups,
-        members=members,
+        member_types=member_types,
         cache=cache,
         output_base=output_base,
         pid=pid
     )
 
 
-def first_round_speak_up(dual_groups, members, cache, output_base, pid) -> dict:
-    # try:
-    logger.info(f'PID {pid} has {len(dual_groups)} instance to process.')
-    responses = {}
-    for member in members:
-        member_id = member.__class__.__name__
-        responses[member_id] = {}
-        writer = open(
-            os.path.join(
-                output_base, f'first_round_speak_up-{member_id}-{pid}-results.jsonl'), 'w',
-            encoding='utf-8')
-        for retrieved_group, target_group in tqdm(dual_groups,
-                                                  desc=f'PID-{pid}: First round {member_id} is speaking up'):
-            record_instance = {
-                'member': member_id
-            }
-            instance, expected_value, raw_assertion, processed_assertion = target_group
-            focal_method = instance.focal_method
-            test_case = instance.test_case
-            test_prefix = instance.test_prefix
-            # local_variables = parse_variables(test_case)
-            record_instance['id'] = instance.id
-            record_instance['focal_method'] = focal_method
-            record_instance['test_case'] = test_case
-            record_instance['test_prefix'] = test_prefix
-            record_instance['retrieved_focal_method'] = ''
-            record_instance['retrieved_test_case'] = ''
-            record_instance['expected_value'] = expected_value
-            expected_value_type = 'boolean' if expected_value in [
-                'assertTrue', 'assertFalse'] else None
-            if retrieved_group is not None:
-                # retrieved_instance, retrieved_expected_value, retrieved_raw_assertion, retrieved_processed_assertion = retrieved_group
-                retrieved_instance, _, _, _ = retrieved_group
-                retrieved_focal_method = retrieved_instance.focal_method
-                retrieved_test_case = retrieved_instance.test_case
-                # retrieved_test_prefix = retrieved_test_case.replace(retrieved_raw_assertion,
-                #                                                     retrieved_processed_assertion)
-                record_instance['retrieved_focal_method'] = retrieved_focal_method
-                record_instance['retrieved_test_case'] = retrieved_test_case
-            else:
-                retrieved_focal_method = None
-                # retrieved_test_prefix = None
-                # retrieved_expected_value = None
-                retrieved_test_case = None
-
-            # focal_class_fields = [f.original_string for f in instance.focal_class_fields]
-            # focal_class_methods = [m.full_signature for m in instance.focal_class_methods if
-            #                        'public' in m.full_signature]
-            # test_class_fields = [f.original_string for f in instance.test_class.fields]
-            focal_class_fields = [f for f in instance.focal_class_fields]
-            focal_class_methods = [m for m in instance.focal_class_methods if
-                                   'public' in m]
-            test_class_fields = [f for f in instance.test_class_fields]
+def member_options(member_type) -> dict:
+    """
+    Constructor options of a member type beyond the model, read from the config.
+    """
+    if member_type is FourStepCoTGenerator:
+        return {'single_turn': config.get('four_step_cot', {}).get('single_turn', False)}
+    return {}
+
+
+def _instance_inputs(retrieved_group, target_group):
+    """
+    Builds the shared part of the record and the generator arguments of one instance.
+    """
+    instance, expected_value, raw_assertion, processed_assertion = target_group
+    record_instance = {
+        'id': instance.id,
+        'focal_method': instance.focal_method,
+        'test_case': instance.test_case,
+        'test_prefix': instance.test_prefix,
+        'retrieved_focal_method': '',
+        'retrieved_test_case': '',
+        'expected_value': expected_value
+    }
+    expected_value_type = 'boolean' if expected_value in [
+        'assertTrue', 'assertFalse'] else None
+    if retrieved_group is not None:
+        retrieved_instance, _, _, _ = retrieved_group
+        retrieved_focal_method = retrieved_instance.focal_method
+        retrieved_test_case = retrieved_instance.test_case
+        record_instance['retrieved_focal_method'] = retrieved_focal_method
+        record_instance['retrieved_test_case'] = retrieved_test_case
+    else:
+        retrieved_focal_method = None
+        retrieved_test_case = None
+    generate_kwargs = dict(
+        focal_method_name=instance.focal_method_name,
+        focal_method=instance.focal_method,
+        focal_class_fields=[f for f in instance.focal_class_fields],
+        focal_class_methods=[m for m in instance.focal_class_methods if 'public' in m],
+        test_class_fields=[f for f in instance.test_class_fields],
+        test_prefix=instance.test_prefix,
+        retrieved_test_case=retrieved_test_case,
+        retrieved_focal_method=retrieved_focal_method,
+        expected_value_type=expected_value_type,
+        actual_value=instance.actual_value,
+        prefix=False
+    )
+    return instance, expected_value, record_instance, generate_kwargs
+
+
+async def _speak_up(member, instance, expected_value, generate_kwargs, cache, semaphore):
+    member_id = member.__class__.__name__
+    async with semaphore:
+        with call_tags(agent=member_id, round='first_round_speak_up', instance_id=instance.id,
+                       assertion_type=assertion_type_tag(expected_value)):
             if expected_value in ['assertTrue', 'assertFalse']:
-                response = member.generate_assertBoolean(
-                    focal_method_name=instance.focal_method_name,
-                    focal_method=focal_method,
-                    focal_class_fields=focal_class_fields,
-                    focal_class_methods=focal_class_methods,
-                    test_class_fields=test_class_fields,
-                    test_prefix=test_prefix,
-                    retrieved_test_case=retrieved_test_case,
-                    retrieved_focal_method=retrieved_focal_method,
-                    cot_cache=cache,
-                    expected_value_type=expected_value_type,
-                    actual_value=instance.actual_value,
-                    prefix=False
-                )
+                await member.agenerate_assertBoolean(cot_cache=cache, **generate_kwargs)
             elif expected_value in ['assertNull', 'assertNotNull']:
-                response = member.generate_assertNullValue(
-                    focal_method_name=instance.focal_method_name,
-                    focal_method=focal_method,
-                    focal_class_fields=focal_class_fields,
-                    focal_class_methods=focal_class_methods,
-                    test_class_fields=test_class_fields,
-                    test_prefix=test_prefix,
-                    retrieved_test_case=retrieved_test_case,
-                    retrieved_focal_method=retrieved_focal_method,
-                    cot_cache=cache,
-                    expected_value_type=expected_value_type,
-                    actual_value=instance.actual_value,
-                    prefix=False
-                )
+                await member.agenerate_assertNullValue(cot_cache=cache, **generate_kwargs)
             else:
-                response = member.generate_assertEquals(
-                    focal_method_name=instance.focal_method_name,
-                    focal_method=focal_method,
-                    focal_class_fields=focal_class_fields,
-                    focal_class_methods=focal_class_methods,
-                    test_class_fields=test_class_fields,
-                    # test_class_methods = test_class_methods,
-                    test_prefix=test_prefix,
-                    retrieved_test_case=retrieved_test_case,
-                    retrieved_focal_method=retrieved_focal_method,
-                    # retrieved_test_prefix=retrieved_test_prefix,
-                    # retrieved_ground_truth=retrieved_expected_value,
-                    cot_cache=cache,
-                    expected_value_type=expected_value_type,
-                    actual_value=instance.actual_value,
-                    prefix=False
-                )
-            record_instance['history'] = member.history
-
-            writer.write(json.dumps(record_instance,
-                                    ensure_ascii=False) + '\n')
-            responses[member_id][instance.id] = pickle.loads(
-                pickle.dumps(member.history))
-        writer.close()
+                await member.agenerate_assertEquals(cot_cache=cache, **generate_kwargs)
+    return member
+
+
+async def _speak_up_instance(dual_group, member_types, cache, semaphore):
+    """
+    Runs the members on one instance. An error (retries exhausted, a cache miss in replay mode) is returned as the
+    last element instead of raised, so that one failing instance does not abort the others of the worker.
+    """
+    retrieved_group, target_group = dual_group
+    instance, expected_value, record_instance, generate_kwargs = _instance_inputs(retrieved_group, target_group)
+    # Every task gets its own generators, so concurrent instances never share a history.
+    members = [member_type(model, **member_options(member_type)) for member_type in member_types]
+    try:
+        if cascade is None:
+            members = await asyncio.gather(*[
+                _speak_up(member, instance, expected_value, generate_kwargs, cache, semaphore) for member in members])
+            return instance, record_instance, members, None, None
+        # Cascade: run the stages in order and stop as soon as the answers so far agree.
+        members_by_id = {member.__class__.__name__: member for member in members}
+        stages = cascade.plan(list(members_by_id))
+        finished = []
+        for stage_idx, stage in enumerate(stages):
+            finished += await asyncio.gather(*[
+                _speak_up(members_by_id[member_id], instance, expected_value, generate_kwargs, cache, semaphore)
+                for member_id in stage])
+            agreed = cascade.settle({member.__class__.__name__: member.history[-1].get('content', '')
+                                     for member in finished if len(member.history) != 0})
+            if agreed is not None:
+                skipped = [member_id for later in stages[stage_idx + 1:] for member_id in later]
+                cascade.observe(stage_idx, skipped, agreed, expected_value)
+                settled = {'assertion': agreed, 'stage': stage_idx, 'skipped': skipped}
+                return instance, record_instance, finished, settled, None
+        cascade.observe(None)
+        return instance, record_instance, finished, None, None
+    except Exception as e:
+        return instance, record_instance, members, None, e
+
+
+async def _first_round_speak_up(dual_groups, member_types, cache, output_base, pid) -> dict:
+    max_concurrency = config.get('first_round', {}).get('max_concurrency', 16)
+    # Blocking generator code runs in the default executor unless the model brings its own.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_concurrency))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    member_ids = [member_type.__name__ for member_type in member_types]
+    responses = {member_id: {} for member_id in member_ids}
+    writers = {member_id: open(
+        os.path.join(output_base, f'first_round_speak_up-{member_id}-{pid}-results.jsonl'), 'w',
+        encoding='utf-8') for member_id in member_ids}
+    combined_writer = open(os.path.join(output_base, f'first_round_speak_up-{pid}-results.jsonl'), 'w',
+                           encoding='utf-8')
+    error_writer = open(os.path.join(output_base, f'first_round_speak_up-error-{pid}.jsonl'), 'w', encoding='utf-8')
+    tasks = [asyncio.ensure_future(_speak_up_instance(dual_group, member_types, cache, semaphore))
+             for dual_group in dual_groups]
+    try:
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=f'PID-{pid}: First round speaking up'):
+            instance, record_instance, members, settled, error = await task
+            if error is not None:
+                logger.error(f'PID {pid}: first round of instance {instance.id} failed: {error!r}')
+                error_writer.write(json.dumps({
+                    'id': instance.id,
+                    'err_msg': str(error),
+                    'history': {member.__class__.__name__: member.history for member in members}
+                }, ensure_ascii=False) + '\n')
+                continue
+            combined_record = dict(record_instance, members={})
+            if settled is not None:
+                combined_record['cascade'] = settled
+            for member in members:
+                member_id = member.__class__.__name__
+                member_record = dict(member=member_id, **record_instance)
+                member_record['history'] = member.history
+                member_record['truncated'] = member.response_truncated
+                writers[member_id].write(json.dumps(member_record, ensure_ascii=False) + '\n')
+                combined_record['members'][member_id] = {
+                    'history': member.history,
+                    'truncated': member.response_truncated
+                }
+                responses[member_id][instance.id] = member.history
+            combined_writer.write(json.dumps(combined_record, ensure_ascii=False) + '\n')
+    finally:
+        for writer in writers.values():
+            writer.close()
+        combined_writer.close()
+        error_writer.close()
     return responses
 
 
+def first_round_speak_up(dual_groups, member_types, cache, output_base, pid) -> dict:
+    """
+    Runs every agent on every instance, instance by instance: the agents of one instance run concurrently, and
+    at most `first_round.max_concurrency` agent tasks are in flight across instances. Writes the per-member
+    record files and one combined record per instance. With `cascade` enabled, the agents of an instance run
+    stage by stage and the remaining stages are skipped once the answers agree. Instances that fail are logged to
+    the error record and left out of the results.
+    """
+    logger.info(f'PID {pid} has {len(dual_groups)} instance to process.')
+    return asyncio.run(_first_round_speak_up(dual_groups, member_types, cache, output_base, pid))
+
+
 def record_results(num_process: int):
     # First Round
 
@@ -182,6 +235,14 @@ def record_results(num_process: int):
     _merge_multiprocessing_record_files(num_process, first_round_rag_result,
                                         first_round_rag_result_formatter)
 
+    first_round_result = os.path.join(output_base, 'first_round_speak_up-results.jsonl')
+    first_round_result_formatter = os.path.join(output_base, 'first_round_speak_up-{}-results.jsonl')
+    _merge_multiprocessing_record_files(num_process, first_round_result, first_round_result_formatter)
+
+    error_result = os.path.join(output_base, 'first_round_speak_up-error-results.jsonl')
+    error_result_formatter = os.path.join(output_base, 'first_round_speak_up-error-{}.jsonl')
+    _merge_multiprocessing_record_files(num_process, error_result, error_result_formatter)
+
     pass
 
 
@@ -214,7 +275,9 @@ if __name__ == '__main__':
     output_base = os.path.join(code_base, 'results/discussions/r1_distill_wo_prefill')
     if not os.path.exists(output_base):
         os.makedirs(output_base)
-    num_process = 10
+    # The async backend keeps `first_round.max_concurrency` agent tasks in flight from one process, so the data is
+    # only split over forked worker processes for the blocking backends.
+    num_process = 1 if config.llm.get('backend', 'deepseek').lower() == 'async_deepseek' else 10
     num_per_chunk = len(data) // num_process
     num_per_chunk += 1
     chunks = [data[i * num_per_chunk: (i + 1) * num_per_chunk]
@@ -222,10 +285,16 @@ if __name__ == '__main__':
     assert len(chunks) == num_process
 
     if debug:
-        discussion(chunks[4], cache, 0, output_base)
+        discussion(chunks[min(4, num_process - 1)], cache, 0, output_base)
         dump_cache(code_base, dict(cache.cot_thoughts))
+        cache.log_stats()
         record_results(1)
         pass
+    elif num_process == 1:
+        discussion(chunks[0], cache, 0, output_base)
+        dump_cache(code_base, dict(cache.cot_thoughts))
+        cache.log_stats()
+        record_results(1)
     else:
         jobs = []
         for pid, chunk in enumerate(chunks):
@@ -237,6 +306,9 @@ if __name__ == '__main__':
         for job in jobs:
             job.join()
         dump_cache(code_base, dict(cache.cot_thoughts))
+        cache.log_stats()
         record_results(num_process)
 
+    if model.metrics is not None:
+        model.metrics.log_run_summary()
     pass
@@ -0,0 +1,111 @@
+import sys
+
+sys.path.extend(['.', '..'])
+import os
+import json
+import random
+import yaml
+from dotmap import DotMap
+from tqdm import tqdm
+from loguru import logger
+
+from agents.Generator_Impls import NaiveGenerator, RAGGenerator, FourStepCoTGenerator
+from agents.base.llm_factory import llm_factory
+from utils.llm_metrics import call_tags, assertion_type_tag
+from utils.multi_processing_cache import load_cache
+from data.base.dataset_factory import dataset_factory
+
+random.seed(888)
+
+code_base = os.path.abspath(os.path.join(os.path.dirname(__file__), '../'))
+with open(os.path.join(code_base, 'config/basic_config.yaml'), 'r') as reader:
+    config = DotMap(yaml.load(reader, Loader=yaml.FullLoader))
+model = llm_factory(config)
+
+# if debugging mode.
+debug = True
+
+
+def _generate_kwargs(retrieved_group, instance, expected_value) -> dict:
+    if retrieved_group is not None:
+        retrieved_instance, _, _, _ = retrieved_group
+        retrieved_focal_method = retrieved_instance.focal_method
+        retrieved_test_case = retrieved_instance.test_case
+    else:
+        retrieved_focal_method = None
+        retrieved_test_case = None
+    return dict(
+        focal_method_name=instance.focal_method_name,
+        focal_method=instance.focal_method,
+        focal_class_fields=[f for f in instance.focal_class_fields],
+        focal_class_methods=[m for m in instance.focal_class_methods if 'public' in m],
+        test_class_fields=[f for f in instance.test_class_fields],
+        test_prefix=instance.test_prefix,
+        retrieved_test_case=retrieved_test_case,
+        retrieved_focal_method=retrieved_focal_method,
+        expected_value_type='boolean' if expected_value in ['assertTrue', 'assertFalse'] else None,
+        actual_value=instance.actual_value,
+        prefix=False
+    )
+
+
+def multiple_speak_up(dual_groups, member_types, cache, output_base):
+    """
+    Samples several answers of every member on every instance with the `generate_*_multiple` methods and writes
+    one record per member and instance, with the sampled `responses` and their `probs` (0-100 confidences), for
+    scripts/Voting.py. Instances that fail are logged to the error record and left out.
+    """
+    writer = open(os.path.join(output_base, 'multiple_speak_up-results.jsonl'), 'w', encoding='utf-8')
+    error_writer = open(os.path.join(output_base, 'multiple_speak_up-error-results.jsonl'), 'w', encoding='utf-8')
+    for retrieved_group, target_group in tqdm(dual_groups, desc='Sampling multiple answers'):
+        instance, expected_value, _, _ = target_group
+        generate_kwargs = _generate_kwargs(retrieved_group, instance, expected_value)
+        for member_type in member_types:
+            member = member_type(model)
+            member_id = member_type.__name__
+            try:
+                with call_tags(agent=member_id, round='multiple_speak_up', instance_id=instance.id,
+                               assertion_type=assertion_type_tag(expected_value)):
+                    if expected_value in ['assertTrue', 'assertFalse']:
+                        responses, probs = member.generate_assertBoolean_multiple(cot_cache=cache, **generate_kwargs)
+                    elif expected_value in ['assertNull', 'assertNotNull']:
+                        responses, probs = member.generate_assertNullValue_multiple(cot_cache=cache,
+                                                                                    **generate_kwargs)
+                    else:
+                        responses, probs = member.generate_assertEquals_multiple(cot_cache=cache, **generate_kwargs)
+            except Exception as e:
+                logger.error(f'Sampling {member_id} on instance {instance.id} failed: {e!r}')
+                error_writer.write(json.dumps({
+                    'id': instance.id,
+                    'member': member_id,
+                    'err_msg': str(e)
+                }, ensure_ascii=False) + '\n')
+                continue
+            writer.write(json.dumps({
+                'id': instance.id,
+                'member': member_id,
+                'expected_value': expected_value,
+                'responses': list(responses),
+                'probs': list(probs)
+            }, ensure_ascii=False) + '\n')
+    writer.close()
+    error_writer.close()
+
+
+if __name__ == '__main__':
+    dataset = 'defects4j'
+
+    ds = dataset_factory(config, dataset)
+    data = ds.load_retrieval_data(top_k=1)
+    cache = load_cache(code_base)
+
+    # randomly sample data for inferencing
+    random.shuffle(data)
+    if debug:
+        data = data[:10]
+
+    # Next to the first-round records, so that voting.inputs can list both.
+    output_base = os.path.join(code_base, 'results/discussions/r1_distill_wo_prefill')
+    if not os.path.exists(output_base):
+        os.makedirs(output_base)
+    multiple_speak_up(data, [NaiveGenerator, RAGGenerator, FourStepCoTGenerator], cache, output_base)
@@ -0,0 +1,118 @@
+import os
+import atexit
+import threading
+
+from loguru import logger
+
+from utils.confidence import merge_candidates
+
+
+class AdaptiveSampler():
+    """
+    Draws multi-sample responses in batches of `batch_size` and stops as soon as one normalized assertion holds
+    `vote_share` of the votes or `mass_share` of the probability mass of all samples (those without an assertion
+    included), after at least `min_samples` samples. A single sample never stops the sampling on its own.
+
+    No more than `max_samples` (or the caller's `best_of`, if smaller) samples are ever drawn. Easy instances,
+    where the first batch already agrees, cost one batch instead of the full `best_of`.
+    """
+
+    def __init__(self, batch_size: int = 3, min_samples: int = 3, max_samples: int = 10, vote_share: float = 0.7,
+                 mass_share: float = 0.7):
+        self.batch_size = batch_size
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.vote_share = vote_share
+        self.mass_share = mass_share
+        self._lock = threading.Lock()
+        self.requested = 0
+        self.drawn = 0
+        atexit.register(self.log_stats)
+
+    def converged(self, responses, probs) -> bool:
+        if len(responses) < self.min_samples:
+            return False
+        # Samples without an assertion share the empty key, but they never agree with anything. They still count
+        # towards both totals, so that one valid sample among garbage cannot hold the whole share.
+        candidates = [c for c in merge_candidates(responses, probs) if c['assertion']]
+        if len(candidates) == 0:
+            return False
+        top_votes = max(c['votes'] for c in candidates)
+        if top_votes >= 2 and top_votes / len(responses) >= self.vote_share:
+            return True
+        total_mass = sum(probs) / 100
+        # Candidates are sorted by mass.
+        top = candidates[0]
+        return top['votes'] >= 2 and total_mass > 0 and top['mass'] / total_mass >= self.mass_share
+
+    def _next_batch(self, drawn, cap) -> int:
+        return min(self.batch_size, cap - drawn)
+
+    def _record(self, best_of, responses):
+        with self._lock:
+            self.requested += best_of
+            self.drawn += len(responses)
+
+    def sample(self, draw, best_of: int, allow_more=None):
+        """
+        Calls `draw(n, batch)` for batches of `n` samples until the answers converge, or until `allow_more()`
+        (asked before every batch after the first) turns them down. Returns `(responses, probs)`.
+        """
+        cap = min(best_of, self.max_samples)
+        responses, probs = [], []
+        batch = 0
+        while len(responses) < cap:
+            if batch != 0 and allow_more is not None and not allow_more():
+                break
+            batch_responses, batch_probs = draw(self._next_batch(len(responses), cap), batch)
+            if len(batch_responses) == 0:
+                break
+            responses += list(batch_responses)
+            probs += list(batch_probs)
+            batch += 1
+            if self.converged(responses, probs):
+                break
+        self._record(best_of, responses)
+        return responses, probs
+
+    async def asample(self, adraw, best_of: int, allow_more=None):
+        cap = min(best_of, self.max_samples)
+        responses, probs = [], []
+        batch = 0
+        while len(responses) < cap:
+            if batch != 0 and allow_more is not None and not allow_more():
+                break
+            batch_responses, batch_probs = await adraw(self._next_batch(len(responses), cap), batch)
+            if len(batch_responses) == 0:
+                break
+            responses += list(batch_responses)
+            probs += list(batch_probs)
+            batch += 1
+            if self.converged(responses, probs):
+                break
+        self._record(best_of, responses)
+        return responses, probs
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'requested': self.requested,
+                'drawn': self.drawn,
+                'saved': round(1 - self.drawn / self.requested, 4) if self.requested else 0.0,
+            }
+
+    def log_stats(self) -> None:
+        if self.requested != 0:
+            logger.info(f'Adaptive sampling of PID {os.getpid()}: {self.stats()}')
+
+
+def load_adaptive_sampler(llm_config):
+    sampling_config = llm_config.get('adaptive_sampling', {})
+    if not sampling_config or not sampling_config.get('enabled', False):
+        return None
+    return AdaptiveSampler(
+        batch_size=sampling_config.get('batch_size', 3),
+        min_samples=sampling_config.get('min_samples', 3),
+        max_samples=sampling_config.get('max_samples', 10),
+        vote_share=sampling_config.get('vote_share', 0.7),
+        mass_share=sampling_config.get('mass_share', 0.7))
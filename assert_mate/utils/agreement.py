@@ -0,0 +1,373 @@
+import os
+import re
+import json
+import atexit
+import threading
+from collections import Counter
+
+from loguru import logger
+
+from utils.postprocessing import extract_assertion_from_response, get_normalized_ast
+
+
+def extract_assertion(response: str) -> str:
+    """
+    `extract_assertion_from_response` that returns '' instead of raising on answers without an assertion.
+    """
+    try:
+        return extract_assertion_from_response(response)
+    except (IndexError, AttributeError):
+        return ''
+
+
+# Assertions that answer the same question with opposite results.
+OPPOSITE_ASSERTIONS = {'assertTrue', 'assertFalse', 'assertNull', 'assertNotNull', 'assertSame', 'assertNotSame',
+                       'assertEquals', 'assertNotEquals'}
+
+# Assertions whose floating-point overloads take a `delta`.
+DELTA_ASSERTIONS = {'assertEquals', 'assertNotEquals', 'assertArrayEquals'}
+
+_INTEGER = re.compile(r'(0[xX][0-9a-fA-F]+|0[bB][01]+|0[0-7]+|[0-9]+)[lL]?')
+_FLOATING = re.compile(r'([0-9]+\.[0-9]*|\.[0-9]+|[0-9]+)([eE][+-]?[0-9]+)?[fFdD]?')
+
+
+def normalize_literal(value: str) -> str:
+    """
+    Canonical spelling of a Java literal, so that `10L`, `0xA` and `1_0` compare equal, as do `1.50` and `1.5d`.
+    String, char, boolean and null literals are returned as they are.
+    """
+    if not isinstance(value, str) or value.startswith(('"', "'")):
+        return value
+    text = value.replace('_', '')
+    if _INTEGER.fullmatch(text):
+        digits = text.rstrip('lL')
+        if digits[:2] in ('0x', '0X', '0b', '0B'):
+            return str(int(digits, 0))
+        return str(int(digits, 8)) if len(digits) > 1 and digits[0] == '0' else str(int(digits))
+    if _FLOATING.fullmatch(text):
+        return repr(float(text.rstrip('fFdD')))
+    return value
+
+
+def _canonical(tree, replace):
+    # Trees come from `ast_to_tuple`: (node type, attributes, children), where the children hold the attribute
+    # values in a fixed order and the attributes also keep raw javalang nodes. The canonical form keeps only the node
+    # types and children, with the scalar attributes `replace(node_type, attributes)` returns swapped in.
+    if isinstance(tree, list):
+        return tuple(_canonical(child, replace) for child in tree)
+    if isinstance(tree, tuple) and len(tree) == 3 and isinstance(tree[1], dict):
+        node_type, attributes, children = tree
+        swapped = {id(attributes[name]): value for name, value in replace(node_type, attributes).items()}
+        return node_type, tuple(swapped[id(child)] if id(child) in swapped else _canonical(child, replace)
+                                for child in children)
+    return tree
+
+
+def _literal_kind(node) -> str | None:
+    # 'integer', 'floating' or 'string' for a literal node of `ast_to_tuple`, None for anything else.
+    if not (isinstance(node, tuple) and len(node) == 3 and node[0] == 'Literal'):
+        return None
+    value = node[1].get('value')
+    if not isinstance(value, str):
+        return None
+    if value.startswith('"'):
+        return 'string'
+    text = value.replace('_', '')
+    if _INTEGER.fullmatch(text):
+        return 'integer'
+    if _FLOATING.fullmatch(text):
+        return 'floating'
+    return None
+
+
+def _has_delta(arguments) -> bool:
+    # JUnit 4 puts the message first (`message, expected, actual[, delta]`), JUnit 5 last (`expected, actual[,
+    # delta], message`): four arguments always hold a delta, three unless one end is a message.
+    kinds = [_literal_kind(argument) for argument in arguments]
+    if len(arguments) == 4:
+        return True
+    return len(arguments) == 3 and kinds[0] != 'string' and kinds[-1] != 'string'
+
+
+def _floating_literals(tree) -> set:
+    """
+    The integer literal arguments (by `id` of their attributes) of the floating-point assertions in `tree`, those
+    called with a delta, where `1` and `1.0` mean the same.
+    """
+    found = set()
+    if isinstance(tree, list):
+        for child in tree:
+            found |= _floating_literals(child)
+    elif isinstance(tree, tuple) and len(tree) == 3 and isinstance(tree[1], dict):
+        node_type, attributes, children = tree
+        if node_type == 'MethodInvocation' and attributes.get('member') in DELTA_ASSERTIONS:
+            # The children hold the attribute values in the order of the attributes.
+            arguments = children[list(attributes).index('arguments')] or []
+            if _has_delta(arguments):
+                found |= {id(argument[1]) for argument in arguments if _literal_kind(argument) == 'integer'}
+        for child in children:
+            found |= _floating_literals(child)
+    return found
+
+
+def _normalize_literals(node_type, attributes, floating=frozenset()) -> dict:
+    if node_type == 'Literal' and isinstance(attributes.get('value'), str):
+        value = normalize_literal(attributes['value'])
+        return {'value': repr(float(value)) if id(attributes) in floating else value}
+    return {}
+
+
+def _mask_answers(node_type, attributes) -> dict:
+    # Blanks what an answer is made of (literal values and the polarity of the assertion), keeping its shape.
+    if node_type == 'Literal' and isinstance(attributes.get('value'), str):
+        return {'value': '<literal>'}
+    if node_type == 'MethodInvocation' and attributes.get('member') in OPPOSITE_ASSERTIONS:
+        return {'member': '<assertion>'}
+    return {}
+
+
+def parse_assertion(assertion: str):
+    if not assertion:
+        return None
+    return get_normalized_ast(assertion.strip().rstrip(';'))
+
+
+def assertion_tree(assertion: str):
+    """
+    Canonical, hashable AST of an extracted assertion with normalized literals, or None if it does not parse.
+    Integer arguments of an assertion with a delta take the floating-point form, so `assertEquals(1, x, 0.01)` and
+    `assertEquals(1.0, x, 0.01)` share one tree.
+    """
+    tree = parse_assertion(assertion)
+    if tree is None:
+        return None
+    floating = _floating_literals(tree)
+    return _canonical(tree, lambda node_type, attributes: _normalize_literals(node_type, attributes, floating))
+
+
+def assertion_key(assertion: str):
+    """
+    Comparable form of an extracted assertion: its normalized AST (see `assertion_tree`) if it parses as a Java
+    expression, otherwise the whitespace-normalized text itself. None for an empty assertion.
+    """
+    if not assertion:
+        return None
+    tree = assertion_tree(assertion)
+    return tree if tree is not None else assertion
+
+
+def agreed_assertion(responses, min_agreement: int = 2, min_share: float = 1.0) -> str | None:
+    """
+    The assertion shared by at least `min_agreement` of the raw `responses` and by at least `min_share` of them,
+    or None. Answers without an assertion count against the share but never agree with anything.
+    """
+    if len(responses) == 0:
+        return None
+    votes = Counter()
+    first = {}
+    for response in responses:
+        assertion = extract_assertion(response)
+        key = assertion_key(assertion)
+        if key is None:
+            continue
+        votes[key] += 1
+        first.setdefault(key, assertion)
+    if len(votes) == 0:
+        return None
+    key, count = votes.most_common(1)[0]
+    if count < min_agreement or count / len(responses) < min_share:
+        return None
+    return first[key]
+
+
+def assertion_matches(expected_value: str, assertion: str) -> bool:
+    """
+    Whether an assertion contains the expected value, the same check as the evaluation scripts.
+    """
+    if expected_value in assertion:
+        return True
+    return (expected_value == 'true' and 'assertTrue' in assertion) or \
+        (expected_value == 'false' and 'assertFalse' in assertion)
+
+
+class AgreementEngine():
+    """
+    Decides locally whether the members of a discussion give the same answer, which is the question the Judge's
+    first verdict answers.
+
+    `decide` returns ('YES', assertion) when every answer normalizes to the same assertion and ('NO', None) when
+    all answers parse and differ only in their literals or in the polarity of the assertion (e.g. `assertTrue`
+    against `assertFalse`), where the answers plainly contradict each other. Anything else (an answer without an
+    assertion, or answers of different shapes that may still be equivalent, like `3` and `list.size()`) is
+    (None, None) and left to the Judge.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.decisions = Counter()
+        atexit.register(self.log_stats)
+
+    def _count(self, decision):
+        with self._lock:
+            self.decisions[decision] += 1
+
+    def decide(self, responses: dict) -> tuple:
+        assertions = [extract_assertion(response or '') for response in responses.values()]
+        if len(assertions) == 0 or any(assertion == '' for assertion in assertions):
+            self._count('ambiguous')
+            return None, None
+        trees = [parse_assertion(assertion) for assertion in assertions]
+        keys = {_canonical(tree, _normalize_literals) if tree is not None else assertion
+                for tree, assertion in zip(trees, assertions)}
+        if len(keys) == 1:
+            self._count('yes')
+            return 'YES', assertions[0]
+        if all(tree is not None for tree in trees) and \
+                len({_canonical(tree, _mask_answers) for tree in trees}) == 1:
+            self._count('no')
+            return 'NO', None
+        self._count('ambiguous')
+        return None, None
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = sum(self.decisions.values())
+            return {
+                'instances': total,
+                'yes': self.decisions['yes'],
+                'no': self.decisions['no'],
+                'ambiguous': self.decisions['ambiguous'],
+                'decided_ratio': round((total - self.decisions['ambiguous']) / total, 4) if total else 0.0,
+            }
+
+    def log_stats(self) -> None:
+        if sum(self.decisions.values()) != 0:
+            logger.info(f'Agreement engine of PID {os.getpid()}: {self.stats()}')
+
+
+class ConsensusCascade():
+    """
+    Runs the members of a discussion in `stages` and settles an instance as soon as the answers given so far
+    agree (see `agreed_assertion`). A settled instance skips the members of the later stages and the
+    refine/debate/judge rounds.
+
+    Members that no stage names run in one extra last stage, so every member of a discussion still runs on the
+    instances that stay unsettled. Outcomes are counted per process and logged at exit: how many instances each
+    stage settled, how many member calls were skipped and how often a settled answer was correct.
+    """
+
+    def __init__(self, stages: list, min_agreement: int = 2, min_share: float = 1.0):
+        self.stages = [list(stage) for stage in stages]
+        self.min_agreement = min_agreement
+        self.min_share = min_share
+        self._lock = threading.Lock()
+        self.instances = 0
+        self.settled_by_stage = Counter()
+        self.skipped_calls = Counter()
+        self.settled_scored = 0
+        self.settled_correct = 0
+        atexit.register(self.log_stats)
+
+    def plan(self, member_ids) -> list:
+        """
+        The stages restricted to `member_ids`, in order, with the members no stage names appended as a last stage.
+        """
+        stages = [[m for m in stage if m in member_ids] for stage in self.stages]
+        staged = {m for stage in stages for m in stage}
+        rest = [m for m in member_ids if m not in staged]
+        stages = [stage for stage in stages if len(stage) != 0]
+        if len(rest) != 0:
+            stages.append(rest)
+        return stages
+
+    def settle(self, responses: dict) -> str | None:
+        """
+        The agreed assertion of `responses` (member id to its latest answer), or None if they do not agree yet.
+        """
+        return agreed_assertion(list(responses.values()), self.min_agreement, self.min_share)
+
+    def settle_stage(self, instances, responses: dict, settled: dict, stages: list, stage_idx: int) -> None:
+        """
+        Settles the `(instance_id, expected_value)` pairs of member-major runs after `stages[stage_idx]` has
+        answered them all. `responses` maps member ids to histories by instance id; newly settled instances are
+        added to `settled`.
+        """
+        skipped = [member_id for later in stages[stage_idx + 1:] for member_id in later]
+        for instance_id, expected_value in instances:
+            if instance_id in settled:
+                continue
+            agreed = self.settle({member_id: histories[instance_id][-1].get('content', '')
+                                  for member_id, histories in responses.items() if instance_id in histories})
+            if agreed is not None:
+                settled[instance_id] = {'assertion': agreed, 'stage': stage_idx, 'skipped': skipped}
+                self.observe(stage_idx, skipped, agreed, expected_value)
+
+    def observe(self, stage: int | None, skipped=(), assertion: str | None = None,
+                expected_value: str | None = None) -> None:
+        """
+        Records one instance: the stage that settled it (None if it stayed unsettled) and the members it skipped.
+        """
+        with self._lock:
+            self.instances += 1
+            if stage is None:
+                return
+            self.settled_by_stage[stage] += 1
+            for member_id in skipped:
+                self.skipped_calls[member_id] += 1
+            if expected_value is not None and assertion is not None:
+                self.settled_scored += 1
+                self.settled_correct += int(assertion_matches(expected_value, assertion))
+
+    def stats(self) -> dict:
+        with self._lock:
+            settled = sum(self.settled_by_stage.values())
+            return {
+                'instances': self.instances,
+                'settled': settled,
+                'settled_ratio': round(settled / self.instances, 4) if self.instances else 0.0,
+                'settled_by_stage': dict(self.settled_by_stage),
+                'skipped_calls': dict(self.skipped_calls),
+                'settled_accuracy': round(self.settled_correct / self.settled_scored, 4) if self.settled_scored
+                else None,
+            }
+
+    def log_stats(self) -> None:
+        if self.instances != 0:
+            logger.info(f'Consensus cascade of PID {os.getpid()}: {self.stats()}')
+
+
+def load_settled_instances(results_file: str) -> dict:
+    """
+    The instances the cascade settled in a RoundTableDiscussion_No_Judge run, read from its merged results
+    (`no_judge-results.jsonl`), as instance id to the `cascade` outcome. The members the cascade skipped wrote no
+    first-round record for these instances.
+    """
+    settled = {}
+    if not os.path.exists(results_file):
+        return settled
+    with open(results_file, 'r', encoding='utf-8') as reader:
+        for line in reader:
+            line = line.strip()
+            if line == '':
+                continue
+            result = json.loads(line)
+            if 'cascade' in result['record']:
+                settled[result['id']] = result['record']['cascade']
+    return settled
+
+
+def load_consensus_cascade(config):
+    cascade_config = config.get('cascade', {})
+    if not cascade_config or not cascade_config.get('enabled', False):
+        return None
+    return ConsensusCascade(
+        stages=cascade_config.get('stages', [['NaiveGenerator', 'RAGGenerator'], ['FourStepCoTGenerator']]),
+        min_agreement=cascade_config.get('min_agreement', 2),
+        min_share=cascade_config.get('min_share', 1.0))
+
+
+def load_agreement_engine(config):
+    agreement_config = config.get('agreement', {})
+    if not agreement_config or not agreement_config.get('enabled', False):
+        return None
+    return AgreementEngine()
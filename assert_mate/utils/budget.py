@@ -0,0 +1,270 @@
+import os
+import glob
+import time
+import atexit
+import threading
+import multiprocessing
+from multiprocessing.util import Finalize
+
+from loguru import logger
+
+from utils.llm_metrics import load_metrics_files
+
+# Expected spend of one round of one agent on one instance when neither the history nor this run has seen it.
+DEFAULT_COSTS = {'usd': 0.002, 'tokens': 4000}
+
+
+def call_spend(call: dict, unit: str = 'usd') -> float:
+    if unit == 'tokens':
+        return call.get('prompt_tokens', 0) + call.get('completion_tokens', 0)
+    return call.get('cost', 0.0)
+
+
+def round_costs(records, unit: str = 'usd') -> dict:
+    """
+    The spend of every agent and round in call `records`, as `(agent, round) -> (total, units)`. A unit is one
+    instance (all calls an agent made for it in the round); a call without an instance id counts for the `cases` it
+    covered (one by default, several for a batched Judge call). Cache hits are left out, so that replayed runs do
+    not make a round look free.
+    """
+    totals, instances, cases = {}, {}, {}
+    for record in records:
+        if record.get('cache_hit'):
+            continue
+        key = (record.get('agent'), record.get('round'))
+        instance_id = record.get('instance_id')
+        totals[key] = totals.get(key, 0.0) + call_spend(record, unit)
+        if instance_id is not None:
+            instances.setdefault(key, set()).add((record.get('run_id'), instance_id))
+        else:
+            cases[key] = cases.get(key, 0) + record.get('cases', 1)
+    return {key: (total, len(instances.get(key, ())) + cases.get(key, 0)) for key, total in totals.items()}
+
+
+class BudgetScheduler():
+    """
+    Spends a fixed LLM budget of one run, `limit` USD (at the metrics prices) or prompt plus completion tokens.
+
+    The first pass of a run (every member answering every instance) is `reserve`d up front and always runs. The
+    optional rounds (Judge, refine, debate, extra samples) spend what is left: `allow` admits one only if its
+    expected cost still fits under the limit less a `safety_margin` share, next to what is spent and reserved, and
+    reserves it. Near exhaustion the optional rounds are thus skipped instead of the run dying partway through.
+
+    The expected cost of an agent's round on an instance comes from the call records of earlier runs (and of this
+    one as it goes), falling back to the mean of the round over all agents and then to `default_cost`. Spend is
+    read from the metrics call records as they are written, totalled over the worker processes and reported every
+    `report_interval` seconds.
+    """
+
+    def __init__(self, limit: float, unit: str = 'usd', history=(), default_cost: float | None = None,
+                 safety_margin: float = 0.05, report_interval: float = 30.0):
+        self.limit = limit
+        self.unit = unit
+        self.default_cost = default_cost if default_cost is not None else DEFAULT_COSTS[unit]
+        self.safety_margin = safety_margin
+        self.report_interval = report_interval
+        self.history = round_costs(history, unit)
+        self.round_history = {}
+        for (agent, round_name), (total, units) in self.history.items():
+            round_total, round_units = self.round_history.get(round_name, (0.0, 0))
+            self.round_history[round_name] = (round_total + total, round_units + units)
+        # Run-wide totals, shared with the worker processes forked after loading.
+        self._run_lock = multiprocessing.Lock()
+        self._spent = multiprocessing.RawValue('d', 0.0)
+        self._reserved = multiprocessing.RawValue('d', 0.0)
+        self._last_report = multiprocessing.RawValue('d', time.time())
+        self._exceeded = multiprocessing.RawValue('b', 0)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._reset()
+        atexit.register(self.log_stats)
+
+    def _reset(self) -> None:
+        # Reservations held by this process, by (agent, round), released as the calls of the round come in.
+        self._reservations = {}
+        self._observed = {}
+        self.allowed = {}
+        self.skipped = {}
+        self.degraded = False
+
+    def _local(self) -> None:
+        # Forked workers start with their own reservations and counters.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._reset()
+            # Unlike atexit handlers, finalizers also run when a multiprocessing worker exits.
+            Finalize(self, self._finish, exitpriority=10)
+
+    def _finish(self) -> None:
+        self.settle()
+        self.log_stats()
+
+    def _format(self, amount: float) -> str:
+        return f'{amount:.4f} USD' if self.unit == 'usd' else f'{int(amount)} tokens'
+
+    def expected_cost(self, agent: str, round_name: str) -> float:
+        """
+        The expected spend of one round of `agent` on one instance.
+        """
+        total, units = self.history.get((agent, round_name), (0.0, 0))
+        with self._lock:
+            observed_total, observed_instances, observed_cases = self._observed.get((agent, round_name),
+                                                                                    (0.0, set(), 0))
+        total, units = total + observed_total, units + len(observed_instances) + observed_cases
+        if units == 0:
+            total, units = self.round_history.get(round_name, (0.0, 0))
+        return total / units if units != 0 else self.default_cost
+
+    def _costs(self, rounds, instances: int) -> dict:
+        return {key: self.expected_cost(*key) * instances for key in rounds}
+
+    def _hold(self, costs: dict) -> None:
+        with self._lock:
+            self._local()
+            for key, cost in costs.items():
+                self._reservations[key] = self._reservations.get(key, 0.0) + cost
+
+    def reserve(self, rounds, instances: int = 1) -> None:
+        """
+        Reserves the first pass: the `(agent, round)` pairs of `rounds` on `instances` instances. Reservations
+        are not checked against the limit.
+        """
+        costs = self._costs(rounds, instances)
+        self._hold(costs)
+        with self._run_lock:
+            self._reserved.value += sum(costs.values())
+            committed = self._spent.value + self._reserved.value
+        if committed > self.limit:
+            logger.warning(f'The first pass is expected to bring the spend to {self._format(committed)}, over the '
+                           f'budget of {self._format(self.limit)}.')
+
+    def allow(self, rounds, instances: int = 1) -> bool:
+        """
+        Whether the optional `(agent, round)` pairs of `rounds` on `instances` instances still fit the budget.
+        If they do, their expected cost is reserved.
+        """
+        costs = self._costs(rounds, instances)
+        cost = sum(costs.values())
+        with self._run_lock:
+            allowed = self._spent.value + self._reserved.value + cost <= self.limit * (1 - self.safety_margin)
+            if allowed:
+                self._reserved.value += cost
+        if allowed:
+            self._hold(costs)
+        with self._lock:
+            self._local()
+            counts = self.allowed if allowed else self.skipped
+            for round_name in {round_name for _, round_name in rounds}:
+                counts[round_name] = counts.get(round_name, 0) + instances
+            warn = not allowed and not self.degraded
+            self.degraded = self.degraded or not allowed
+        if warn:
+            logger.warning(f'LLM budget of PID {os.getpid()} nearly exhausted, skipping optional rounds: '
+                           f'{self.report()}')
+        return allowed
+
+    def settle(self) -> None:
+        """
+        Releases what is left of the reservations of this process, once the rounds they were made for are over.
+        """
+        with self._lock:
+            self._local()
+            left = sum(self._reservations.values())
+            self._reservations = {}
+        with self._run_lock:
+            self._reserved.value = max(self._reserved.value - left, 0.0)
+
+    def observe(self, call: dict) -> None:
+        """
+        Metrics listener: adds the spend of a finished call and draws it from the reservation of its round.
+        """
+        spend = call_spend(call, self.unit)
+        key = (call.get('agent'), call.get('round'))
+        with self._lock:
+            self._local()
+            if not call.get('cache_hit'):
+                total, instances, cases = self._observed.get(key, (0.0, set(), 0))
+                instance_id = call.get('instance_id')
+                if instance_id is not None:
+                    instances.add(instance_id)
+                else:
+                    cases += call.get('cases', 1)
+                self._observed[key] = (total + spend, instances, cases)
+            held = self._reservations.get(key, 0.0)
+            released = min(held, spend)
+            if released != 0:
+                self._reservations[key] = held - released
+        now = time.time()
+        with self._run_lock:
+            self._spent.value += spend
+            self._reserved.value = max(self._reserved.value - released, 0.0)
+            exceeded = self._spent.value > self.limit and not self._exceeded.value
+            if exceeded:
+                self._exceeded.value = 1
+            due = now - self._last_report.value >= self.report_interval
+            if due:
+                self._last_report.value = now
+        if exceeded:
+            logger.warning(f'LLM budget exceeded: {self.report()}')
+        elif due:
+            logger.info(self.report())
+
+    def report(self) -> str:
+        with self._run_lock:
+            spent, reserved = self._spent.value, self._reserved.value
+        return f'LLM budget: {self._format(spent)} of {self._format(self.limit)} spent ' \
+               f'({spent / self.limit:.1%}), {self._format(reserved)} reserved.'
+
+    def stats(self) -> dict:
+        with self._run_lock:
+            spent, reserved = self._spent.value, self._reserved.value
+        with self._lock:
+            return {
+                'unit': self.unit,
+                'limit': self.limit,
+                'spent': round(spent, 6),
+                'reserved': round(reserved, 6),
+                'allowed': dict(self.allowed),
+                'skipped': dict(self.skipped),
+            }
+
+    def log_stats(self) -> None:
+        if self._spent.value != 0 or len(self.allowed) != 0 or len(self.skipped) != 0:
+            logger.info(f'LLM budget of PID {os.getpid()}: {self.stats()}')
+
+
+_schedulers = {}
+
+
+def load_budget_scheduler(config, metrics):
+    budget_config = config.get('budget', {})
+    if not budget_config or not budget_config.get('enabled', False):
+        return None
+    if metrics is None:
+        logger.error('budget needs metrics to be enabled, spend is read from the call records.')
+        exit(-1)
+    unit = budget_config.get('unit', 'usd')
+    if unit not in DEFAULT_COSTS:
+        logger.error(f'Unknown budget unit {unit}, expected one of {list(DEFAULT_COSTS)}.')
+        exit(-1)
+    if unit == 'usd' and not metrics.prices:
+        logger.error('A budget in USD needs metrics.prices.')
+        exit(-1)
+    limit = budget_config.get('limit', 0)
+    if not limit or limit <= 0:
+        logger.error('Error loading configuration: budget.limit must be positive.')
+        exit(-1)
+    # Shared by every LLM of the process (and its forked workers), like the metrics recorder.
+    if metrics.output_dir not in _schedulers:
+        history = []
+        if budget_config.get('history', True) and metrics.output_dir is not None:
+            paths = [path for path in glob.glob(os.path.join(metrics.output_dir, 'llm_calls-*.jsonl'))
+                     if not os.path.basename(path).startswith(f'llm_calls-{metrics.run_id}-')]
+            history = load_metrics_files(sorted(paths))
+        scheduler = BudgetScheduler(limit, unit, history,
+                                    default_cost=budget_config.get('default_cost', None),
+                                    safety_margin=budget_config.get('safety_margin', 0.05),
+                                    report_interval=budget_config.get('report_interval', 30.0))
+        metrics.add_listener(scheduler.observe)
+        _schedulers[metrics.output_dir] = scheduler
+    return _schedulers[metrics.output_dir]
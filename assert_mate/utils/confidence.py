@@ -0,0 +1,88 @@
+import numpy as np
+
+from utils.agreement import extract_assertion
+
+STOP_TOKEN = '```'
+
+
+def pad_logprobs(token_lists, logprob_lists, stop_token=STOP_TOKEN):
+    """
+    Packs the token logprobs of all choices into one `(choices, max_len)` array.
+
+    Returns `(logprobs, mask)`, where `mask` keeps the tokens before the first `stop_token` of each choice.
+    Padding and missing logprobs (None) are masked out.
+    """
+    num_choices = len(logprob_lists)
+    max_len = max((len(lp) for lp in logprob_lists), default=0)
+    logprobs = np.full((num_choices, max_len), np.nan, dtype=np.float64)
+    tokens = np.full((num_choices, max_len), '', dtype=object)
+    for i, (token_list, logprob_list) in enumerate(zip(token_lists, logprob_lists)):
+        logprobs[i, :len(logprob_list)] = [np.nan if lp is None else lp for lp in logprob_list]
+        tokens[i, :len(token_list)] = token_list
+    before_stop = np.cumsum(tokens == stop_token, axis=1) == 0
+    mask = before_stop & ~np.isnan(logprobs)
+    return logprobs, mask
+
+
+def score_logprobs(token_lists, logprob_lists, stop_token=STOP_TOKEN) -> dict:
+    """
+    Scores every choice in one vectorized pass over the padded logprob array.
+
+    Returns arrays (one entry per choice) of the mean, min and sum token logprob, the number of scored tokens and
+    the confidence `exp(mean) * 100`. Choices without any scored token get a mean of -inf and confidence 0.
+    """
+    logprobs, mask = pad_logprobs(token_lists, logprob_lists, stop_token)
+    masked = np.where(mask, logprobs, 0.0)
+    length = mask.sum(axis=1)
+    total = masked.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(length > 0, total / np.maximum(length, 1), -np.inf)
+    minimum = np.where(mask, logprobs, np.inf).min(axis=1, initial=np.inf)
+    minimum = np.where(length > 0, minimum, -np.inf)
+    return {
+        'mean': mean,
+        'min': minimum,
+        'sum': total,
+        'length': length,
+        'confidence': np.round(np.exp(mean) * 100, 2),
+    }
+
+
+def score_choices(choices, stop_token=STOP_TOKEN) -> dict:
+    """
+    `score_logprobs` over the choices of a completion requested with `logprobs`.
+    """
+    token_lists = [choice.logprobs.tokens for choice in choices]
+    logprob_lists = [choice.logprobs.token_logprobs for choice in choices]
+    return score_logprobs(token_lists, logprob_lists, stop_token)
+
+
+def merge_candidates(responses, confidences, sequence_logprobs=None, key_fn=extract_assertion) -> list:
+    """
+    Merges responses whose normalized assertion (`key_fn`) is identical. Responses without an assertion share the
+    empty key.
+
+    Every merged candidate carries its first response, the number of votes, the summed per-token probability
+    mass (`confidence / 100`) and, if `sequence_logprobs` is given, the summed sequence probability. Candidates are
+    sorted by mass, then votes.
+    """
+    keys = [key_fn(response) for response in responses]
+    unique_keys, first_index, inverse = np.unique(np.asarray(keys, dtype=object), return_index=True,
+                                                  return_inverse=True)
+    inverse = inverse.reshape(-1)
+    votes = np.bincount(inverse, minlength=len(unique_keys))
+    mass = np.bincount(inverse, weights=np.asarray(confidences, dtype=np.float64) / 100,
+                       minlength=len(unique_keys))
+    if sequence_logprobs is not None:
+        sequence_mass = np.bincount(inverse, weights=np.exp(np.asarray(sequence_logprobs, dtype=np.float64)),
+                                    minlength=len(unique_keys))
+    else:
+        sequence_mass = np.zeros(len(unique_keys))
+    order = np.lexsort((-votes, -mass))
+    return [{
+        'assertion': unique_keys[i],
+        'response': responses[first_index[i]],
+        'votes': int(votes[i]),
+        'mass': float(mass[i]),
+        'sequence_mass': float(sequence_mass[i]),
+    } for i in order]
@@ -0,0 +1,95 @@
+import re
+
+from utils.tokens import count_tokens
+
+IDENTIFIER = re.compile(r'[A-Za-z_$][A-Za-z0-9_$]*')
+SUBTOKEN = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+JAVA_KEYWORDS = {
+    'abstract', 'assert', 'boolean', 'break', 'byte', 'case', 'catch', 'char', 'class', 'const', 'continue',
+    'default', 'do', 'double', 'else', 'enum', 'extends', 'final', 'finally', 'float', 'for', 'goto', 'if',
+    'implements', 'import', 'instanceof', 'int', 'interface', 'long', 'native', 'new', 'package', 'private',
+    'protected', 'public', 'return', 'short', 'static', 'strictfp', 'super', 'switch', 'synchronized', 'this',
+    'throw', 'throws', 'transient', 'try', 'void', 'volatile', 'while', 'true', 'false', 'null', 'var'
+}
+
+
+def identifiers(code: str) -> set:
+    return {name for name in IDENTIFIER.findall(code or '') if name not in JAVA_KEYWORDS}
+
+
+def subtokens(names) -> set:
+    """
+    Lower-cased camelCase and snake_case parts of identifiers, e.g. `getMaxValue` gives get, max and value.
+    """
+    return {part.lower() for name in names for part in SUBTOKEN.findall(name)}
+
+
+def member_name(declaration: str) -> str:
+    """
+    The declared name of a field (`private int count = 0;`) or method signature (`public int size()`).
+    """
+    head = declaration.split('(', 1)[0] if '(' in declaration else re.split(r'[=;]', declaration, 1)[0]
+    names = [name for name in IDENTIFIER.findall(head) if name not in JAVA_KEYWORDS]
+    return names[-1] if names else ''
+
+
+class ContextBuilder():
+    """
+    Chooses the focal class fields and methods and the test class fields that go into a prompt, within a token
+    budget per agent.
+
+    Members are ranked by relevance to the focal method and the test prefix: a member they reference by name
+    (called methods, used fields) ranks first, the others by how many identifier parts (`getMaxValue`: get, max,
+    value) they share with the code. The best members are taken until the next one no longer fits the budget;
+    the chosen ones keep their original order. Tokens are counted with the tokenizer at `tokenizer_path` if
+    given (see `count_tokens`), otherwise estimated.
+    """
+
+    def __init__(self, default_budget: int = 1024, budgets: dict = None, tokenizer_path: str | None = None):
+        self.default_budget = default_budget
+        self.budgets = dict(budgets or {})
+        self.tokenizer_path = tokenizer_path
+
+    def budget(self, agent: str) -> int:
+        return self.budgets.get(agent, self.default_budget)
+
+    def relevance(self, declaration: str, referenced: set, code_subtokens: set) -> float:
+        name = member_name(declaration)
+        overlap = subtokens(identifiers(declaration)) & code_subtokens
+        return (1.0 if name in referenced else 0.0) + len(overlap) / (len(overlap) + 4)
+
+    def fit(self, agent: str, focal_method: str, test_prefix: str, focal_class_fields=(), focal_class_methods=(),
+            test_class_fields=()) -> dict:
+        """
+        The members that fit the budget of `agent`, as `focal_class_fields`, `focal_class_methods` and
+        `test_class_fields` lists.
+        """
+        groups = {'focal_class_fields': list(focal_class_fields or []),
+                  'focal_class_methods': list(focal_class_methods or []),
+                  'test_class_fields': list(test_class_fields or [])}
+        referenced = identifiers(focal_method) | identifiers(test_prefix)
+        code_subtokens = subtokens(referenced)
+        members = [(group, idx, declaration) for group, declarations in groups.items()
+                   for idx, declaration in enumerate(declarations)]
+        ranked = sorted(members, key=lambda member: -self.relevance(member[2], referenced, code_subtokens))
+        remaining = self.budget(agent)
+        chosen = set()
+        for group, idx, declaration in ranked:
+            # One more token for the line break after every member.
+            cost = count_tokens(declaration, self.tokenizer_path) + 1
+            if cost > remaining:
+                break
+            remaining -= cost
+            chosen.add((group, idx))
+        return {group: [declaration for idx, declaration in enumerate(declarations) if (group, idx) in chosen]
+                for group, declarations in groups.items()}
+
+
+def load_context_builder(config):
+    builder_config = config.get('context_budget', {})
+    if not builder_config or not builder_config.get('enabled', False):
+        return None
+    return ContextBuilder(
+        default_budget=builder_config.get('default', 1024),
+        budgets=builder_config.get('agents', {}),
+        tokenizer_path=builder_config.get('tokenizer', None))
@@ -0,0 +1,190 @@
+import os
+import time
+import random
+import asyncio
+import threading
+
+from loguru import logger
+
+from utils.http_clients import get_openai_client
+
+
+class Endpoint():
+    def __init__(self, name: str, base_url: str, api_key: str, model: str | None = None, weight: float = 1.0,
+                 max_concurrency: int = 0):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        # Self-hosted servers often serve the model under another name.
+        self.model = model
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def healthy(self, now) -> bool:
+        return self.unhealthy_until <= now
+
+    def has_capacity(self) -> bool:
+        return self.max_concurrency <= 0 or self.outstanding < self.max_concurrency
+
+
+class EndpointPool():
+    """
+    Routes requests across several OpenAI-compatible endpoints.
+
+    Every request goes to the healthy endpoint with the fewest outstanding requests relative to its weight, among
+    those below their concurrency limit. An endpoint that fails `failure_threshold` times in a row is taken out of
+    rotation for `cooldown` seconds; an optional background thread also probes every endpoint each
+    `health_check_interval` seconds. When every endpoint is unhealthy the one that recovers first is used anyway,
+    so that requests keep failing over instead of blocking.
+
+    Outstanding counts are per process; the rate limiter bounds the load across processes.
+    """
+
+    def __init__(self, endpoints: list, failure_threshold: int = 3, cooldown: float = 30.0,
+                 health_check_interval: float = 0.0):
+        if len(endpoints) == 0:
+            raise ValueError('An endpoint pool needs at least one endpoint.')
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health_check_interval = health_check_interval
+        self._cond = threading.Condition()
+        self._checker_pid = None
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def _pick(self, exclude):
+        now = time.time()
+        candidates = [e for e in self.endpoints if e not in exclude] or self.endpoints
+        healthy = [e for e in candidates if e.healthy(now)]
+        if len(healthy) == 0:
+            healthy = [min(candidates, key=lambda e: e.unhealthy_until)]
+        available = [e for e in healthy if e.has_capacity()]
+        if len(available) == 0:
+            return None
+        best = min((e.outstanding + 1) / e.weight for e in available)
+        endpoint = random.choice([e for e in available if (e.outstanding + 1) / e.weight == best])
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return endpoint
+
+    def try_acquire(self, exclude=()):
+        self._ensure_health_checker()
+        with self._cond:
+            return self._pick(exclude)
+
+    def acquire(self, exclude=()) -> Endpoint:
+        """
+        Picks an endpoint for one request, waiting while all of them are at their concurrency limit. `exclude`
+        holds endpoints that already failed this request; they are only used if nothing else is left.
+        """
+        self._ensure_health_checker()
+        with self._cond:
+            while True:
+                endpoint = self._pick(exclude)
+                if endpoint is not None:
+                    return endpoint
+                self._cond.wait(timeout=1.0)
+
+    async def aacquire(self, exclude=()) -> Endpoint:
+        while True:
+            endpoint = self.try_acquire(exclude)
+            if endpoint is not None:
+                return endpoint
+            await asyncio.sleep(0.05)
+
+    def release(self, endpoint: Endpoint, success: bool = True) -> None:
+        with self._cond:
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+            if success:
+                endpoint.consecutive_failures = 0
+            else:
+                self._mark_failure(endpoint)
+            self._cond.notify()
+
+    def _mark_failure(self, endpoint: Endpoint) -> None:
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures >= self.failure_threshold:
+            endpoint.unhealthy_until = time.time() + self.cooldown
+            logger.warning(f'Endpoint {endpoint.name} failed {endpoint.consecutive_failures} times in a row, '
+                           f'out of rotation for {self.cooldown:.0f}s.')
+
+    def has_alternative(self, endpoint: Endpoint, failed=()) -> bool:
+        """
+        Whether a healthy endpoint other than `endpoint` is left that has not `failed` the request yet.
+        """
+        now = time.time()
+        return any(e is not endpoint and e not in failed and e.healthy(now) for e in self.endpoints)
+
+    def _ensure_health_checker(self):
+        # Threads do not survive fork, so every worker process starts its own checker.
+        if self.health_check_interval <= 0 or self._checker_pid == os.getpid():
+            return
+        with self._cond:
+            if self._checker_pid == os.getpid():
+                return
+            self._checker_pid = os.getpid()
+        threading.Thread(target=self._health_check_loop, daemon=True).start()
+
+    def _health_check_loop(self):
+        while True:
+            time.sleep(self.health_check_interval)
+            for endpoint in self.endpoints:
+                self.health_check(endpoint)
+
+    def health_check(self, endpoint: Endpoint) -> bool:
+        try:
+            get_openai_client(endpoint.api_key, endpoint.base_url).with_options(timeout=10.0).models.list()
+        except Exception as e:
+            with self._cond:
+                endpoint.consecutive_failures = max(endpoint.consecutive_failures, self.failure_threshold - 1)
+                self._mark_failure(endpoint)
+            logger.warning(f'Health check of endpoint {endpoint.name} failed: {str(e)}')
+            return False
+        with self._cond:
+            endpoint.consecutive_failures = 0
+            endpoint.unhealthy_until = 0.0
+            self._cond.notify_all()
+        return True
+
+    def stats(self) -> list:
+        now = time.time()
+        with self._cond:
+            return [{
+                'name': e.name,
+                'healthy': e.healthy(now),
+                'outstanding': e.outstanding,
+                'requests': e.requests,
+                'failures': e.failures,
+            } for e in self.endpoints]
+
+
+def load_endpoint_pool(llm_config) -> EndpointPool:
+    """
+    Builds the pool from `endpoints` of an LLM config section, or a single endpoint from its `api` and `key`.
+    """
+    endpoint_configs = llm_config.get('endpoints', [])
+    if not endpoint_configs:
+        endpoints = [Endpoint('default', llm_config.get('api', None), llm_config.get('key', None))]
+    else:
+        endpoints = []
+        for idx, endpoint_config in enumerate(endpoint_configs):
+            endpoints.append(Endpoint(
+                name=endpoint_config.get('name', f'endpoint-{idx}'),
+                base_url=endpoint_config.get('api', llm_config.get('api', None)),
+                api_key=endpoint_config.get('key', llm_config.get('key', None)),
+                model=endpoint_config.get('model', None),
+                weight=endpoint_config.get('weight', 1.0),
+                max_concurrency=endpoint_config.get('max_concurrency', 0)))
+    pool_config = llm_config.get('endpoint_pool', {})
+    return EndpointPool(endpoints,
+                        failure_threshold=pool_config.get('failure_threshold', 3),
+                        cooldown=pool_config.get('cooldown', 30.0),
+                        health_check_interval=pool_config.get('health_check_interval', 0.0))
@@ -0,0 +1,165 @@
+import os
+import time
+import atexit
+import asyncio
+import threading
+from collections import deque
+
+from loguru import logger
+
+from utils.llm_metrics import active_call
+
+
+def _percentile(ordered, q):
+    if len(ordered) == 0:
+        return None
+    idx = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+class HedgingPolicy():
+    """
+    Sends a duplicate of a request that has been running longer than the `percentile` of recent latencies and
+    keeps whichever copy answers first.
+
+    Hedging starts once `min_samples` latencies have been observed, and at most `max_hedge_ratio` of all requests
+    are duplicated so that a slow backend is not hit with twice the load. Only async requests are hedged (`arun`),
+    since the losing copy must be cancelled: a blocking HTTP call cannot be interrupted, and a synchronous loser
+    would run to completion, holding its rate limiter lease and endpoint slot, so every hedge would be paid twice.
+    `simulate` replays the policy on sampled latencies for the offline replay backend.
+
+    Two latencies are kept per request: the primary one, of the first copy alone (what the request would have
+    taken without hedging), and the effective one the caller waited. The hedge delay is read from the primary
+    latencies, so that hedging does not keep lowering its own trigger point. A primary copy cancelled because its
+    duplicate won counts with the time it ran, a lower bound that still lies above the hedge delay.
+    """
+
+    def __init__(self, percentile: float = 95, min_samples: int = 20, window: int = 500,
+                 max_hedge_ratio: float = 0.1, min_delay: float = 1.0):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_delay = min_delay
+        self._latencies = deque(maxlen=window)
+        self._primary_latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        atexit.register(self.log_stats)
+
+    def hedge_delay(self) -> float | None:
+        """
+        Seconds to wait before sending the duplicate, or None while there are too few samples.
+        """
+        with self._lock:
+            if len(self._primary_latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._primary_latencies)
+        return max(self.min_delay, _percentile(ordered, self.percentile))
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if self.hedged + 1 > self.max_hedge_ratio * max(self.requests, 1):
+                return False
+            self.hedged += 1
+            return True
+
+    def _observe(self, latency, primary_latency=None, hedged=False, hedge_won=False):
+        with self._lock:
+            self._latencies.append(latency)
+            self._primary_latencies.append(primary_latency if primary_latency is not None else latency)
+            self.requests += 1
+            if hedge_won:
+                self.hedge_wins += 1
+        call = active_call()
+        if call is not None and hedged:
+            call['hedged'] = True
+            call['hedge_won'] = hedge_won
+
+    def simulate(self, sample_latency) -> float:
+        """
+        Offline counterpart of `arun` for the replay backend: draws the latency of a request from
+        `sample_latency()` and, if the policy would hedge it, the latency of its duplicate, and returns the
+        latency of the first answer without sending anything.
+        """
+        primary = sample_latency()
+        delay = self.hedge_delay()
+        if delay is None or primary <= delay or not self._take_budget():
+            self._observe(primary)
+            return primary
+        backup = delay + sample_latency()
+        self._observe(min(primary, backup), primary, hedged=True, hedge_won=backup < primary)
+        return min(primary, backup)
+
+    async def arun(self, make_coro):
+        """
+        Awaits `make_coro()` and hedges it with a second `make_coro()` if it is slow; the loser is cancelled.
+        """
+        start = time.perf_counter()
+        delay = self.hedge_delay()
+        if delay is None:
+            result = await make_coro()
+            self._observe(time.perf_counter() - start)
+            return result
+        primary = asyncio.ensure_future(make_coro())
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if len(done) != 0 or not self._take_budget():
+                result = await primary
+                self._observe(time.perf_counter() - start)
+                return result
+            backup = asyncio.ensure_future(make_coro())
+            pending.add(backup)
+            # The primary latency ends when the primary copy finishes, or when it is cancelled if it never does.
+            primary_end = []
+            primary.add_done_callback(lambda _: primary_end.append(time.perf_counter()))
+            error = None
+            while len(pending) != 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        end = time.perf_counter()
+                        self._observe(end - start, (primary_end[0] if primary_end else end) - start, hedged=True,
+                                      hedge_won=task is backup)
+                        return task.result()
+                    error = task.exception()
+            end = time.perf_counter()
+            self._observe(end - start, (primary_end[0] if primary_end else end) - start, hedged=True)
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        """
+        Hedging counters and the p50/p95/p99 latencies before (primary copy alone) and after hedging.
+        """
+        with self._lock:
+            before = sorted(self._primary_latencies)
+            after = sorted(self._latencies)
+            return {
+                'requests': self.requests,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'hedge_ratio': round(self.hedged / self.requests, 4) if self.requests else 0.0,
+                'before': {f'p{q}': _percentile(before, q) for q in (50, 95, 99)},
+                'after': {f'p{q}': _percentile(after, q) for q in (50, 95, 99)},
+            }
+
+    def log_stats(self) -> None:
+        if self.requests != 0:
+            logger.info(f'Hedging of PID {os.getpid()}: {self.stats()}')
+
+
+def load_hedging_policy(config):
+    hedging_config = config.get('hedging', {})
+    if not hedging_config or not hedging_config.get('enabled', False):
+        return None
+    return HedgingPolicy(
+        percentile=hedging_config.get('percentile', 95),
+        min_samples=hedging_config.get('min_samples', 20),
+        window=hedging_config.get('window', 500),
+        max_hedge_ratio=hedging_config.get('max_hedge_ratio', 0.1),
+        min_delay=hedging_config.get('min_delay', 1.0))
@@ -0,0 +1,103 @@
+import os
+import re
+import atexit
+import threading
+
+from loguru import logger
+
+from utils.agreement import extract_assertion
+from utils.message_history import MessageHistory
+from utils.tokens import estimate_messages_tokens
+
+CODE_BLOCK = re.compile(r'```.*?(?:```|$)', re.DOTALL)
+
+
+def _shorten(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(' ', 1)[0] + ' ...'
+
+
+def key_conclusions(content: str, summary_chars: int = 400) -> str:
+    """
+    A short stand-in for an assistant answer: its first and last paragraphs outside code blocks (where the
+    answers state what they found and conclude) and the assertion it predicts, if any.
+    """
+    paragraphs = [p.strip() for p in re.split(r'\n\s*\n', CODE_BLOCK.sub('', content or '')) if p.strip()]
+    if len(paragraphs) > 1:
+        summary = _shorten(paragraphs[0], summary_chars // 2) + '\n...\n' + \
+            _shorten(paragraphs[-1], summary_chars // 2)
+    else:
+        summary = _shorten(paragraphs[0], summary_chars) if paragraphs else ''
+    compacted = f'(Summary of my earlier answer)\n{summary}'
+    assertion = extract_assertion(content or '')
+    if assertion:
+        compacted += f'\nPredicted assertion:\n```java\n{assertion}\n```'
+    return compacted
+
+
+class HistoryCompactor():
+    """
+    Keeps the conversation sent to the model under `max_tokens` (estimated): once it is longer, the oldest
+    assistant turns are replaced by their `key_conclusions` until it fits. The latest `keep_last` assistant turns
+    and all other messages stay as they are.
+
+    Only the request is compacted; the generators keep the full transcript in their history and result files.
+    Compaction is deterministic, so compacted requests still hit the response cache and share prompt prefixes.
+    """
+
+    def __init__(self, max_tokens: int = 3000, keep_last: int = 1, summary_chars: int = 400):
+        self.max_tokens = max_tokens
+        self.keep_last = keep_last
+        self.summary_chars = summary_chars
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.compacted = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        atexit.register(self.log_stats)
+
+    def compact(self, messages) -> MessageHistory:
+        messages = MessageHistory(messages)
+        tokens = estimate_messages_tokens(messages)
+        with self._lock:
+            self.requests += 1
+        if tokens <= self.max_tokens:
+            return messages
+        assistant_turns = [idx for idx, message in enumerate(messages) if message.get('role') == 'assistant']
+        older = assistant_turns[:max(len(assistant_turns) - self.keep_last, 0)]
+        compacted = list(messages)
+        for idx in older:
+            if tokens <= self.max_tokens:
+                break
+            summary = dict(messages[idx], content=key_conclusions(messages[idx].get('content', ''),
+                                                                  self.summary_chars))
+            tokens -= estimate_messages_tokens([messages[idx]]) - estimate_messages_tokens([summary])
+            compacted[idx] = summary
+        with self._lock:
+            self.compacted += 1
+            self.tokens_before += estimate_messages_tokens(messages)
+            self.tokens_after += tokens
+        return MessageHistory(compacted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'compacted': self.compacted,
+                'saved_tokens': self.tokens_before - self.tokens_after,
+            }
+
+    def log_stats(self) -> None:
+        if self.compacted != 0:
+            logger.info(f'History compaction of PID {os.getpid()}: {self.stats()}')
+
+
+def load_history_compactor(config):
+    compaction_config = config.get('history_compaction', {})
+    if not compaction_config or not compaction_config.get('enabled', False):
+        return None
+    return HistoryCompactor(
+        max_tokens=compaction_config.get('max_tokens', 3000),
+        keep_last=compaction_config.get('keep_last', 1),
+        summary_chars=compaction_config.get('summary_chars', 400))
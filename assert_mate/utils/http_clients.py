@@ -0,0 +1,78 @@
+import os
+import threading
+import importlib.util
+
+import httpx
+from loguru import logger
+from openai import OpenAI, AsyncOpenAI
+
+# Process-wide registry of OpenAI clients. Every client owns an httpx connection pool, so sharing one client per
+# (endpoint, key) keeps connections alive across calls instead of paying a new TLS handshake per request.
+_clients = {}
+_lock = threading.Lock()
+_pool_config = {
+    'http2': True,
+    'max_connections': 100,
+    'max_keepalive_connections': 20,
+    'keepalive_expiry': 60.0,
+    'timeout': 600.0,
+}
+_http2_warned = False
+
+
+def configure_http_pool(pool_config) -> None:
+    """
+    Updates the pool limits used by clients created afterwards. Unknown keys are ignored.
+    """
+    if not pool_config:
+        return
+    for key in _pool_config.keys():
+        if key in pool_config:
+            _pool_config[key] = pool_config[key]
+
+
+def _http2_enabled() -> bool:
+    global _http2_warned
+    if not _pool_config['http2']:
+        return False
+    if importlib.util.find_spec('h2') is None:
+        if not _http2_warned:
+            logger.warning('HTTP/2 requested but the `h2` package is not installed, falling back to HTTP/1.1.')
+            _http2_warned = True
+        return False
+    return True
+
+
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=_pool_config['max_connections'],
+                        max_keepalive_connections=_pool_config['max_keepalive_connections'],
+                        keepalive_expiry=_pool_config['keepalive_expiry'])
+
+
+def get_openai_client(api_key: str, base_url: str, async_client: bool = False, loop=None, max_retries: int = 0):
+    """
+    Returns the shared client for the given endpoint, creating it on first use.
+
+    The SDK's own retries are disabled by default because `DeepSeek._request` retries through the shared rate
+    limiter, which must see every attempt.
+
+    Connection pools cannot cross fork or event loops, so clients are keyed by process id as well, and async
+    clients additionally by the event loop they will run on.
+    """
+    key = (os.getpid(), api_key, base_url, async_client, id(loop) if async_client else None, max_retries)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        if key not in _clients:
+            if async_client:
+                http_client = httpx.AsyncClient(http2=_http2_enabled(), limits=_pool_limits(),
+                                                timeout=_pool_config['timeout'])
+                _clients[key] = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                                            max_retries=max_retries)
+            else:
+                http_client = httpx.Client(http2=_http2_enabled(), limits=_pool_limits(),
+                                           timeout=_pool_config['timeout'])
+                _clients[key] = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                                       max_retries=max_retries)
+        return _clients[key]
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import hashlib
+import threading
+
+from loguru import logger
+
+
+class LLMCacheMiss(KeyError):
+    pass
+
+
+class LLMResponseCache():
+    """
+    Disk-backed, content-addressed cache of LLM responses.
+
+    Entries live in a SQLite database in WAL mode, so every worker process (and every script) can read and write
+    the same file concurrently. Keys are the SHA-256 of the request (model, messages, prefix, temperature, stop
+    tokens, n, ...). In read-only mode the cache never writes and a miss raises `LLMCacheMiss`, which replays a
+    previous run without touching the API.
+
+    Every response is committed as soon as it arrives, so a run restarted after a crash finds every call that had
+    completed and only pays for the rest; the records and in-memory results of the crashed run are rebuilt from the
+    cache for free. With `synchronous` NORMAL the commits survive a crash of the process, with FULL (an fsync per
+    commit) also one of the machine.
+    """
+
+    def __init__(self, db_path: str, ttl: float = 0, max_entries: int = 0, read_only: bool = False,
+                 evict_every: int = 500, synchronous: str = 'NORMAL'):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.read_only = read_only
+        self.evict_every = evict_every
+        self.synchronous = synchronous
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        if not read_only and not os.path.exists(os.path.dirname(db_path)):
+            os.makedirs(os.path.dirname(db_path))
+        atexit.register(self.log_stats)
+
+    @staticmethod
+    def make_key(**request) -> str:
+        serialized = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def _connection(self):
+        # SQLite connections must not be shared across fork, so each process opens its own.
+        if self._conn is None or self._conn_pid != os.getpid():
+            if self.read_only:
+                conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, timeout=30,
+                                       check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(f'PRAGMA synchronous={self.synchronous}')
+                conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                             'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                             'created_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_accessed_at ON responses (accessed_at)')
+                conn.commit()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str):
+        """
+        Returns a `(found, value)` pair. Expired entries count as misses.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            try:
+                row = conn.execute('SELECT value, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            except sqlite3.OperationalError as e:
+                logger.warning(f'LLM cache lookup failed: {e}')
+                row = None
+            if row is not None and self.ttl and now - row[1] > self.ttl:
+                row = None
+            if row is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            if not self.read_only:
+                conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+                conn.commit()
+        return True, json.loads(row[0])
+
+    def put(self, key: str, value):
+        if self.read_only:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                         (key, json.dumps(value, ensure_ascii=False), now, now))
+            conn.commit()
+            self._puts += 1
+            if self._puts % self.evict_every == 0:
+                self._evict(conn, now)
+
+    def evict(self):
+        if self.read_only:
+            return
+        with self._lock:
+            self._evict(self._connection(), time.time())
+
+    def _evict(self, conn, now):
+        if self.ttl:
+            conn.execute('DELETE FROM responses WHERE created_at < ?', (now - self.ttl,))
+        if self.max_entries:
+            conn.execute('DELETE FROM responses WHERE key IN ('
+                         'SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                         (self.max_entries,))
+        conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0
+        }
+
+    def log_stats(self):
+        if self.hits + self.misses:
+            logger.info(f'LLM response cache (PID {os.getpid()}): {self.stats()}')
+
+
+def load_llm_cache(code_base, config):
+    cache_config = config.get('llm_cache', {})
+    if not cache_config or not cache_config.get('enabled', False):
+        return None
+    db_path = cache_config.get('path', 'cache/llm_responses.sqlite')
+    if not os.path.isabs(db_path):
+        db_path = os.path.join(code_base, db_path)
+    read_only = cache_config.get('read_only', False)
+    if read_only and not os.path.exists(db_path):
+        logger.error(f'LLM cache {db_path} does not exist, cannot replay in read-only mode.')
+        exit(-1)
+    synchronous = cache_config.get('synchronous', 'NORMAL').upper()
+    if synchronous not in ['NORMAL', 'FULL']:
+        logger.error(f'Unknown llm_cache.synchronous {synchronous}, expected NORMAL or FULL.')
+        exit(-1)
+    logger.debug(f'Using LLM response cache at {db_path}.')
+    return LLMResponseCache(db_path,
+                            ttl=cache_config.get('ttl', 0),
+                            max_entries=cache_config.get('max_entries', 0),
+                            read_only=read_only,
+                            synchronous=synchronous)
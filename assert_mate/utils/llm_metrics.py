@@ -0,0 +1,267 @@
+import os
+import glob
+import json
+import time
+import atexit
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from loguru import logger
+
+# Tags (agent, round, step, instance id, assertion type) of the code currently calling the LLM.
+_call_tags = contextvars.ContextVar('llm_call_tags', default={})
+# The record of the LLM call in progress, filled in by the layers below the public LLM methods.
+_active_call = contextvars.ContextVar('llm_active_call', default=None)
+
+SUMMARY_KEYS = ['agent', 'round']
+
+
+@contextmanager
+def call_tags(**tags):
+    """
+    Tags every LLM call made inside the block. Nested blocks add to (or override) the outer tags.
+    """
+    token = _call_tags.set({**_call_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _call_tags.reset(token)
+
+
+def assertion_type_tag(expected_value) -> str:
+    if expected_value in ['assertTrue', 'assertFalse']:
+        return 'assertBoolean'
+    if expected_value in ['assertNull', 'assertNotNull']:
+        return 'assertNullValue'
+    return 'assertEquals'
+
+
+def current_tags() -> dict:
+    return dict(_call_tags.get())
+
+
+def active_call() -> dict | None:
+    return _active_call.get()
+
+
+@contextmanager
+def track_call(recorder, kind: str, model: str):
+    call = {
+        'kind': kind,
+        'model': model,
+        **current_tags(),
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'cached_tokens': 0,
+        'retries': 0,
+        'cache_hit': False,
+        'ttft': None,
+        'error': None,
+    }
+    token = _active_call.set(call)
+    start = time.perf_counter()
+    try:
+        yield call
+    except Exception as e:
+        call['error'] = type(e).__name__
+        raise
+    finally:
+        call['latency'] = round(time.perf_counter() - start, 4)
+        if call['ttft'] is not None:
+            call['ttft'] = round(call['ttft'] - start, 4)
+        _active_call.reset(token)
+        if recorder is not None:
+            recorder.record(call)
+
+
+def note_usage(usage) -> None:
+    call = active_call()
+    if call is None or usage is None:
+        return
+    call['prompt_tokens'] += getattr(usage, 'prompt_tokens', 0) or 0
+    call['completion_tokens'] += getattr(usage, 'completion_tokens', 0) or 0
+    # DeepSeek reports prompt cache hits as `prompt_cache_hit_tokens`, OpenAI under `prompt_tokens_details`.
+    cached = getattr(usage, 'prompt_cache_hit_tokens', None)
+    if cached is None and getattr(usage, 'prompt_tokens_details', None) is not None:
+        cached = getattr(usage.prompt_tokens_details, 'cached_tokens', None)
+    call['cached_tokens'] += cached or 0
+
+
+def note_retry() -> None:
+    call = active_call()
+    if call is not None:
+        call['retries'] += 1
+
+
+def note_first_token() -> None:
+    call = active_call()
+    if call is not None and call['ttft'] is None:
+        call['ttft'] = time.perf_counter()
+
+
+def _percentile(values, q):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def call_cost(call: dict, prices) -> float:
+    """
+    Cost of one call from per-million-token `prices` (input, cached_input, output). Cached prompt tokens are
+    billed at the cached rate.
+    """
+    if not prices:
+        return 0.0
+    uncached = call['prompt_tokens'] - call['cached_tokens']
+    cost = uncached * prices.get('input', 0.0) + call['cached_tokens'] * prices.get('cached_input', 0.0) + \
+        call['completion_tokens'] * prices.get('output', 0.0)
+    return cost / 1e6
+
+
+def summarize(records, keys=None) -> list:
+    """
+    Aggregates call records into one row per combination of `keys` (agent and round by default).
+    """
+    keys = keys if keys else SUMMARY_KEYS
+    groups = {}
+    for record in records:
+        group = tuple(record.get(k) for k in keys)
+        groups.setdefault(group, []).append(record)
+    rows = []
+    for group, group_records in sorted(groups.items(), key=lambda item: [str(v) for v in item[0]]):
+        latencies = [r['latency'] for r in group_records if not r['cache_hit']]
+        ttfts = [r['ttft'] for r in group_records if r.get('ttft') is not None]
+        row = dict(zip(keys, group))
+        row.update({
+            'calls': len(group_records),
+            'cache_hits': sum(1 for r in group_records if r['cache_hit']),
+            'errors': sum(1 for r in group_records if r.get('error')),
+            'retries': sum(r['retries'] for r in group_records),
+            'prompt_tokens': sum(r['prompt_tokens'] for r in group_records),
+            'completion_tokens': sum(r['completion_tokens'] for r in group_records),
+            'cached_tokens': sum(r['cached_tokens'] for r in group_records),
+            'cached_ratio': None,
+            'cost': round(sum(r.get('cost', 0.0) for r in group_records), 4),
+            'hedged': sum(1 for r in group_records if r.get('hedged')),
+            'mean_latency': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'p50_latency': _percentile(latencies, 50),
+            'p95_latency': _percentile(latencies, 95),
+            'p99_latency': _percentile(latencies, 99),
+            'mean_ttft': round(sum(ttfts) / len(ttfts), 3) if ttfts else None,
+        })
+        if row['prompt_tokens'] != 0:
+            row['cached_ratio'] = round(row['cached_tokens'] / row['prompt_tokens'], 4)
+        rows.append(row)
+    return rows
+
+
+def format_summary(rows) -> str:
+    if len(rows) == 0:
+        return '(no LLM calls recorded)'
+    columns = list(rows[0].keys())
+    cells = [[str(row[c]) if row[c] is not None else '-' for c in columns] for row in rows]
+    widths = [max(len(c), *(len(cell[i]) for cell in cells)) for i, c in enumerate(columns)]
+    lines = ['  '.join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines.append('  '.join('-' * w for w in widths))
+    for cell in cells:
+        lines.append('  '.join(v.ljust(w) for v, w in zip(cell, widths)))
+    return '\n'.join(lines)
+
+
+def load_metrics_files(paths) -> list:
+    records = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as reader:
+            for line in reader:
+                line = line.strip()
+                if line != '':
+                    records.append(json.loads(line))
+    return records
+
+
+class MetricsRecorder():
+    """
+    Collects one record per LLM call and streams them to `<output_dir>/llm_calls-<run_id>-<pid>.jsonl`.
+
+    Worker processes forked from the same parent share the run id, so `run_summary` aggregates the whole run.
+    """
+
+    def __init__(self, output_dir: str | None = None, run_id: str | None = None, prices=None):
+        self.output_dir = output_dir
+        self.prices = prices if prices else {}
+        self.run_id = run_id if run_id else time.strftime('%Y%m%d-%H%M%S')
+        self.records = []
+        self._lock = threading.Lock()
+        self._writer = None
+        self._writer_pid = None
+        self._listeners = []
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        atexit.register(self.log_summary)
+
+    def add_listener(self, listener) -> None:
+        self._listeners.append(listener)
+
+    def _get_writer(self):
+        if self.output_dir is None:
+            return None
+        if self._writer is None or self._writer_pid != os.getpid():
+            # Records inherited through fork belong to the parent process.
+            if self._writer_pid is not None:
+                self.records = []
+            self._writer = open(os.path.join(self.output_dir, f'llm_calls-{self.run_id}-{os.getpid()}.jsonl'),
+                                'a', encoding='utf-8')
+            self._writer_pid = os.getpid()
+        return self._writer
+
+    def record(self, call: dict) -> None:
+        call = {'ts': round(time.time(), 3), 'run_id': self.run_id, 'pid': os.getpid(), **call}
+        call['cost'] = round(call_cost(call, self.prices), 6)
+        with self._lock:
+            writer = self._get_writer()
+            self.records.append(call)
+            if writer is not None:
+                writer.write(json.dumps(call, ensure_ascii=False) + '\n')
+                writer.flush()
+        for listener in self._listeners:
+            listener(call)
+
+    def summary(self, keys=None) -> list:
+        with self._lock:
+            return summarize(list(self.records), keys)
+
+    def log_summary(self) -> None:
+        if len(self.records) != 0:
+            logger.info(f'LLM calls of PID {os.getpid()}:\n{format_summary(self.summary())}')
+
+    def run_files(self) -> list:
+        if self.output_dir is None:
+            return []
+        return sorted(glob.glob(os.path.join(self.output_dir, f'llm_calls-{self.run_id}-*.jsonl')))
+
+    def run_summary(self, keys=None) -> list:
+        return summarize(load_metrics_files(self.run_files()), keys)
+
+    def log_run_summary(self, keys=None) -> None:
+        logger.info(f'LLM calls of run {self.run_id}:\n{format_summary(self.run_summary(keys))}')
+
+
+_recorders = {}
+
+
+def load_metrics_recorder(code_base, config):
+    metrics_config = config.get('metrics', {})
+    if not metrics_config or not metrics_config.get('enabled', False):
+        return None
+    output_dir = metrics_config.get('path', 'results/metrics')
+    if not os.path.isabs(output_dir):
+        output_dir = os.path.join(code_base, output_dir)
+    if output_dir not in _recorders:
+        _recorders[output_dir] = MetricsRecorder(output_dir, metrics_config.get('run_id', None),
+                                                  metrics_config.get('prices', {}))
+    return _recorders[output_dir]
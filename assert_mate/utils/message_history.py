@@ -0,0 +1,69 @@
+class Message(dict):
+    """
+    A chat message that cannot be changed once created, so that histories can share it instead of copying it.
+
+    It is still a `dict`, so it serializes with `json.dumps` and is accepted wherever a message dict is.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Messages are immutable; build a new one instead.')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+    __ior__ = _readonly
+
+    def __reduce__(self):
+        return Message, (dict(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def _as_message(message) -> Message:
+    return message if isinstance(message, Message) else Message(message)
+
+
+class MessageHistory(tuple):
+    """
+    An immutable conversation. Appending returns a new history that shares every existing message with the old
+    one, so forking a conversation costs one tuple of references instead of a deep copy, and a history handed to
+    another agent or stored in a record can never change behind its back.
+
+    It is a `tuple` of `dict` messages, so it can be passed to the LLM clients and `json.dumps` as it is.
+    """
+
+    def __new__(cls, messages=()):
+        if isinstance(messages, MessageHistory):
+            return messages
+        return super().__new__(cls, (_as_message(message) for message in messages))
+
+    def with_message(self, role: str, content: str, **extra) -> 'MessageHistory':
+        return tuple.__new__(MessageHistory, (*self, Message(role=role, content=content, **extra)))
+
+    def with_messages(self, messages) -> 'MessageHistory':
+        return tuple.__new__(MessageHistory, (*self, *(_as_message(message) for message in messages)))
+
+    def __add__(self, other):
+        return self.with_messages(other)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return tuple.__new__(MessageHistory, tuple.__getitem__(self, item))
+        return tuple.__getitem__(self, item)
+
+    def __reduce__(self):
+        return MessageHistory, (tuple(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def to_list(self) -> list:
+        """
+        Plain, mutable copies of the messages, for code that edits them.
+        """
+        return [dict(message) for message in self]
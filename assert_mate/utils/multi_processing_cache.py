@@ -1,5 +1,6 @@
 import json
 import os
+import hashlib
 from multiprocessing import Manager
 
 from loguru import logger
@@ -10,6 +11,8 @@ class MultiProcessingCache():
         manager = Manager()
         self._cot_thoughts = manager.dict()
         self._cot_thoughts.update(thoughts)
+        self._stats = manager.dict({'hits': 0, 'misses': 0})
+        self._stats_lock = manager.Lock()
 
     @property
     def cot_thoughts(self):
@@ -19,6 +22,40 @@ class MultiProcessingCache():
         logger.debug(f'Updating thought:{add_thought}')
         self._cot_thoughts.update(add_thought)
 
+    @staticmethod
+    def thought_key(model_name, step, messages) -> str:
+        """
+        A thought is keyed by the model and every message it answers. Earlier rounds are part of the messages,
+        so the key of each round chains the inputs of all rounds before it.
+        """
+        serialized = json.dumps([model_name, [{'role': m['role'], 'content': m['content']} for m in messages]],
+                                ensure_ascii=False)
+        return f'{step}:{hashlib.sha256(serialized.encode("utf-8")).hexdigest()}'
+
+    def get_thought(self, key):
+        thought = self._cot_thoughts.get(key, None)
+        with self._stats_lock:
+            if thought is None:
+                self._stats['misses'] += 1
+            else:
+                self._stats['hits'] += 1
+        return thought
+
+    def put_thought(self, key, thought) -> None:
+        self._cot_thoughts[key] = thought
+
+    def stats(self) -> dict:
+        hits, misses = self._stats['hits'], self._stats['misses']
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            'entries': len(self._cot_thoughts)
+        }
+
+    def log_stats(self) -> None:
+        logger.info(f'CoT thought cache: {self.stats()}')
+
 
 def load_cache(code_base):
     if os.path.exists(os.path.join(code_base, 'cache/cot_thoughts.json')):
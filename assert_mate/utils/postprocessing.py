@@ -84,3 +84,57 @@ def ast_to_tuple(node):
     else:
         return node
 
+
+
+def _statement_end(code: str) -> int:
+    # Index just after the first `;` outside string/char literals and parentheses, or -1.
+    depth = 0
+    quote = None
+    escaped = False
+    for idx, ch in enumerate(code):
+        if quote:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == quote:
+                quote = None
+        elif ch in '"\'':
+            quote = ch
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch == ';' and depth <= 0:
+            return idx + 1
+    return -1
+
+
+def first_code_block_end(llm_response: str) -> int:
+    """
+    Finds where a (possibly still streaming) response has said everything `extract_assertion_from_response` needs.
+
+    Returns the index just after the closing fence of the first code block, or just after the first statement
+    of that block when the block starts with a complete `assert...;` statement. Returns -1 if neither has been
+    seen yet.
+    """
+    if llm_response.startswith('```'):
+        open_idx = 0
+    else:
+        open_idx = llm_response.find('\n```')
+        if open_idx == -1:
+            return -1
+        open_idx += 1
+    code_start = llm_response.find('\n', open_idx)
+    if code_start == -1:
+        return -1
+    code_start += 1
+    close_idx = llm_response.find('\n```', code_start - 1)
+    if close_idx != -1:
+        return close_idx + len('\n```')
+    code = llm_response[code_start:]
+    if code.lstrip().startswith('assert'):
+        end = _statement_end(code)
+        if end != -1:
+            return code_start + end
+    return -1
@@ -0,0 +1,68 @@
+SYSTEM_PROMPT = "You are an expert in software testing, with 10 years of experience. You are very good at writing " \
+                "test cases. You work in a team that completes assertions of Java unit tests."
+
+SHARED_INSTRUCTIONS = 'The task is to complete the assertion of a Java test case. Below are the class that declares ' \
+                      'the method under test (if known), the method under test and the test case, where the part ' \
+                      'to complete is marked with `<expected_value>` or `<AssertionPlaceHolder>`. The question ' \
+                      'for you comes last.\n\n'
+
+EQUALS_QUESTION = 'Please read the code, and accomplish the assertion statement by choosing the proper value for ' \
+                  'the `<expected_value>` part.\n'
+BOOLEAN_QUESTION = 'Please read the code and write an assertion statement in the `<AssertionPlaceHolder>` line.\n' \
+                   'You **MUST** use either `assertTrue()` or `assertFalse()` method to verify the result.\n'
+NULL_QUESTION = 'Please read the code and write an assertion statement in the `<AssertionPlaceHolder>` line.\n' \
+                'You **MUST** use either `assertNull()` or `assertNotNull()` method to verify the result.\n'
+ANSWER_FORMAT = 'Please write down the completed assertion and provide a short explanation. You should keep your ' \
+                'answer within 200 words.'
+
+
+def class_context(focal_class_fields=(), focal_class_methods=(), test_class_fields=()) -> str:
+    context = ''
+    if len(focal_class_fields) != 0 or len(focal_class_methods) != 0:
+        context += 'The method under test is declared in a class with the following fields and methods:\n```java\n'
+        context += ''.join(field + '\n' for field in focal_class_fields)
+        context += ''.join(method + '\n' for method in focal_class_methods)
+        context += '```\n'
+    if len(test_class_fields) != 0:
+        context += 'The test case is declared in a class with the following fields:\n```java\n'
+        context += ''.join(field + '\n' for field in test_class_fields)
+        context += '```\n'
+    return context
+
+
+def instance_context(focal_method: str, test_prefix: str, focal_class_fields=(), focal_class_methods=(),
+                     test_class_fields=()) -> str:
+    """
+    Everything one instance shares between its agents and rounds, after the shared instructions.
+    """
+    context = class_context(focal_class_fields, focal_class_methods, test_class_fields)
+    context += f'The method under test is:\n```java\n{focal_method}\n```\n'
+    context += f'The test case is:\n```java\n{test_prefix}\n```\n\n'
+    return context
+
+
+def similar_example(retrieved_focal_method: str | None, retrieved_test_case: str | None) -> str:
+    if not (retrieved_focal_method and retrieved_test_case):
+        return ''
+    return 'Here is a similar focal method and its corresponding test case, I hope this could help you:\n```java\n' + \
+        retrieved_focal_method + '\n' + retrieved_test_case + '\n```\n'
+
+
+def layout_messages(question: str, focal_method: str, test_prefix: str, focal_class_fields=(),
+                    focal_class_methods=(), test_class_fields=()) -> list:
+    """
+    Messages laid out for providers that cache prompt prefixes (the hosted DeepSeek API bills cached prefix tokens
+    at a fraction of the price). Content runs from the most to the least stable part: the system prompt and the
+    task instructions (the same for every request), the focal class context (shared by the instances of a class),
+    the focal method and the test prefix (shared by every agent and round of an instance) and only then the
+    `question` of the agent and round. All agents and the Judge share the system prompt, so they all reuse the
+    prefix of an instance.
+    """
+    return [{
+        'role': 'system',
+        'content': SYSTEM_PROMPT
+    }, {
+        'role': 'user',
+        'content': SHARED_INSTRUCTIONS + instance_context(focal_method, test_prefix, focal_class_fields,
+                                                          focal_class_methods, test_class_fields) + question
+    }]
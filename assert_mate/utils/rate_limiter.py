@@ -0,0 +1,205 @@
+import os
+import time
+import uuid
+import random
+import asyncio
+import sqlite3
+import threading
+
+from loguru import logger
+
+
+class AdaptiveRateLimiter():
+    """
+    Token-bucket rate limiter with AIMD concurrency control, shared by every process that points at the same
+    state file.
+
+    Two buckets refill continuously: one for requests per minute and one for tokens per minute (0 disables a
+    bucket). On top of the buckets, the number of requests in flight is capped by an adaptive limit that grows
+    additively after every success and shrinks multiplicatively after a 429, which also pauses all workers until
+    the `Retry-After` delay has passed. The state lives in SQLite so that all worker processes of a run see the
+    same buckets, leases and cool-down.
+    """
+
+    def __init__(self, state_path: str, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 max_concurrency: int = 64, min_concurrency: int = 1, initial_concurrency: int = 16,
+                 additive_increase: float = 1.0, multiplicative_decrease: float = 0.5, lease_timeout: float = 900.0):
+        self.state_path = state_path
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.initial_concurrency = min(max(initial_concurrency, min_concurrency), max_concurrency)
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.lease_timeout = lease_timeout
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        if not os.path.exists(os.path.dirname(state_path)):
+            os.makedirs(os.path.dirname(state_path))
+
+    def _connection(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.state_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS limiter ('
+                         'id INTEGER PRIMARY KEY CHECK (id = 0), request_tokens REAL, token_tokens REAL, '
+                         'updated_at REAL, concurrency_limit REAL, cooldown_until REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS leases (id TEXT PRIMARY KEY, pid INTEGER, acquired_at REAL)')
+            conn.execute('INSERT OR IGNORE INTO limiter VALUES (0, ?, ?, ?, ?, 0)',
+                         (self.rpm, self.tpm, time.time(), self.initial_concurrency))
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _drop_stale_leases(self, conn, now):
+        # Leases of crashed workers would otherwise hold concurrency slots forever.
+        conn.execute('DELETE FROM leases WHERE acquired_at < ?', (now - self.lease_timeout,))
+        for lease_id, pid in conn.execute('SELECT id, pid FROM leases').fetchall():
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                conn.execute('DELETE FROM leases WHERE id = ?', (lease_id,))
+            except PermissionError:
+                pass
+
+    def try_acquire(self, tokens: int = 0):
+        """
+        Tries to take one request slot and `tokens` tokens.
+
+        Returns `(lease_id, 0)` on success, or `(None, seconds)` with a suggested wait before trying again.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                request_tokens, token_tokens, updated_at, limit, cooldown_until = conn.execute(
+                    'SELECT request_tokens, token_tokens, updated_at, concurrency_limit, cooldown_until '
+                    'FROM limiter WHERE id = 0').fetchone()
+                elapsed = max(0.0, now - updated_at)
+                if self.rpm:
+                    request_tokens = min(self.rpm, request_tokens + elapsed * self.rpm / 60)
+                if self.tpm:
+                    token_tokens = min(self.tpm, token_tokens + elapsed * self.tpm / 60)
+                    # A single request larger than the whole bucket would never fit.
+                    tokens = min(tokens, self.tpm)
+                self._drop_stale_leases(conn, now)
+                in_flight = conn.execute('SELECT COUNT(*) FROM leases').fetchone()[0]
+
+                wait = 0.0
+                if cooldown_until > now:
+                    wait = cooldown_until - now
+                elif in_flight >= int(limit):
+                    wait = 0.05
+                elif self.rpm and request_tokens < 1:
+                    wait = (1 - request_tokens) * 60 / self.rpm
+                elif self.tpm and token_tokens < tokens:
+                    wait = (tokens - token_tokens) * 60 / self.tpm
+
+                lease_id = None
+                if wait == 0.0:
+                    if self.rpm:
+                        request_tokens -= 1
+                    if self.tpm:
+                        token_tokens -= tokens
+                    lease_id = uuid.uuid4().hex
+                    conn.execute('INSERT INTO leases VALUES (?, ?, ?)', (lease_id, os.getpid(), now))
+                conn.execute('UPDATE limiter SET request_tokens = ?, token_tokens = ?, updated_at = ? WHERE id = 0',
+                             (request_tokens, token_tokens, now))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return lease_id, wait
+
+    def acquire(self, tokens: int = 0) -> str:
+        while True:
+            lease_id, wait = self.try_acquire(tokens)
+            if lease_id is not None:
+                return lease_id
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 0) -> str:
+        while True:
+            # The SQLite transaction blocks (up to the busy timeout) while other workers hold the state file, so it
+            # runs in a thread to keep the event loop serving the requests in flight.
+            lease_id, wait = await asyncio.to_thread(self.try_acquire, tokens)
+            if lease_id is not None:
+                return lease_id
+            await asyncio.sleep(wait)
+
+    def release(self, lease_id: str, success: bool = True, rate_limited: bool = False,
+                retry_after: float | None = None, reserved_tokens: int = 0, used_tokens: int | None = None):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM leases WHERE id = ?', (lease_id,))
+                token_tokens, limit, cooldown_until = conn.execute(
+                    'SELECT token_tokens, concurrency_limit, cooldown_until FROM limiter WHERE id = 0').fetchone()
+                if rate_limited:
+                    limit = max(self.min_concurrency, limit * self.multiplicative_decrease)
+                    if retry_after:
+                        cooldown_until = max(cooldown_until, now + retry_after)
+                    logger.warning(f'Rate limited, concurrency limit lowered to {limit:.1f}.')
+                elif success:
+                    limit = min(self.max_concurrency, limit + self.additive_increase / max(limit, 1.0))
+                if self.tpm and used_tokens is not None:
+                    # Settle the difference between the reservation and the real usage.
+                    token_tokens -= used_tokens - reserved_tokens
+                conn.execute('UPDATE limiter SET token_tokens = ?, concurrency_limit = ?, cooldown_until = ? '
+                             'WHERE id = 0', (token_tokens, limit, cooldown_until))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    async def arelease(self, lease_id: str, **kwargs):
+        # Like `aacquire`, keeps the SQLite write off the event loop.
+        await asyncio.to_thread(self.release, lease_id, **kwargs)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """
+    Exponential backoff with full jitter: a random delay in [0, min(cap, base * 2 ** attempt)].
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def retry_after_seconds(error) -> float | None:
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers.get('retry-after-ms')) / 1000
+        if headers.get('retry-after'):
+            return float(headers.get('retry-after'))
+    except ValueError:
+        return None
+    return None
+
+
+_limiters = {}
+
+
+def load_rate_limiter(code_base, config):
+    limiter_config = config.get('rate_limit', {})
+    if not limiter_config or not limiter_config.get('enabled', False):
+        return None
+    state_path = limiter_config.get('path', 'cache/rate_limiter.sqlite')
+    if not os.path.isabs(state_path):
+        state_path = os.path.join(code_base, state_path)
+    if state_path not in _limiters:
+        _limiters[state_path] = AdaptiveRateLimiter(
+            state_path,
+            requests_per_minute=limiter_config.get('requests_per_minute', 0),
+            tokens_per_minute=limiter_config.get('tokens_per_minute', 0),
+            max_concurrency=limiter_config.get('max_concurrency', 64),
+            min_concurrency=limiter_config.get('min_concurrency', 1),
+            initial_concurrency=limiter_config.get('initial_concurrency', 16))
+    return _limiters[state_path]
@@ -0,0 +1,51 @@
+import functools
+
+from loguru import logger
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count of a piece of text (about four characters per token for code and English).
+    """
+    if not text:
+        return 0
+    return len(text) // 4 + 1
+
+
+def estimate_messages_tokens(messages) -> int:
+    if isinstance(messages, str):
+        return estimate_tokens(messages)
+    total = 0
+    for message in messages:
+        # Every chat message carries a few tokens of role and formatting overhead.
+        total += estimate_tokens(message.get('content', '')) + 4
+    return total
+
+
+
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(path: str):
+    """
+    The Hugging Face tokenizer at `path`, loaded once per process. Returns None (and token counts fall back to
+    `estimate_tokens`) if `transformers` is not installed or the tokenizer cannot be loaded.
+    """
+    try:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(path)
+    except Exception as e:
+        logger.warning(f'Tokenizer {path} could not be loaded, estimating token counts instead: {str(e)}')
+        return None
+
+
+@functools.lru_cache(maxsize=65536)
+def count_tokens(text: str, tokenizer_path: str | None = None) -> int:
+    """
+    Token count of `text` with the tokenizer at `tokenizer_path`, or `estimate_tokens` without one. Counts are
+    cached, since the same class members are counted again for every instance of a class.
+    """
+    if not text:
+        return 0
+    tokenizer = load_tokenizer(tokenizer_path) if tokenizer_path else None
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer.encode(text, add_special_tokens=False))
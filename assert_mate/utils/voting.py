@@ -0,0 +1,165 @@
+import os
+import json
+
+import numpy as np
+from loguru import logger
+
+from utils.agreement import extract_assertion, assertion_key, assertion_matches
+
+
+def _last_answer(history) -> str:
+    for message in reversed(history or []):
+        if message.get('role') == 'assistant':
+            return message.get('content', '')
+    return ''
+
+
+def record_candidates(record: dict) -> list:
+    """
+    The candidates in one result record, as dicts of `agent`, `response` and `confidence` (None for plain answers).
+
+    Understands the combined first-round records (`members` by id, each with a `history`), per-member records
+    (`member` and `history`) and the records of the `_multiple` generators (`member`, `responses` and their
+    `probs`, the 0-100 confidences of `get_multiple_responses_with_prefix`).
+    """
+    if 'members' in record:
+        return [{'agent': member_id, 'response': _last_answer(member.get('history')), 'confidence': None}
+                for member_id, member in record['members'].items()]
+    agent = record.get('member', 'unknown')
+    if 'responses' in record:
+        probs = record.get('probs') or [None] * len(record['responses'])
+        return [{'agent': agent, 'response': response, 'confidence': prob}
+                for response, prob in zip(record['responses'], probs)]
+    return [{'agent': agent, 'response': _last_answer(record.get('history')), 'confidence': None}]
+
+
+def load_candidates(paths) -> dict:
+    """
+    Gathers the candidates of every instance over several result files, keyed by instance id. Every entry holds
+    the `expected_value` (if a record has one) and the `candidates` of all files.
+    """
+    instances = {}
+    for path in paths:
+        if not os.path.exists(path):
+            logger.error(f'Result file {path} does not exist.')
+            continue
+        with open(path, 'r', encoding='utf-8') as reader:
+            for line in reader:
+                line = line.strip()
+                if line == '':
+                    continue
+                record = json.loads(line)
+                instance = instances.setdefault(record['id'], {'expected_value': None, 'candidates': []})
+                if instance['expected_value'] is None:
+                    instance['expected_value'] = record.get('expected_value')
+                instance['candidates'] += record_candidates(record)
+    return instances
+
+
+class WeightedVoter():
+    """
+    Picks one assertion per instance from the candidates of all agents by weighted voting.
+
+    Candidates are clustered by normalized assertion (`assertion_key`); answers without an assertion do not vote.
+    A candidate weighs `agent_weights[agent]` (or `default_weight`) times `(confidence / 100) ** confidence_exponent`,
+    where plain answers count as fully confident, so an exponent of 0 is a plain majority vote. With
+    `normalize_samples`, the sampled candidates of one agent on one instance split that weight between them, so
+    that ten samples do not outvote two single answers. Ties go to the cluster backed by more agents, then to the
+    one seen first.
+    """
+
+    def __init__(self, agent_weights: dict = None, default_weight: float = 1.0, confidence_exponent: float = 1.0,
+                 normalize_samples: bool = True):
+        self.agent_weights = dict(agent_weights or {})
+        self.default_weight = default_weight
+        self.confidence_exponent = confidence_exponent
+        self.normalize_samples = normalize_samples
+
+    def _flatten(self, instances: dict):
+        # One row per voting candidate across all instances; clusters and agents are interned as integer codes
+        # so that the scoring below runs on flat arrays.
+        ids = list(instances)
+        rows = {'instance': [], 'cluster': [], 'agent': [], 'group': [], 'weight': [], 'prob': []}
+        clusters, agents, groups, assertions = {}, {}, {}, []
+        for instance_idx, instance_id in enumerate(ids):
+            for candidate in instances[instance_id]['candidates']:
+                assertion = extract_assertion(candidate['response'] or '')
+                key = assertion_key(assertion)
+                if key is None:
+                    continue
+                cluster = clusters.setdefault((instance_idx, key), len(clusters))
+                if cluster == len(assertions):
+                    assertions.append(assertion)
+                agent = agents.setdefault(candidate['agent'], len(agents))
+                sampled = candidate['confidence'] is not None
+                rows['instance'].append(instance_idx)
+                rows['cluster'].append(cluster)
+                rows['agent'].append(agent)
+                rows['group'].append(groups.setdefault((instance_idx, agent, sampled), len(groups)))
+                rows['weight'].append(self.agent_weights.get(candidate['agent'], self.default_weight))
+                rows['prob'].append(candidate['confidence'] / 100 if sampled else 1.0)
+        arrays = {name: np.asarray(values, dtype=np.float64 if name in ('weight', 'prob') else np.int64)
+                  for name, values in rows.items()}
+        return ids, arrays, assertions, len(agents), len(groups)
+
+    def vote(self, instances: dict) -> dict:
+        """
+        Votes on every instance of `instances` (as returned by `load_candidates`) at once. Returns, by instance id,
+        the winning `assertion` with its `score`, its `share` of the instance's total score and the number of
+        `agents` behind it; instances without any voting candidate get an empty assertion.
+        """
+        ids, rows, assertions, num_agents, num_groups = self._flatten(instances)
+        results = {instance_id: {'assertion': '', 'score': 0.0, 'share': 0.0, 'agents': 0} for instance_id in ids}
+        if len(assertions) == 0:
+            return results
+        weights = rows['weight'] * np.power(np.clip(rows['prob'], 0.0, 1.0), self.confidence_exponent)
+        if self.normalize_samples:
+            weights = weights / np.bincount(rows['group'], minlength=num_groups)[rows['group']]
+        num_clusters = len(assertions)
+        score = np.bincount(rows['cluster'], weights=weights, minlength=num_clusters)
+        cluster_agents = np.unique(rows['cluster'] * num_agents + rows['agent']) // num_agents
+        agent_count = np.bincount(cluster_agents, minlength=num_clusters)
+        cluster_instance = np.zeros(num_clusters, dtype=np.int64)
+        cluster_instance[rows['cluster']] = rows['instance']
+        instance_total = np.bincount(cluster_instance, weights=score, minlength=len(ids))
+        # Clusters are numbered in order of appearance, so the cluster index breaks the remaining ties.
+        order = np.lexsort((np.arange(num_clusters), -agent_count, -score, cluster_instance))
+        _, first = np.unique(cluster_instance[order], return_index=True)
+        for cluster in order[first]:
+            instance_idx = cluster_instance[cluster]
+            total = instance_total[instance_idx]
+            results[ids[instance_idx]] = {
+                'assertion': assertions[cluster],
+                'score': round(float(score[cluster]), 4),
+                'share': round(float(score[cluster] / total), 4) if total > 0 else 0.0,
+                'agents': int(agent_count[cluster]),
+            }
+        return results
+
+    def vote_answers(self, answers: dict) -> str:
+        """
+        The winning assertion among the plain answers of one instance, by agent; '' if none holds an assertion.
+        """
+        candidates = [{'agent': agent, 'response': answer, 'confidence': None} for agent, answer in answers.items()]
+        return self.vote({None: {'candidates': candidates}})[None]['assertion']
+
+
+def voting_accuracy(instances: dict, results: dict) -> dict:
+    scored = [instance_id for instance_id, instance in instances.items() if instance['expected_value'] is not None]
+    correct = sum(1 for instance_id in scored
+                  if assertion_matches(instances[instance_id]['expected_value'], results[instance_id]['assertion']))
+    return {
+        'instances': len(instances),
+        'scored': len(scored),
+        'correct': correct,
+        'accuracy': round(correct / len(scored), 4) if scored else None,
+    }
+
+
+def load_weighted_voter(config) -> WeightedVoter:
+    voting_config = config.get('voting', {})
+    return WeightedVoter(
+        agent_weights=voting_config.get('agent_weights', {}),
+        default_weight=voting_config.get('default_weight', 1.0),
+        confidence_exponent=voting_config.get('confidence_exponent', 1.0),
+        normalize_samples=voting_config.get('normalize_samples', True))